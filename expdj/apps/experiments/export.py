@@ -0,0 +1,427 @@
+'''
+export.py: export of battery and experiment results
+
+Results are read in chunks of EXPORT_CHUNK_SIZE (ResultQuerySet.chunked),
+so memory is bounded by one chunk whatever the size of the battery. The
+columns come from the experiment schemas recorded when results complete
+(turk.models.ExperimentSchema), so a single pass streams one TSV row per trial.
+
+The columnar formats are built one experiment at a time, with typed
+columns, into a temporary file that is then served:
+
+    parquet, feather    zip of one file per experiment (requires pyarrow)
+    hdf5                one group per experiment, one dataset per column
+
+Exports too large for a request are written by ExportJob tasks instead
+(see experiments/tasks.py), which follow their progress with ExportProgress.
+Batteries with at least EXPORT_POOL_MIN_EXPERIMENTS experiments are then
+written by a pool of EXPORT_PROCESSES processes, one file per experiment,
+merged at the end (see write_export_parallel).
+'''
+
+from django.db import connections
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from expdj.apps.experiments.utils import (
+    get_result_columns, make_experiment_lookup, make_results_df,
+    result_rows
+)
+from expdj.apps.experiments.models import Battery, ExportJob
+from expdj.apps.turk import codec
+from expdj.apps.turk.models import Result, get_schema_variables, get_trial_keys
+from expdj.settings import (
+    EXPORT_CHUNK_SIZE, EXPORT_PROCESSES, EXPORT_POOL_MIN_EXPERIMENTS
+)
+
+import csv
+import h5py
+import multiprocessing
+import numpy
+import os
+import pandas
+import shutil
+import tempfile
+import zipfile
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class ExportProgress(object):
+    '''ExportProgress counts the results read by an export, and calls report
+    with the count after each chunk of EXPORT_CHUNK_SIZE results
+    :param job_id: the id of the ExportJob written, if any, kept alive by the
+    pool processes of a parallel export (see heartbeat_export_job)
+    '''
+    def __init__(self,report,job_id=None):
+        self.report = report
+        self.count = 0
+        self.job_id = job_id
+
+    def track(self,results):
+        for result in results:
+            yield result
+            self.count += 1
+            if self.count % EXPORT_CHUNK_SIZE == 0:
+                self.report(self.count)
+
+
+def heartbeat_export_job(job_id):
+    '''heartbeat_export_job records that a running export job is still writing, so
+    it is not taken for stalled (see experiments.tasks.fail_stalled_export_jobs)
+    '''
+    if job_id != None:
+        ExportJob.objects.filter(id=job_id,status="RUNNING").update(update_date=timezone.now())
+
+
+def track_results(results,progress=None):
+    if progress == None:
+        return results
+    return progress.track(results)
+
+
+def get_export_results(battery,experiment_tags=None,filters=None):
+    '''get_export_results returns the completed results of a battery, optionally
+    only for some experiments
+    :param experiment_tags: list of ExperimentTemplate.exp_id
+    :param filters: optional result filters, see turk.utils.get_result_filters,
+    with completed None to include the results that are not completed
+    '''
+    filters = dict(filters or {})
+    completed = filters.pop("completed",True)
+    results = Result.objects.filter(battery=battery)
+    if completed != None:
+        results = results.filter(completed=completed)
+    if experiment_tags != None:
+        if isinstance(experiment_tags,str):
+            experiment_tags = [experiment_tags]
+        results = results.filter(experiment__exp_id__in=experiment_tags)
+    return results.filter_results(**filters)
+
+
+def scan_export_variables(results):
+    '''scan_export_variables returns the sorted trial variables of results by
+    reading their taskdata, for results that are not in the experiment schemas
+    '''
+    variables = set()
+    for result in results.taskdata_only().chunked():
+        keys,trialdata_keys = get_trial_keys(result.stored_taskdata())
+        variables.update(keys)
+        variables.update(trialdata_keys)
+    return sorted(variables)
+
+
+def get_export_variables(battery,experiment_tags=None,filters=None):
+    '''get_export_variables returns the sorted trial variables of the completed results
+    of a battery, from the experiment schemas (see turk.models.ExperimentSchema)
+    :param experiment_tags: optional list of ExperimentTemplate.exp_id
+    :param filters: optional result filters, see get_export_results. Filters on
+    workers or dates keep the columns of the whole experiments, while results
+    that are not completed have no schema and are read for their variables
+    '''
+    filters = filters or {}
+    if isinstance(experiment_tags,str):
+        experiment_tags = [experiment_tags]
+    if experiment_tags == None:
+        experiment_tags = filters.get("experiment_tags")
+    if filters.get("completed",True) != True:
+        return scan_export_variables(get_export_results(battery,experiment_tags,filters))
+    return get_schema_variables(battery,experiment_tags)
+
+
+def get_export_rows(battery,results,variables,header=True,progress=None):
+    '''get_export_rows yields the header and then one row per trial of results
+    :param header: False to yield only the rows
+    :param progress: an optional ExportProgress
+    '''
+    if header:
+        yield get_result_columns(variables)
+    lookup = dict()
+    for result in track_results(results.for_export().chunked(),progress):
+        exp_id = result.experiment.exp_id
+        if exp_id not in lookup:
+            lookup.update(make_experiment_lookup([exp_id],battery))
+        if exp_id in lookup:
+            for row in result_rows(battery,result,variables,lookup[exp_id]):
+                yield row
+
+
+class Echo(object):
+    '''A file-like object whose write returns the value, for csv.writer'''
+    def write(self,value):
+        return value
+
+
+def encode_value(value):
+    if isinstance(value,unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def stream_tsv(rows):
+    writer = csv.writer(Echo(),delimiter='\t')
+    for row in rows:
+        yield writer.writerow([encode_value(x) for x in row])
+
+
+def write_tsv(tsv,rows):
+    for line in stream_tsv(rows):
+        tsv.write(line)
+
+
+def export_tsv(battery,output_name,experiment_tags=None,filters=None):
+    '''export_tsv returns a streaming response with the results of a battery as TSV
+    :param output_name: the file name of the download, without extension
+    :param experiment_tags: optional list of ExperimentTemplate.exp_id to export
+    :param filters: optional result filters, see get_export_results
+    '''
+    results = get_export_results(battery,experiment_tags,filters)
+    variables = get_export_variables(battery,experiment_tags,filters)
+    rows = get_export_rows(battery,results,variables)
+    response = StreamingHttpResponse(stream_tsv(rows),content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s.tsv"' %(output_name)
+    return response
+
+
+# COLUMNAR FORMATS ######################################################
+
+# Trial fields that are always numeric, values that are not become missing
+NUMERIC_COLUMNS = ["result_rt",
+                   "result_trial_index",
+                   "result_key_press",
+                   "result_time_elapsed"]
+
+def to_text(value):
+    if value is None or (isinstance(value,float) and numpy.isnan(value)):
+        return u""
+    if isinstance(value,str):
+        return value.decode("utf-8")
+    return unicode(value)
+
+
+def get_typed_frame(df):
+    '''get_typed_frame converts the columns of an export DataFrame to numeric
+    when every value is numeric (always for NUMERIC_COLUMNS), otherwise to text
+    '''
+    df.index = range(0,df.shape[0])
+    for column in df.columns:
+        if column in NUMERIC_COLUMNS:
+            df[column] = pandas.to_numeric(df[column],errors="coerce")
+            continue
+        try:
+            df[column] = pandas.to_numeric(df[column])
+        except (ValueError,TypeError):
+            df[column] = df[column].map(to_text)
+    return df
+
+
+def get_experiment_frames(battery,results,progress=None):
+    '''get_experiment_frames yields (exp_id, DataFrame) for each experiment in results,
+    so only one experiment is held in memory at a time
+    :param progress: an optional ExportProgress
+    '''
+    exp_ids = set(results.order_by().values_list("experiment__exp_id",flat=True).distinct())
+    for exp_id in sorted(exp_ids):
+        experiment_results = results.filter(experiment__exp_id=exp_id).for_export()
+        experiment_results = track_results(experiment_results.chunked(),progress)
+        df = make_results_df(battery,experiment_results)
+        yield exp_id,get_typed_frame(df)
+
+
+def write_hdf5(frames,path):
+    text = h5py.special_dtype(vlen=unicode)
+    with h5py.File(path,"w") as hdf5:
+        for exp_id,df in frames:
+            group = hdf5.create_group(exp_id)
+            group.attrs["columns"] = codec.dumps(df.columns.tolist())
+            for column in df.columns:
+                values = df[column].values
+                options = {"compression":"gzip"} if len(values) > 0 else {}
+                if values.dtype == object:
+                    options["dtype"] = text
+                group.create_dataset(column.replace("/","_"),data=values,**options)
+
+
+def write_arrow_frame(df,path,format):
+    if format == "parquet":
+        table = pyarrow.Table.from_pandas(df,preserve_index=False)
+        pyarrow.parquet.write_table(table,path)
+    else:
+        pyarrow.feather.write_feather(df,path)
+
+
+def write_arrow(frames,path,format):
+    with zipfile.ZipFile(path,"w",zipfile.ZIP_STORED,allowZip64=True) as archive:
+        for exp_id,df in frames:
+            handle,member = tempfile.mkstemp(suffix=".%s" %format)
+            os.close(handle)
+            try:
+                write_arrow_frame(df,member,format)
+                archive.write(member,"%s.%s" %(exp_id,format))
+            finally:
+                os.remove(member)
+
+
+# format: (extension, content type)
+EXPORT_FORMATS = {"tsv":("tsv","text/csv"),
+                  "parquet":("zip","application/zip"),
+                  "feather":("zip","application/zip"),
+                  "hdf5":("h5","application/x-hdf5")}
+
+def get_export_formats():
+    '''get_export_formats returns the export formats available in this install'''
+    formats = ["tsv","parquet","feather","hdf5"]
+    return [x for x in formats if pyarrow != None or x not in ["parquet","feather"]]
+
+
+def write_export(battery,results,path,format,progress=None,experiment_tags=None,processes=None,
+                 filters=None):
+    '''write_export writes results to path in one of the EXPORT_FORMATS, with a pool
+    of processes when there are enough experiments (see use_export_pool)
+    :param progress: an optional ExportProgress
+    :param experiment_tags: the experiments of results, None for all in the battery
+    :param processes: size of the pool, default EXPORT_PROCESSES, 1 to export serially
+    :param filters: the result filters of results, see get_export_results
+    '''
+    if processes == None:
+        processes = EXPORT_PROCESSES
+    exp_ids = sorted(set(results.order_by().values_list("experiment_id",flat=True).distinct()))
+    if use_export_pool(exp_ids,processes):
+        variables = get_export_variables(battery,experiment_tags,filters) if format == "tsv" else None
+        write_export_parallel(battery,results,exp_ids,path,format,variables,processes,progress)
+        return
+    if format == "tsv":
+        variables = get_export_variables(battery,experiment_tags,filters)
+        with open(path,"wb") as tsv:
+            write_tsv(tsv,get_export_rows(battery,results,variables,progress=progress))
+        return
+    frames = get_experiment_frames(battery,results,progress)
+    if format == "hdf5":
+        write_hdf5(frames,path)
+    else:
+        write_arrow(frames,path,format)
+
+
+def export_file(battery,output_name,experiment_tags=None,format="hdf5",filters=None):
+    '''export_file returns a response serving a columnar export from a temporary file,
+    written in the request process (large batteries should use an ExportJob)
+    :param output_name: the file name of the download, without extension
+    :param format: one of parquet, feather or hdf5, see get_export_formats
+    :param filters: optional result filters, see get_export_results
+    '''
+    extension,content_type = EXPORT_FORMATS[format]
+    handle,path = tempfile.mkstemp(suffix=".%s" %extension)
+    os.close(handle)
+    try:
+        write_export(battery,get_export_results(battery,experiment_tags,filters),path,format,
+                     experiment_tags=experiment_tags,processes=1,filters=filters)
+        export = open(path,"rb")
+    finally:
+        # the open file stays readable until the response closes it
+        os.remove(path)
+    response = FileResponse(export,content_type=content_type)
+    response['Content-Length'] = os.fstat(export.fileno()).st_size
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' %(output_name,extension)
+    return response
+
+
+# PARALLEL EXPORT #######################################################
+
+def use_export_pool(exp_ids,processes):
+    '''use_export_pool returns True when an export of exp_ids should use a pool of
+    processes: more than one process, at least EXPORT_POOL_MIN_EXPERIMENTS experiments,
+    and the current process can have children (daemonic processes cannot)
+    and is not in a transaction, as the database connections are closed to fork
+    '''
+    if processes < 2 or len(exp_ids) < EXPORT_POOL_MIN_EXPERIMENTS:
+        return False
+    if multiprocessing.current_process().daemon:
+        return False
+    return not any([c.in_atomic_block for c in connections.all()])
+
+
+def write_partition(args):
+    '''write_partition writes the results of one experiment to its own file, in a
+    pool process, and returns the number of results written. The export job, if
+    any, is kept alive after each chunk of results.
+    :param args: (battery id, exp_id, pickled results query, path, format, variables, job id)
+    '''
+    battery_id,exp_id,query,path,format,variables,job_id = args
+    try:
+        battery = Battery.objects.select_related("owner").get(id=battery_id)
+        results = Result.objects.all()
+        results.query = query
+        progress = ExportProgress(lambda count: heartbeat_export_job(job_id))
+        if format == "tsv":
+            with open(path,"wb") as tsv:
+                write_tsv(tsv,get_export_rows(battery,results,variables,header=False,progress=progress))
+        else:
+            frames = get_experiment_frames(battery,results,progress)
+            if format == "hdf5":
+                write_hdf5(frames,path)
+            else:
+                for _,df in frames:
+                    write_arrow_frame(df,path,format)
+        return exp_id,progress.count
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+def merge_partitions(partitions,path,format,variables):
+    '''merge_partitions writes the export from the per-experiment files, in order
+    :param partitions: list of (exp_id, path of the partition)
+    '''
+    if format == "tsv":
+        with open(path,"wb") as tsv:
+            write_tsv(tsv,[get_result_columns(variables)])
+            for _,partition in partitions:
+                with open(partition,"rb") as rows:
+                    shutil.copyfileobj(rows,tsv)
+    elif format == "hdf5":
+        with h5py.File(path,"w") as hdf5:
+            for exp_id,partition in partitions:
+                with h5py.File(partition,"r") as source:
+                    source.copy(source[exp_id],hdf5,name=exp_id)
+    else:
+        with zipfile.ZipFile(path,"w",zipfile.ZIP_STORED,allowZip64=True) as archive:
+            for exp_id,partition in partitions:
+                archive.write(partition,"%s.%s" %(exp_id,format))
+
+
+def write_export_parallel(battery,results,exp_ids,path,format,variables,processes,progress=None):
+    '''write_export_parallel writes each experiment of results to its own file in a
+    pool of processes, each reading its experiment from the database, and merges them
+    (concatenated TSV, HDF5 groups, or a zip of parquet/feather files)
+    :param variables: the TSV columns, see get_export_variables
+    :param progress: an optional ExportProgress, reported as each experiment is written
+    '''
+    folder = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    partitions = [(exp_id,os.path.join(folder,"%s.part" %i)) for i,exp_id in enumerate(exp_ids)]
+    job_id = None if progress == None else progress.job_id
+    tasks = [(battery.id,exp_id,results.filter(experiment_id=exp_id).query,partition,format,variables,job_id)
+             for exp_id,partition in partitions]
+    try:
+        # The pool processes must open their own connections, not share ours
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(processes)
+        try:
+            for exp_id,count in pool.imap_unordered(write_partition,tasks):
+                if progress != None:
+                    progress.count += count
+                    progress.report(progress.count)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        merge_partitions(partitions,path,format,variables)
+    finally:
+        shutil.rmtree(folder,ignore_errors=True)
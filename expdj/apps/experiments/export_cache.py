@@ -0,0 +1,372 @@
+'''
+export_cache.py: materialized TSV exports of battery results
+
+The TSV export of a battery, or of one experiment of a battery, is written
+once under EXPORT_CACHE_ROOT and then brought up to date on each request,
+appending only the results completed since. A state file next to each TSV
+records its columns, its size, a build id that changes each time the export
+is rebuilt, and a high-water mark: the latest finishtime exported. Results are
+not committed in the order of their finishtime, so the ids of the results
+exported with a finishtime within EXPORT_CACHE_LATE_SECONDS of the mark are
+kept too, and each update appends the results finished since the mark less
+that window that are not among them. The export is rebuilt (into a temporary
+file renamed over the old one) when the columns of the experiment schemas
+change, when the battery or experiment fields copied into every row change,
+or when results without a finishtime (eg imported) are added.
+
+    battery_<id>/all.tsv          all experiments of the battery
+    battery_<id>/<exp_id>.tsv     one experiment
+
+The data files of the results explorer (the Shiny app of expfactory-explorer)
+are cleaned copies of the experiment exports, see update_explorer_feed.
+
+Updates hold an exclusive lock (fcntl.flock) on a lock file per export, and
+a response only reads the bytes written when the lock was released, so a
+concurrent append is never served half written. Deleting a result, battery
+or experiment template, or saving the taskdata of a completed result, removes
+the affected exports (see turk/models.py).
+'''
+
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+
+from expdj.apps.experiments.export import (
+    get_export_results, get_export_rows, get_export_variables, write_tsv
+)
+from expdj.apps.experiments.utils import clean_results_df, get_result_columns
+from expdj.apps.turk import codec
+from expdj.settings import EXPLORER_DATA_ROOT, EXPORT_CACHE_ROOT, EXPORT_CACHE_LATE_SECONDS
+
+import datetime
+import fcntl
+import glob
+import hashlib
+import os
+import pandas
+import shutil
+import StringIO
+import tempfile
+import uuid
+
+
+def get_cache_paths(battery_id,exp_id=None):
+    '''get_cache_paths returns the folder, TSV, state and lock file of an export
+    :param exp_id: ExperimentTemplate.exp_id, None for all experiments of the battery
+    '''
+    folder = os.path.join(EXPORT_CACHE_ROOT,"battery_%s" %(battery_id))
+    name = "all" if exp_id == None else exp_id
+    return (folder,
+            os.path.join(folder,"%s.tsv" %(name)),
+            os.path.join(folder,"%s.json" %(name)),
+            os.path.join(folder,"%s.lock" %(name)))
+
+
+def get_export_signature(battery):
+    '''get_export_signature returns a hash of the battery and experiment fields
+    copied into every row (see utils.get_result_info), a change rebuilds the export
+    '''
+    values = [battery.name,battery.owner.username,battery.owner.email]
+    experiments = battery.experiments.select_related("template").order_by("template__exp_id")
+    for experiment in experiments:
+        template = experiment.template
+        values += [template.exp_id,experiment.include_bonus,experiment.include_catch,
+                   template.name,template.reference,template.cognitive_atlas_task_id]
+    return hashlib.sha1(codec.dumps(values)).hexdigest()
+
+
+# Exports whose state has another version are rebuilt
+EXPORT_STATE_VERSION = 3
+
+
+def read_state(state_path):
+    with open(state_path,"rb") as state_file:
+        return codec.loads(state_file.read(),ordered=False)
+
+
+def write_state(state_path,state):
+    handle,tmp_path = tempfile.mkstemp(dir=os.path.dirname(state_path),suffix=".json")
+    with os.fdopen(handle,"wb") as state_file:
+        state_file.write(codec.dumps(state))
+    os.rename(tmp_path,state_path)
+
+
+class ExportedResults(object):
+    '''ExportedResults records the id and finishtime of the results written by
+    get_export_rows, passed as its progress, and gives the state of the export
+    '''
+    def __init__(self,state=None):
+        state = state or {}
+        self.mark = parse_datetime(state["mark"]) if state.get("mark") else None
+        self.recent = dict((x[0],parse_datetime(x[1])) for x in state.get("recent",[]))
+        self.undated = state.get("undated",0)
+
+    def track(self,results):
+        for result in results:
+            if result.finishtime == None:
+                self.undated += 1
+            else:
+                self.recent[result.id] = result.finishtime
+                if self.mark == None or result.finishtime > self.mark:
+                    self.mark = result.finishtime
+            yield result
+
+    def get_since(self):
+        '''get_since returns the finishtime from which results may not be exported yet'''
+        if self.mark == None:
+            return None
+        return self.mark - datetime.timedelta(seconds=EXPORT_CACHE_LATE_SECONDS)
+
+    def get_state(self):
+        since = self.get_since()
+        recent = [(x,y) for x,y in self.recent.items() if y >= since]
+        return {"mark":None if self.mark == None else self.mark.isoformat(),
+                "recent":sorted([[x,y.isoformat()] for x,y in recent]),
+                "undated":self.undated}
+
+
+def rebuild_export(battery,results,tsv_path,signature,variables):
+    '''rebuild_export writes the export of all results completed so far, and returns its state'''
+    exported = ExportedResults()
+    handle,tmp_path = tempfile.mkstemp(dir=os.path.dirname(tsv_path),suffix=".tsv")
+    try:
+        with os.fdopen(handle,"wb") as tsv:
+            write_tsv(tsv,get_export_rows(battery,results,variables,progress=exported))
+        os.rename(tmp_path,tsv_path)
+    except:
+        os.remove(tmp_path)
+        raise
+    state = {"version":EXPORT_STATE_VERSION,
+             "build":uuid.uuid4().hex,
+             "columns":variables,
+             "signature":signature,
+             "size":os.path.getsize(tsv_path)}
+    state.update(exported.get_state())
+    return state
+
+
+def append_export(battery,results,tsv_path,state,variables):
+    '''append_export appends the completed results that are not in the export yet,
+    and returns the new state, or None when the export must be rebuilt
+    '''
+    if variables != state["columns"]:
+        return None
+    exported = ExportedResults(state)
+    # results without a finishtime are not found by the mark
+    if results.filter(finishtime__isnull=True).count() != exported.undated:
+        return None
+    since = exported.get_since()
+    if since == None:
+        new_results = results.filter(finishtime__isnull=False)
+    else:
+        new_results = results.filter(finishtime__gte=since).exclude(id__in=exported.recent.keys())
+    if not new_results.exists():
+        return state
+    with open(tsv_path,"r+b") as tsv:
+        # drops the rows of an append that failed before its state was written
+        tsv.truncate(state["size"])
+        tsv.seek(state["size"])
+        write_tsv(tsv,get_export_rows(battery,new_results,state["columns"],
+                                      header=False,progress=exported))
+        size = tsv.tell()
+    return dict(state,size=size,**exported.get_state())
+
+
+def update_export(battery,exp_id=None):
+    '''update_export brings the export of a battery up to date, and returns it open
+    for reading with its state (state["size"] is the number of bytes to read)
+    :param exp_id: ExperimentTemplate.exp_id, None for all experiments of the battery
+    '''
+    folder,tsv_path,state_path,lock_path = get_cache_paths(battery.id,exp_id)
+    if not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder):
+                raise
+    experiment_tags = None if exp_id == None else [exp_id]
+    results = get_export_results(battery,experiment_tags)
+    signature = get_export_signature(battery)
+    variables = get_export_variables(battery,experiment_tags)
+    with open(lock_path,"a") as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        try:
+            state = None
+            if os.path.exists(tsv_path) and os.path.exists(state_path):
+                state = read_state(state_path)
+                if (state.get("version"),state.get("signature")) != (EXPORT_STATE_VERSION,signature):
+                    state = None
+                else:
+                    state = append_export(battery,results,tsv_path,state,variables)
+            if state == None:
+                state = rebuild_export(battery,results,tsv_path,signature,variables)
+            write_state(state_path,state)
+            export = open(tsv_path,"rb")
+        finally:
+            fcntl.flock(lock,fcntl.LOCK_UN)
+    return export,state
+
+
+def read_export(export,size,chunk_size=64*1024):
+    '''read_export yields the first size bytes of an open export, then closes it'''
+    try:
+        while size > 0:
+            data = export.read(min(chunk_size,size))
+            if not data:
+                break
+            size -= len(data)
+            yield data
+    finally:
+        export.close()
+
+
+def cached_export_tsv(battery,output_name,exp_id=None):
+    '''cached_export_tsv returns a response serving the up to date export of a battery
+    :param output_name: the file name of the download, without extension
+    :param exp_id: ExperimentTemplate.exp_id, None for all experiments of the battery
+    '''
+    export,state = update_export(battery,exp_id)
+    response = StreamingHttpResponse(read_export(export,state["size"]),content_type='text/csv')
+    response['Content-Length'] = state["size"]
+    response['Content-Disposition'] = 'attachment; filename="%s.tsv"' %(output_name)
+    return response
+
+
+# EXPLORER FEED #########################################################
+
+def get_feed_paths(exp_id):
+    '''get_feed_paths returns the explorer data file of an experiment, with its
+    state and lock file under EXPORT_CACHE_ROOT
+    '''
+    folder = os.path.join(EXPORT_CACHE_ROOT,"explorer")
+    return (folder,
+            os.path.join(EXPLORER_DATA_ROOT,"%s_data.tsv" %(exp_id)),
+            os.path.join(folder,"%s.json" %(exp_id)),
+            os.path.join(folder,"%s.lock" %(exp_id)))
+
+
+def read_feed_frame(export,start,end,columns=None):
+    '''read_feed_frame reads bytes start to end of an open export as a cleaned
+    DataFrame, values are kept as the text of the export
+    :param columns: the export columns when start is past the header
+    '''
+    export.seek(start)
+    data = StringIO.StringIO(export.read(end - start))
+    if columns == None:
+        df = pandas.read_csv(data,sep="\t",encoding="utf-8",dtype=str,keep_default_na=False)
+    else:
+        df = pandas.read_csv(data,sep="\t",encoding="utf-8",dtype=str,keep_default_na=False,
+                             header=None,names=columns)
+    return clean_results_df(df)
+
+
+def write_feed(feed_path,df,rows=0):
+    '''write_feed writes a cleaned DataFrame to a temporary file renamed over
+    the explorer data file, so the explorer never reads a partial file
+    :param rows: append df after this many rows of the current file
+    '''
+    folder = os.path.dirname(feed_path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    handle,tmp_path = tempfile.mkstemp(dir=folder,suffix=".tsv")
+    try:
+        with os.fdopen(handle,"wb") as feed:
+            if rows > 0:
+                with open(feed_path,"rb") as current:
+                    shutil.copyfileobj(current,feed)
+            df.index = range(rows,rows + df.shape[0])
+            df.to_csv(feed,sep="\t",encoding="utf-8",header=(rows == 0))
+        os.chmod(tmp_path,0o644)
+        os.rename(tmp_path,feed_path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def update_explorer_feed(battery,experiment):
+    '''update_explorer_feed brings the explorer data file of an experiment up to
+    date with the completed results of a battery, and returns its number of rows.
+    Only the rows exported since the last update are read and appended, and
+    nothing is written when there are none.
+    :param experiment: an ExperimentTemplate
+    '''
+    folder,feed_path,state_path,lock_path = get_feed_paths(experiment.exp_id)
+    if not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder):
+                raise
+    export,export_state = update_export(battery,experiment.exp_id)
+    try:
+        with open(lock_path,"a") as lock:
+            fcntl.flock(lock,fcntl.LOCK_EX)
+            try:
+                state = None
+                if os.path.exists(feed_path) and os.path.exists(state_path):
+                    state = read_state(state_path)
+                    # the data file of another battery, or of an export since rebuilt
+                    if (state["battery"],state["build"]) != (battery.id,export_state.get("build")):
+                        state = None
+                if state != None and state["size"] == export_state["size"]:
+                    return state["rows"]
+                if state == None:
+                    df = read_feed_frame(export,0,export_state["size"])
+                    rows = 0
+                    if df.shape[0] == 0:
+                        return 0
+                else:
+                    columns = get_result_columns(export_state["columns"])
+                    df = read_feed_frame(export,state["size"],export_state["size"],columns)
+                    rows = state["rows"]
+                write_feed(feed_path,df,rows)
+                write_state(state_path,{"battery":battery.id,
+                                        "build":export_state.get("build"),
+                                        "rows":rows + df.shape[0],
+                                        "size":export_state["size"]})
+                return rows + df.shape[0]
+            finally:
+                fcntl.flock(lock,fcntl.LOCK_UN)
+    finally:
+        export.close()
+
+
+# INVALIDATION ##########################################################
+
+def remove_export(tsv_path):
+    '''remove_export removes an export and its state, waiting for any update in progress'''
+    base = os.path.splitext(tsv_path)[0]
+    if not os.path.exists("%s.lock" %(base)):
+        return
+    with open("%s.lock" %(base),"a") as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        try:
+            for path in [tsv_path,"%s.json" %(base)]:
+                if os.path.exists(path):
+                    os.remove(path)
+        finally:
+            fcntl.flock(lock,fcntl.LOCK_UN)
+
+
+def invalidate_result(battery_id,exp_id):
+    '''invalidate_result removes the exports that may include a result'''
+    for name in [None,exp_id]:
+        remove_export(get_cache_paths(battery_id,name)[1])
+
+
+def invalidate_battery(battery_id):
+    '''invalidate_battery removes all exports of a battery'''
+    folder = get_cache_paths(battery_id)[0]
+    for tsv_path in glob.glob(os.path.join(folder,"*.tsv")):
+        remove_export(tsv_path)
+
+
+def remove_battery_exports(battery_id):
+    '''remove_battery_exports removes the export folder of a deleted battery'''
+    invalidate_battery(battery_id)
+    shutil.rmtree(get_cache_paths(battery_id)[0],ignore_errors=True)
+
+
+def invalidate_experiment(exp_id):
+    '''invalidate_experiment removes the exports of an experiment template in all batteries'''
+    for tsv_path in glob.glob(os.path.join(EXPORT_CACHE_ROOT,"battery_*","%s.tsv" %(exp_id))):
+        remove_export(tsv_path)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from expdj.apps.experiments.export import (
+    ExportProgress, get_export_formats, get_export_results, write_export
+)
+from expdj.apps.experiments.models import Battery
+from expdj.settings import EXPORT_PROCESSES
+
+
+class Command(BaseCommand):
+    help = '''Export the completed results of a battery to a file, with one process
+    per experiment for large batteries (see experiments/export.py)'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('battery_id', type=int,
+                            help="id of the battery to export")
+        parser.add_argument('output',
+                            help="path of the export file")
+        parser.add_argument('--format', default="tsv",
+                            help="tsv, parquet, feather or hdf5")
+        parser.add_argument('--experiments', nargs='*',
+                            help="exp_id of the experiments to export, default all")
+        parser.add_argument('--processes', type=int, default=EXPORT_PROCESSES,
+                            help="size of the process pool, 1 to export serially")
+
+    def handle(self, *args, **options):
+        try:
+            battery = Battery.objects.get(id=options["battery_id"])
+        except Battery.DoesNotExist:
+            raise CommandError("Battery %s does not exist" %options["battery_id"])
+        if options["format"] not in get_export_formats():
+            raise CommandError("Export format %s is not available" %options["format"])
+
+        experiment_tags = options["experiments"] or None
+        results = get_export_results(battery,experiment_tags)
+        total = results.count()
+        progress = ExportProgress(lambda count: self.stdout.write("Exported %s of %s results" %(count,total)))
+        write_export(battery,results,options["output"],options["format"],progress,
+                     experiment_tags=experiment_tags,processes=options["processes"])
+        self.stdout.write("Exported %s results to %s" %(total,options["output"]))
@@ -1,5 +1,6 @@
 import collections
 import operator
+import os
 
 from guardian.shortcuts import assign_perm, get_users_with_perms, remove_perm
 from jsonfield import JSONField
@@ -11,7 +12,10 @@ from django.core.urlresolvers import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.db.models import Q, DO_NOTHING
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_delete
+from django.utils import timezone
+
+from expdj.settings import EXPORT_JOB_ROOT
 
 #  trying to import Result object directly from models was giving an import 
 #  error here, even though the import matched views.py exactly.
@@ -225,3 +229,56 @@ def contributors_changed(sender, instance, action, **kwargs):
             remove_perm('edit_battery', contributor, instance)
 
 m2m_changed.connect(contributors_changed, sender=Battery.contributors.through)
+
+
+class ExportJob(models.Model):
+    '''An export of the completed results of a battery, written to a file under
+    EXPORT_JOB_ROOT by a Celery task (see experiments/tasks.py). Requests for the
+    same snapshot of the results share a job.
+    '''
+    STATUS_CHOICES = (
+        ("PENDING", "Pending"),
+        ("RUNNING", "Running"),
+        ("SUCCESS", "Finished"),
+        ("FAILURE", "Failed"),
+    )
+    battery = models.ForeignKey(Battery,related_name="export_jobs",help_text="Battery of the exported results")
+    exp_id = models.CharField(max_length=200,null=True,blank=True,help_text="exp_id of the exported experiment, all experiments of the battery when empty")
+    format = models.CharField(max_length=32,default="tsv",help_text="one of experiments.export.EXPORT_FORMATS")
+    filters = JSONField(default=dict,help_text="query parameters of the result filters, see turk.utils.get_result_filters")
+    output_name = models.CharField(max_length=200,help_text="file name of the download, without extension")
+    snapshot = models.CharField(max_length=40,db_index=True,help_text="hash of the export and of the completed results when requested")
+    status = models.CharField(max_length=32,choices=STATUS_CHOICES,default="PENDING")
+    processed = models.PositiveIntegerField(default=0,help_text="results written so far")
+    total = models.PositiveIntegerField(default=0,help_text="results to write")
+    file_name = models.CharField(max_length=500,null=True,blank=True,help_text="name of the written file under EXPORT_JOB_ROOT")
+    error = models.TextField(null=True,blank=True)
+    requested_by = models.ForeignKey(User,null=True,blank=True,on_delete=models.SET_NULL)
+    add_date = models.DateTimeField('date requested', auto_now_add=True)
+    update_date = models.DateTimeField('date of the last progress', default=timezone.now)
+    finish_date = models.DateTimeField('date finished', null=True, blank=True)
+
+    def get_progress(self):
+        '''get_progress returns the percentage of results written'''
+        if self.status == "SUCCESS":
+            return 100
+        if self.total == 0:
+            return 0
+        return int(100 * self.processed / self.total)
+
+    def __unicode__(self):
+        return "%s: %s %s" %(self.battery,self.format,self.status)
+
+    class Meta:
+        ordering = ["-add_date"]
+        app_label = 'experiments'
+        verbose_name = "Export job"
+
+
+def remove_export_job_file(sender,instance,**kwargs):
+    if instance.file_name:
+        path = os.path.join(EXPORT_JOB_ROOT,instance.file_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+post_delete.connect(remove_export_job_file,sender=ExportJob)
@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+
+import datetime
+import hashlib
+import os
+
+from celery import shared_task
+
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+
+from expdj.apps.experiments.export import (
+    EXPORT_FORMATS, ExportProgress, get_export_results, write_export
+)
+from expdj.apps.experiments.export_cache import get_export_signature
+from expdj.apps.experiments.models import Battery, ExportJob
+from expdj.apps.turk import codec
+from expdj.apps.turk.utils import get_result_filters
+from expdj.settings import EXPORT_JOB_ROOT, EXPORT_JOB_EXPIRE_HOURS, EXPORT_JOB_STALL_MINUTES
+
+
+def get_job_filters(params):
+    '''get_job_filters returns the result filters of the query parameters stored
+    in ExportJob.filters, see turk.utils.get_result_filters
+    '''
+    return get_result_filters(MultiValueDict(params or {}))
+
+
+def get_export_snapshot(battery,exp_id=None,format="tsv",filters=None):
+    '''get_export_snapshot returns a hash of an export and of the completed results
+    it includes, requests with the same snapshot would produce the same file
+    :param exp_id: ExperimentTemplate.exp_id, None for all experiments of the battery
+    :param filters: query parameters of the result filters, as in ExportJob.filters
+    '''
+    results = get_export_results(battery,None if exp_id == None else [exp_id],
+                                 get_job_filters(filters))
+    stats = results.aggregate(count=Count("id"),last_id=Max("id"),finishtime=Max("finishtime"))
+    if stats["finishtime"] != None:
+        stats["finishtime"] = stats["finishtime"].isoformat()
+    values = [battery.id,exp_id,format,filters or {},stats["count"],stats["last_id"],stats["finishtime"],
+              get_export_signature(battery)]
+    return hashlib.sha1(codec.dumps(values)).hexdigest()
+
+
+def submit_export_job(battery,output_name,exp_id=None,format="tsv",user=None,filters=None):
+    '''submit_export_job returns the export job of the current snapshot of the results,
+    starting one when there is none (or it failed, stalled or expired)
+    :param output_name: the file name of the download, without extension
+    :param exp_id: ExperimentTemplate.exp_id, None for all experiments of the battery
+    :param format: one of experiments.export.get_export_formats
+    :param filters: query parameters of the result filters, {name: [values]}
+    '''
+    snapshot = get_export_snapshot(battery,exp_id,format,filters)
+    expired = timezone.now() - datetime.timedelta(hours=EXPORT_JOB_EXPIRE_HOURS)
+    created = False
+    with transaction.atomic():
+        # Concurrent requests for the battery wait here, and find the job of the first
+        Battery.objects.select_for_update().get(id=battery.id)
+        fail_stalled_export_jobs(battery)
+        job = ExportJob.objects.filter(battery=battery,
+                                       snapshot=snapshot,
+                                       add_date__gte=expired).exclude(status="FAILURE").first()
+        if job == None:
+            job = ExportJob.objects.create(battery=battery,
+                                           exp_id=exp_id,
+                                           format=format,
+                                           filters=filters or {},
+                                           output_name=output_name,
+                                           snapshot=snapshot,
+                                           requested_by=user)
+            created = True
+    if created:
+        run_export_job.apply_async([job.id])
+    return job
+
+
+def fail_stalled_export_jobs(battery):
+    '''fail_stalled_export_jobs marks the unfinished export jobs of a battery without
+    progress for EXPORT_JOB_STALL_MINUTES as failed, they are no longer reused
+    '''
+    stalled = timezone.now() - datetime.timedelta(minutes=EXPORT_JOB_STALL_MINUTES)
+    jobs = ExportJob.objects.filter(battery=battery,status__in=["PENDING","RUNNING"],update_date__lt=stalled)
+    jobs.update(status="FAILURE",error="The export stopped without progress",finish_date=timezone.now())
+
+
+@shared_task
+def run_export_job(job_id):
+    '''run_export_job writes the file of an export job, recording the results processed
+    :param job_id: the id of an ExportJob
+    '''
+    # A job is only run once, even when the task is delivered again
+    if ExportJob.objects.filter(id=job_id,status="PENDING").update(status="RUNNING",update_date=timezone.now()) == 0:
+        return
+    job = ExportJob.objects.select_related("battery").get(id=job_id)
+    jobs = ExportJob.objects.filter(id=job_id)
+    experiment_tags = None if job.exp_id == None else [job.exp_id]
+    filters = get_job_filters(job.filters)
+    results = get_export_results(job.battery,experiment_tags,filters)
+    total = results.count()
+    jobs.update(total=total)
+
+    if not os.path.exists(EXPORT_JOB_ROOT):
+        try:
+            os.makedirs(EXPORT_JOB_ROOT)
+        except OSError:
+            if not os.path.isdir(EXPORT_JOB_ROOT):
+                raise
+
+    extension = EXPORT_FORMATS[job.format][0]
+    file_name = "%s_%s.%s" %(job.id,job.output_name,extension)
+    path = os.path.join(EXPORT_JOB_ROOT,file_name)
+    # each report shows the job is alive, see fail_stalled_export_jobs
+    running = jobs.filter(status="RUNNING")
+    progress = ExportProgress(lambda count: running.update(processed=count,update_date=timezone.now()),
+                              job_id=job.id)
+    try:
+        write_export(job.battery,results,path,job.format,progress,experiment_tags,
+                     filters=filters)
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path)
+        jobs.update(status="FAILURE",error=str(e),finish_date=timezone.now())
+        raise
+    finished = running.update(status="SUCCESS",
+                              processed=progress.count,
+                              total=max(progress.count,total),
+                              file_name=file_name,
+                              finish_date=timezone.now())
+    # a job taken for stalled has been replaced, its file is not served
+    if finished == 0:
+        os.remove(path)
+
+
+@shared_task
+def remove_expired_export_jobs():
+    '''remove_expired_export_jobs deletes export jobs (and their files) older than
+    EXPORT_JOB_EXPIRE_HOURS, running jobs are given twice as long to finish
+    '''
+    expire = datetime.timedelta(hours=EXPORT_JOB_EXPIRE_HOURS)
+    expired = ExportJob.objects.filter(add_date__lt=timezone.now() - expire)
+    expired = expired.exclude(status="RUNNING",add_date__gte=timezone.now() - 2*expire)
+    for job in expired:
+        job.delete()
@@ -0,0 +1,791 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the result processing paths"""
+
+from StringIO import StringIO
+from collections import namedtuple
+
+import datetime
+import h5py
+import json
+import numpy
+import os
+import pandas
+import redis
+import shutil
+import socket
+import tempfile
+import zipfile
+
+from boto.mturk.connection import MTurkRequestError
+from celery import current_app
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from expdj.apps.experiments import export, export_cache
+from expdj.apps.experiments import tasks as experiment_tasks
+from expdj.apps.experiments.export import (
+    ExportProgress, get_export_formats, get_export_results, heartbeat_export_job,
+    write_export
+)
+from expdj.apps.experiments.models import (
+    Battery, CreditCondition, Experiment, ExperimentTemplate, ExperimentVariable,
+    ExportJob
+)
+from expdj.apps.experiments.tasks import run_export_job, submit_export_job
+from expdj.apps.experiments.utils import (
+    make_experiment_lookup, make_results_df, result_rows
+)
+from expdj.apps.turk import buffer, codec
+from expdj.apps.turk.credit import CompiledCondition
+from expdj.apps.turk.models import (
+    Assignment, Blacklist, Bonus, BonusPayment, HIT, Result, Worker,
+    WorkerBatteryProgress, get_battery_progress, get_experiment_schema,
+    get_schema_variables, merge_experiment_schema, record_completed_experiment
+)
+from expdj.apps.turk.payments import claim_payment, send_payment
+from expdj.apps.turk.storage import decode_taskdata, encode_taskdata
+from expdj.apps.turk.tasks import (
+    check_battery_dependencies, evaluate_result_credit, flush_result_buffer,
+    get_mturk_assignments, get_sweep_hits, get_unique_experiments,
+    queue_bonus_payment, reconcile_hit_credit
+)
+from expdj.apps.turk.utils import get_result_filters
+from expdj.apps.turk.variables import (
+    get_result_variables, get_variable_index, lookup_variable
+)
+from expdj.settings import EXPORT_JOB_STALL_MINUTES
+
+
+TASKDATA = [{"trial_index":0,"rt":512,"trialdata":{"correct":True,"exp_stage":"test"}},
+            {"trial_index":1,"rt":430,"trialdata":{"correct":False,"exp_stage":"test"}}]
+
+
+class ResultFixtures(object):
+    '''ResultFixtures creates a battery of three experiments, with the completed
+    results of four workers
+    '''
+    def setUp(self):
+        self.owner = User.objects.create_superuser("owner","owner@expfactory.org","password")
+        self.templates = []
+        for number in range(3):
+            template = ExperimentTemplate.objects.create(exp_id="task_%s" %number,
+                                                         name="Task %s" %number,
+                                                         time=5,
+                                                         reference="",
+                                                         template="jspsych")
+            self.templates.append(template)
+        self.battery = self.make_battery("battery",self.templates)
+        self.add_results(4)
+
+    def make_battery(self,name,templates):
+        battery = Battery.objects.create(name=name,
+                                         credentials="credentials",
+                                         owner=self.owner,
+                                         maximum_time=30,
+                                         number_of_experiments=len(templates))
+        for template in templates:
+            battery.experiments.add(Experiment.objects.create(template=template))
+        return battery
+
+    def add_results(self,count):
+        start = Worker.objects.count()
+        for number in range(start,start + count):
+            worker = Worker.objects.create(id="worker%s" %number)
+            for template in self.templates:
+                Result.objects.create(worker=worker,
+                                      experiment=template,
+                                      battery=self.battery,
+                                      completed=True,
+                                      taskdata=TASKDATA)
+
+    def count_queries(self,func):
+        with CaptureQueriesContext(connection) as context:
+            func()
+        return len(context.captured_queries)
+
+
+class ResultTestCase(ResultFixtures,TestCase):
+    pass
+
+
+
+class ResultQueryTests(ResultTestCase):
+    def test_make_results_df_queries_do_not_grow_with_results(self):
+        battery = Battery.objects.get(id=self.battery.id)
+        make_df = lambda: make_results_df(battery,Result.objects.filter(battery=battery).for_export())
+        before = self.count_queries(make_df)
+        self.add_results(6)
+        battery = Battery.objects.get(id=self.battery.id)
+        self.assertEqual(self.count_queries(make_df),before)
+        self.assertEqual(make_df().shape[0],10 * len(self.templates) * len(TASKDATA))
+
+    def test_get_unique_experiments_is_one_query(self):
+        with self.assertNumQueries(1):
+            exp_ids = get_unique_experiments(Result.objects.filter(battery=self.battery))
+        self.assertEqual(exp_ids,["task_0","task_1","task_2"])
+
+    def test_summaries_do_not_load_related_or_taskdata(self):
+        with self.assertNumQueries(1):
+            for result in Result.objects.filter(battery=self.battery).summaries():
+                result.worker.id,result.experiment.name,result.battery.name
+        result = Result.objects.filter(battery=self.battery).summaries()[0]
+        self.assertIn("taskdata",result.get_deferred_fields())
+
+    def test_check_battery_dependencies_queries(self):
+        required = self.make_battery("required",self.templates[:2])
+        restricted = self.make_battery("restricted",self.templates[2:])
+        self.battery.required_batteries.add(required)
+        self.battery.restricted_batteries.add(restricted)
+        worker = Worker.objects.get(id="worker0")
+        WorkerBatteryProgress.objects.create(worker=worker,battery=required,
+                                             completed_experiments=["task_0","task_1"],
+                                             completed_count=2)
+        WorkerBatteryProgress.objects.create(worker=worker,battery=restricted,
+                                             completed_experiments=[],
+                                             completed_count=0)
+        # worker, required and restricted batteries with their experiments, progress
+        with self.assertNumQueries(6):
+            missing,blocking = check_battery_dependencies(self.battery,worker.id)
+        self.assertEqual(missing,[])
+        self.assertEqual(blocking,[])
+
+    def test_result_api_queries_do_not_grow_with_results(self):
+        self.client.login(username="owner",password="password")
+        get_results = lambda: self.client.get("/api/results/")
+        self.assertEqual(get_results().status_code,200)
+        before = self.count_queries(get_results)
+        self.add_results(6)
+        self.assertEqual(self.count_queries(get_results),before)
+
+    def test_result_filters_are_applied_in_the_query(self):
+        Result.objects.filter(worker_id="worker1",experiment_id="task_0").update(completed=False)
+        filters = get_result_filters(QueryDict("experiment=task_0,task_1&worker=worker0&worker=worker1"))
+        results = get_export_results(self.battery,filters=filters)
+        self.assertEqual(sorted(results.values_list("worker_id","experiment_id")),
+                         [("worker0","task_0"),("worker0","task_1"),("worker1","task_1")])
+        filters = get_result_filters(QueryDict("completed=false"))
+        self.assertEqual(get_export_results(self.battery,filters=filters).count(),1)
+        self.assertRaises(ValueError,get_result_filters,QueryDict("finished_after=yesterday"))
+
+
+class TaskdataStorageTests(ResultTestCase):
+    def test_encoded_taskdata_round_trips(self):
+        blob = encode_taskdata(TASKDATA,compression="zlib",serializer="json")
+        self.assertTrue(blob.startswith(b"zlib:json:"))
+        self.assertEqual(decode_taskdata(blob),TASKDATA)
+
+    def test_compress_taskdata_converts_every_result(self):
+        result_ids = list(Result.objects.values_list("id",flat=True))
+        call_command("compress_taskdata",compression="zlib",batch_size=5,stdout=StringIO())
+        self.assertFalse(Result.objects.filter(taskdata_compressed__isnull=True).exists())
+        for result in Result.objects.filter(id__in=result_ids):
+            self.assertEqual(result.taskdata,None)
+            self.assertEqual(result.get_taskdata(),TASKDATA)
+
+
+class ResultBufferTests(ResultTestCase):
+    def setUp(self):
+        super(ResultBufferTests,self).setUp()
+        try:
+            buffer.get_client().delete(buffer.BUFFER_KEY)
+        except redis.ConnectionError:
+            self.skipTest("the result buffer (RESULT_BUFFER_URL) is not reachable")
+        Result.objects.filter(worker_id="worker0").update(completed=False)
+        self.result = Result.objects.filter(worker_id="worker0").first()
+
+    def tearDown(self):
+        buffer.get_client().delete(buffer.BUFFER_KEY)
+
+    def buffer_trials(self,trials,sequence):
+        self.result.set_taskdata(trials)
+        self.result.current_trial = len(trials) - 1
+        self.result.sync_sequence = sequence
+        buffer.buffer_result(self.result)
+
+    def test_flush_saves_and_removes_buffered_states(self):
+        self.buffer_trials(TASKDATA[:1],1)
+        flush_result_buffer()
+        result = Result.objects.get(id=self.result.id)
+        self.assertEqual(result.get_taskdata(),TASKDATA[:1])
+        self.assertEqual(result.sync_sequence,1)
+        self.assertEqual(buffer.read_buffered_results(),{})
+
+    def test_state_buffered_during_a_flush_is_kept(self):
+        self.buffer_trials(TASKDATA[:1],1)
+        flushing = buffer.read_buffered_results()
+        self.buffer_trials(TASKDATA,2)
+        self.assertEqual(buffer.remove_flushed_results(flushing),0)
+        result = Result.objects.get(id=self.result.id)
+        buffer.load_buffered_result(result)
+        self.assertEqual(result.get_taskdata(),TASKDATA)
+        self.assertEqual(result.sync_sequence,2)
+
+    def test_flush_does_not_overwrite_completed_results(self):
+        self.buffer_trials(TASKDATA[:1],1)
+        Result.objects.filter(id=self.result.id).update(completed=True)
+        flush_result_buffer()
+        self.assertEqual(Result.objects.get(id=self.result.id).get_taskdata(),TASKDATA)
+
+
+class CodecTests(TestCase):
+    def test_floats_round_trip(self):
+        values = [0.1 + 0.2,1 / 3.0,512.0000000001,1e-300,-2.5e17,123456789.123456789]
+        self.assertEqual(codec.loads(codec.dumps(values),ordered=True),values)
+        self.assertEqual(codec.loads(codec.dumps(values),ordered=False),values)
+        trials = [{"rt":value,"trialdata":{"rt":value}} for value in values]
+        self.assertEqual(codec.loads(codec.dumps(trials),ordered=False),trials)
+
+
+class BatteryProgressTests(ResultTestCase):
+    def test_reading_progress_does_not_create_it(self):
+        worker = Worker.objects.create(id="new_worker")
+        progress = get_battery_progress(worker,self.battery)
+        self.assertEqual(progress.completed_count,0)
+        self.assertFalse(progress.is_finished())
+        self.assertFalse(WorkerBatteryProgress.objects.filter(worker=worker).exists())
+
+    def test_recorded_experiments_finish_the_battery(self):
+        worker = Worker.objects.create(id="new_worker")
+        for number,template in enumerate(self.templates):
+            result = Result.objects.create(worker=worker,experiment=template,
+                                           battery=self.battery,completed=True)
+            progress = record_completed_experiment(result)
+            self.assertEqual(progress.completed_count,number + 1)
+            self.assertEqual(progress.is_finished(),number == len(self.templates) - 1)
+        # a retried completion is not counted twice
+        progress = record_completed_experiment(result)
+        self.assertEqual(get_battery_progress(worker,self.battery).completed_count,len(self.templates))
+
+    def test_battery_with_a_new_experiment_is_not_finished(self):
+        worker = Worker.objects.create(id="new_worker")
+        for template in self.templates:
+            result = Result.objects.create(worker=worker,experiment=template,
+                                           battery=self.battery,completed=True)
+            progress = record_completed_experiment(result)
+        self.assertTrue(progress.is_finished())
+        # a completed experiment is replaced by one the worker has not done
+        self.battery.experiments.remove(self.battery.experiments.get(template=self.templates[0]))
+        template = ExperimentTemplate.objects.create(exp_id="task_new",name="Task new",time=5,
+                                                     reference="",template="jspsych")
+        self.battery.experiments.add(Experiment.objects.create(template=template))
+        self.assertEqual(progress.completed_count,self.battery.experiments.count())
+        self.assertFalse(get_battery_progress(worker,self.battery).is_finished())
+
+
+class SyncTests(ResultTestCase):
+    def setUp(self):
+        super(SyncTests,self).setUp()
+        # the tasks fired by a FINISHED sync run in the test
+        self.always_eager = current_app.conf.CELERY_ALWAYS_EAGER
+        current_app.conf.CELERY_ALWAYS_EAGER = True
+        self.result = Result.objects.create(worker=Worker.objects.create(id="syncing"),
+                                            experiment=self.templates[0],
+                                            battery=self.battery)
+
+    def tearDown(self):
+        current_app.conf.CELERY_ALWAYS_EAGER = self.always_eager
+
+    def sync(self,trials,first_trial=None,sequence=None,session="page1",djstatus="NOTFINISHED"):
+        taskdata = {"data":trials,"currenttrial":len(trials)}
+        if first_trial != None:
+            taskdata["first_trial"] = first_trial
+        headers = dict()
+        if sequence != None:
+            headers = {"HTTP_X_SYNC_SEQUENCE":str(sequence),"HTTP_X_SYNC_SESSION":session}
+        response = self.client.post("/local/%s/" %self.result.id,
+                                    json.dumps({"taskdata":taskdata,"djstatus":djstatus}),
+                                    content_type="application/json",**headers)
+        return response.status_code,json.loads(response.content)
+
+    def get_trials(self):
+        return Result.objects.get(id=self.result.id).get_taskdata()
+
+    def test_delta_syncs_append_trials(self):
+        status,data = self.sync(TASKDATA[:1],first_trial=0,sequence=1)
+        self.assertEqual((status,data["trial_count"]),(200,1))
+        status,data = self.sync(TASKDATA[1:],first_trial=1,sequence=2)
+        self.assertEqual((status,data["trial_count"]),(200,2))
+        self.assertEqual(self.get_trials(),TASKDATA)
+        # a delta leaving a gap is answered with the stored trial count
+        status,data = self.sync(TASKDATA,first_trial=5,sequence=3)
+        self.assertEqual((status,data["trial_count"]),(409,2))
+        # trials already stored (a retried delta under a new number) are skipped
+        status,data = self.sync(TASKDATA,first_trial=0,sequence=4)
+        self.assertEqual((status,data["trial_count"]),(200,2))
+        self.assertEqual(self.get_trials(),TASKDATA)
+
+    def test_duplicate_and_stale_syncs_are_not_applied(self):
+        self.sync(TASKDATA[:1],sequence=1)
+        self.sync(TASKDATA,sequence=2)
+        self.assertEqual(self.sync(TASKDATA,sequence=2),(200,{"message":"duplicate"}))
+        self.assertEqual(self.sync(TASKDATA[:1],sequence=1),(409,{"message":"stale"}))
+        self.assertEqual(self.get_trials(),TASKDATA)
+        # without a sequence, a repeated payload is a duplicate
+        self.sync(TASKDATA[:1])
+        self.assertEqual(self.sync(TASKDATA[:1]),(200,{"message":"duplicate"}))
+
+    def test_reloaded_page_numbers_its_syncs_again(self):
+        self.sync(TASKDATA,sequence=5,session="page1")
+        status,data = self.sync(TASKDATA[:1],sequence=1,session="page2")
+        self.assertEqual(status,200)
+        self.assertEqual(self.get_trials(),TASKDATA[:1])
+        self.assertEqual(self.sync(TASKDATA[:1],sequence=1,session="page2"),(200,{"message":"duplicate"}))
+
+    def test_retried_finished_sync_gets_the_completion_response(self):
+        completion = {"djstatus":"FINISHED","finished_battery":"NOTFINISHED"}
+        self.assertEqual(self.sync(TASKDATA,sequence=1,djstatus="FINISHED"),(200,completion))
+        result = Result.objects.get(id=self.result.id)
+        self.assertTrue(result.completed)
+        self.assertEqual(self.sync(TASKDATA,sequence=1,djstatus="FINISHED"),(200,completion))
+        self.assertEqual(Result.objects.get(id=self.result.id).finishtime,result.finishtime)
+        progress = WorkerBatteryProgress.objects.get(worker_id="syncing",battery=self.battery)
+        self.assertEqual(progress.completed_experiments,["task_0"])
+
+
+class ExportTests(ResultTestCase):
+    def set_taskdata(self,exp_id,taskdata):
+        result = Result.objects.get(worker_id="worker0",experiment_id=exp_id)
+        result.taskdata = taskdata
+        result.save()
+        return result
+
+    def test_result_rows_skip_malformed_taskdata(self):
+        lookup = make_experiment_lookup(["task_0","task_1"],self.battery)
+        result = self.set_taskdata("task_0",{"question":"answer"})
+        self.assertEqual(list(result_rows(self.battery,result,["rt"],lookup["task_0"])),[])
+        result = self.set_taskdata("task_1",TASKDATA + ["not a trial",None,[1,2]])
+        rows = list(result_rows(self.battery,result,["rt"],lookup["task_1"]))
+        self.assertEqual([row[-1] for row in rows],[512,430])
+
+    def test_results_df_skips_malformed_taskdata(self):
+        self.set_taskdata("task_0",{"question":"answer"})
+        self.set_taskdata("task_1",TASKDATA + ["not a trial"])
+        df = make_results_df(self.battery,Result.objects.filter(battery=self.battery).for_export())
+        self.assertEqual(df.shape[0],(4 * len(self.templates) - 1) * len(TASKDATA))
+        self.assertEqual(sorted(df["result_rt"].unique().tolist()),[430,512])
+
+    def test_completed_result_keys_are_merged_into_the_schema(self):
+        result = Result.objects.get(worker_id="worker0",experiment_id="task_0")
+        trials = TASKDATA + [{"trial_index":2,"new_key":1,"trialdata":{"new_trialdata_key":True}}]
+        # the first schema is built by process_completed_result
+        self.assertEqual(merge_experiment_schema(result,trials),None)
+        get_experiment_schema(self.battery,self.templates[0])
+        self.assertNotIn("new_key",get_schema_variables(self.battery,["task_0"]))
+        merge_experiment_schema(result,trials)
+        variables = get_schema_variables(self.battery,["task_0"])
+        self.assertIn("new_key",variables)
+        self.assertIn("new_trialdata_key",variables)
+
+
+class ExportCacheTests(ResultTestCase):
+    def setUp(self):
+        super(ExportCacheTests,self).setUp()
+        self.cache_root = export_cache.EXPORT_CACHE_ROOT
+        self.explorer_root = export_cache.EXPLORER_DATA_ROOT
+        export_cache.EXPORT_CACHE_ROOT = tempfile.mkdtemp()
+        export_cache.EXPLORER_DATA_ROOT = os.path.join(export_cache.EXPORT_CACHE_ROOT,"explorer_data")
+
+    def tearDown(self):
+        shutil.rmtree(export_cache.EXPORT_CACHE_ROOT)
+        export_cache.EXPORT_CACHE_ROOT = self.cache_root
+        export_cache.EXPLORER_DATA_ROOT = self.explorer_root
+
+    def read_export(self):
+        export,state = export_cache.update_export(self.battery)
+        try:
+            return export.read(state["size"]).splitlines()
+        finally:
+            export.close()
+
+    def test_results_committed_late_are_appended(self):
+        now = timezone.now()
+        Result.objects.filter(battery=self.battery).update(finishtime=now - datetime.timedelta(hours=1))
+        Result.objects.filter(worker_id="worker0").update(finishtime=now)
+        self.assertEqual(len(self.read_export()),1 + 4 * len(self.templates) * len(TASKDATA))
+        # the state keeps the ids of the results near the mark only
+        state = export_cache.read_state(export_cache.get_cache_paths(self.battery.id)[2])
+        self.assertEqual(len(state["recent"]),len(self.templates))
+        # finished before the results already exported, committed after the export
+        self.add_results(1)
+        Result.objects.filter(finishtime__isnull=True).update(finishtime=now - datetime.timedelta(minutes=1))
+        self.assertEqual(len(self.read_export()),1 + 5 * len(self.templates) * len(TASKDATA))
+        self.assertEqual(len(self.read_export()),1 + 5 * len(self.templates) * len(TASKDATA))
+        # results imported without a finishtime rebuild the export
+        self.add_results(1)
+        self.assertEqual(len(self.read_export()),1 + 6 * len(self.templates) * len(TASKDATA))
+
+    def test_saving_a_completed_result_rebuilds_the_export(self):
+        self.assertEqual(len(self.read_export()),1 + 4 * len(self.templates) * len(TASKDATA))
+        result = Result.objects.filter(battery=self.battery).first()
+        result.taskdata = TASKDATA[:1]
+        result.save()
+        self.assertEqual(len(self.read_export()),4 * len(self.templates) * len(TASKDATA))
+
+    def test_explorer_feed_appends_completed_results(self):
+        now = timezone.now()
+        Result.objects.filter(battery=self.battery).update(finishtime=now)
+        self.assertEqual(export_cache.update_explorer_feed(self.battery,self.templates[0]),4 * len(TASKDATA))
+        _,feed_path,state_path,_ = export_cache.get_feed_paths("task_0")
+        build = export_cache.read_state(state_path)["build"]
+        with open(feed_path) as feed:
+            before = feed.read()
+        self.add_results(1)
+        Result.objects.filter(finishtime__isnull=True).update(finishtime=now)
+        self.assertEqual(export_cache.update_explorer_feed(self.battery,self.templates[0]),5 * len(TASKDATA))
+        # the new rows are appended to the feed of the same export build
+        self.assertEqual(export_cache.read_state(state_path)["build"],build)
+        with open(feed_path) as feed:
+            after = feed.read()
+        self.assertTrue(after.startswith(before))
+        feed = pandas.read_csv(feed_path,sep="\t",index_col=0)
+        self.assertEqual(feed.index.tolist(),range(5 * len(TASKDATA)))
+        self.assertEqual(feed["rt"].tolist(),[512,430] * 5)
+        # the feed is replaced by a rename, no temporary file is left
+        self.assertEqual(os.listdir(os.path.dirname(feed_path)),["task_0_data.tsv"])
+
+
+class ParallelExportTests(ResultFixtures,TransactionTestCase):
+    '''the pool processes read the results with their own connections, so the
+    results are committed (TransactionTestCase)
+    '''
+    def setUp(self):
+        super(ParallelExportTests,self).setUp()
+        # the battery is exported with the pool, as one with more experiments
+        self.pool_min_experiments = export.EXPORT_POOL_MIN_EXPERIMENTS
+        export.EXPORT_POOL_MIN_EXPERIMENTS = 1
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        export.EXPORT_POOL_MIN_EXPERIMENTS = self.pool_min_experiments
+        shutil.rmtree(self.folder)
+
+    def write(self,format,processes):
+        path = os.path.join(self.folder,"%s_%s.%s" %(format,processes,export.EXPORT_FORMATS[format][0]))
+        progress = ExportProgress(lambda count: None)
+        write_export(self.battery,get_export_results(self.battery),path,format,progress,processes=processes)
+        self.assertEqual(progress.count,4 * len(self.templates))
+        return path
+
+    def test_parallel_tsv_has_the_rows_of_the_serial_export(self):
+        self.assertTrue(export.use_export_pool(["task_0","task_1","task_2"],2))
+        with open(self.write("tsv",2)) as parallel:
+            parallel = parallel.read().splitlines()
+        with open(self.write("tsv",1)) as serial:
+            serial = serial.read().splitlines()
+        # the pool writes the experiments one after the other
+        self.assertEqual(parallel[0],serial[0])
+        self.assertEqual(sorted(parallel[1:]),sorted(serial[1:]))
+        self.assertEqual(len(parallel),1 + 4 * len(self.templates) * len(TASKDATA))
+
+    def test_parallel_hdf5_has_the_groups_of_the_serial_export(self):
+        with h5py.File(self.write("hdf5",2),"r") as parallel:
+            with h5py.File(self.write("hdf5",1),"r") as serial:
+                self.assertEqual(sorted(parallel.keys()),["task_0","task_1","task_2"])
+                self.assertEqual(sorted(parallel.keys()),sorted(serial.keys()))
+                for exp_id in serial.keys():
+                    self.assertEqual(parallel[exp_id].attrs["columns"],serial[exp_id].attrs["columns"])
+                    self.assertEqual(sorted(parallel[exp_id].keys()),sorted(serial[exp_id].keys()))
+                    for column in serial[exp_id].keys():
+                        self.assertEqual(parallel[exp_id][column][()].tolist(),
+                                         serial[exp_id][column][()].tolist())
+
+    def test_parallel_arrow_has_the_files_of_the_serial_export(self):
+        readers = {"parquet":lambda path: export.pyarrow.parquet.read_table(path).to_pandas(),
+                   "feather":lambda path: export.pyarrow.feather.read_feather(path)}
+        formats = [x for x in ["parquet","feather"] if x in get_export_formats()]
+        if len(formats) == 0:
+            self.skipTest("pyarrow is not installed")
+        for format in formats:
+            archives = []
+            for processes in [2,1]:
+                folder = os.path.join(self.folder,"%s_%s" %(format,processes))
+                with zipfile.ZipFile(self.write(format,processes)) as archive:
+                    archive.extractall(folder)
+                    archives.append((folder,sorted(archive.namelist())))
+            (parallel,names),(serial,serial_names) = archives
+            self.assertEqual(names,["task_0.%s" %format,"task_1.%s" %format,"task_2.%s" %format])
+            self.assertEqual(names,serial_names)
+            for name in names:
+                read = readers[format]
+                self.assertTrue(read(os.path.join(parallel,name)).equals(read(os.path.join(serial,name))))
+
+
+class ExportJobTests(ResultTestCase):
+    def setUp(self):
+        super(ExportJobTests,self).setUp()
+        self.always_eager = current_app.conf.CELERY_ALWAYS_EAGER
+        current_app.conf.CELERY_ALWAYS_EAGER = True
+        self.job_root = experiment_tasks.EXPORT_JOB_ROOT
+        experiment_tasks.EXPORT_JOB_ROOT = tempfile.mkdtemp()
+
+    def tearDown(self):
+        current_app.conf.CELERY_ALWAYS_EAGER = self.always_eager
+        shutil.rmtree(experiment_tasks.EXPORT_JOB_ROOT)
+        experiment_tasks.EXPORT_JOB_ROOT = self.job_root
+
+    def submit(self):
+        return submit_export_job(self.battery,"expfactory_battery_%s" %self.battery.id)
+
+    def test_requests_for_a_snapshot_share_a_job(self):
+        job = ExportJob.objects.get(id=self.submit().id)
+        self.assertEqual((job.status,job.processed,job.total),("SUCCESS",12,12))
+        with open(os.path.join(experiment_tasks.EXPORT_JOB_ROOT,job.file_name)) as export:
+            self.assertEqual(len(export.read().splitlines()),1 + 12 * len(TASKDATA))
+        self.assertEqual(self.submit().id,job.id)
+        # new results are a new snapshot
+        self.add_results(1)
+        self.assertNotEqual(self.submit().id,job.id)
+
+    def test_stalled_job_is_replaced(self):
+        job = self.submit()
+        stalled = timezone.now() - datetime.timedelta(minutes=EXPORT_JOB_STALL_MINUTES + 1)
+        ExportJob.objects.filter(id=job.id).update(status="RUNNING",update_date=stalled)
+        # a job writing its results is alive
+        heartbeat_export_job(job.id)
+        self.assertEqual(self.submit().id,job.id)
+        ExportJob.objects.filter(id=job.id).update(update_date=stalled)
+        self.assertNotEqual(self.submit().id,job.id)
+        self.assertEqual(ExportJob.objects.get(id=job.id).status,"FAILURE")
+        # the stalled job is not run again when its task is delivered again
+        run_export_job(job.id)
+        self.assertEqual(ExportJob.objects.get(id=job.id).status,"FAILURE")
+
+    def test_download_is_served_by_nginx(self):
+        job = self.submit()
+        self.client.login(username="owner",password="password")
+        response = self.client.get(reverse("download_export_job",args=[self.battery.id,job.id]))
+        self.assertEqual(response[settings.PRIVATE_MEDIA_REDIRECT_HEADER],
+                         "%s%s" %(settings.EXPORT_JOB_URL,ExportJob.objects.get(id=job.id).file_name))
+        self.assertEqual(response["Content-Disposition"],
+                         'attachment; filename="expfactory_battery_%s.tsv"' %self.battery.id)
+
+
+class CreditTests(ResultTestCase):
+    def setUp(self):
+        super(CreditTests,self).setUp()
+        template = self.templates[0]
+        template.performance_variable = ExperimentVariable.objects.create(name="mean_rt",description="mean response time")
+        template.rejection_variable = ExperimentVariable.objects.create(name="correct",description="correct response")
+        template.save()
+        Battery.objects.filter(id=self.battery.id).update(blacklist_active=True,bonus_active=True)
+        self.experiment = self.battery.experiments.get(template=template)
+        self.experiment.include_bonus = True
+        self.experiment.include_catch = True
+        self.experiment.save()
+        self.result = Result.objects.get(worker_id="worker0",experiment=template)
+        self.result.taskdata = [{"trialdata":[{"rt":300,"correct":True},{"rt":600,"correct":False}]}]
+        self.result.save()
+
+    def add_condition(self,variable,operator,value,amount=None):
+        condition = CreditCondition.objects.create(variable=variable,operator=operator,
+                                                   value=value,amount=amount)
+        self.experiment.credit_conditions.add(condition)
+
+    def test_conditions_compare_each_kind_of_value(self):
+        evaluate = lambda operator,value,values: CompiledCondition(1,1,"variable",operator,value,None).evaluate(values).tolist()
+        self.assertEqual(evaluate("GREATERTHAN","400",[300,450.5,600]),[False,True,True])
+        self.assertEqual(evaluate("GREATERTHAN","fast",[300,600]),[False,False])
+        self.assertEqual(evaluate("EQUALS","false",[True,False]),[False,True])
+        self.assertEqual(evaluate("NOTEQUALTO","left",["left","right"]),[False,True])
+        self.assertEqual(evaluate("EQUALS","1",[True,1,2.0,"1",None,[1]]),[True,True,False,True,False,False])
+        self.assertEqual(evaluate("EQUALS","1",[]),[])
+
+    def test_result_credit_flags_violations_and_records_bonuses(self):
+        self.add_condition(self.templates[0].rejection_variable,"EQUALS","false")
+        self.add_condition(self.templates[0].performance_variable,"GREATERTHAN","400",1.5)
+        evaluate_result_credit(self.result.id)
+        blacklist = Blacklist.objects.get(worker_id="worker0",battery=self.battery)
+        self.assertEqual(blacklist.flags["task_0"]["description"],"correct False EQUALS False")
+        self.assertFalse(blacklist.active)
+        bonus = Bonus.objects.get(worker_id="worker0",battery=self.battery)
+        self.assertEqual(bonus.amounts["task_0"]["description"],"mean_rt 450.0 GREATERTHAN 400.0")
+        self.assertEqual(bonus.calculate_bonus(),1.5)
+        self.assertTrue(Result.objects.get(id=self.result.id).credit_granted)
+
+    def test_rejection_only_credit_records_no_bonus(self):
+        self.add_condition(self.templates[0].rejection_variable,"EQUALS","true")
+        self.add_condition(self.templates[0].performance_variable,"LESSTHAN","400",1.5)
+        evaluate_result_credit(self.result.id,reward=False)
+        self.assertTrue(Blacklist.objects.filter(worker_id="worker0").exists())
+        self.assertFalse(Bonus.objects.filter(worker_id="worker0").exists())
+
+    def test_variable_index_summarizes_numeric_variables(self):
+        index = get_variable_index(self.result)
+        self.assertEqual(Result.objects.get(id=self.result.id).variable_index,index)
+        self.assertEqual(index["variables"],["correct","rt"])
+        self.assertEqual(index["values"],{"correct":[True,False],"rt":[300,600]})
+        self.assertEqual(index["summaries"]["rt"],{"mean":450.0,"median":450.0,"sum":900.0,"max":600.0,"min":300.0})
+        self.assertEqual(lookup_variable(index,"mean_rt"),[450.0])
+        self.assertEqual(lookup_variable(index,"max_rt"),[600.0])
+        self.assertEqual(lookup_variable(index,"unknown"),[])
+        self.assertTrue(numpy.isnan(lookup_variable(index,"mean_unknown")[0]))
+        self.assertEqual(get_result_variables(self.result,["mean_rt","correct"]),
+                         {"mean_rt":[450.0],"correct":[True,False]})
+
+
+# An assignment as answered by MTurk
+MTurkAssignment = namedtuple("MTurkAssignment",["AssignmentId","AssignmentStatus"])
+
+
+class MTurkAssignmentPage(list):
+    '''MTurkAssignmentPage is a page of assignments as answered by MTurk'''
+    TotalNumResults = "0"
+
+
+class FakeConnection(object):
+    '''FakeConnection answers the MTurk calls of the payout queue and the credit
+    sweep, granting bonuses unless it is given the error to raise
+    '''
+    def __init__(self,error=None,assignments=None):
+        self.error = error
+        self.assignments = assignments or []
+        self.granted = []
+        self.approved = []
+
+    def grant_bonus(self,worker_id,assignment_id,price,reason):
+        if self.error != None:
+            raise self.error
+        self.granted.append((worker_id,assignment_id,price.amount))
+
+    def get_assignments(self,hit_id,page_size=10,page_number=1):
+        start = (page_number - 1) * page_size
+        page = MTurkAssignmentPage(self.assignments[start:start + page_size])
+        page.TotalNumResults = str(len(self.assignments))
+        return page
+
+    def approve_assignment(self,assignment_id):
+        self.approved.append(assignment_id)
+
+
+class PaymentTests(ResultTestCase):
+    def setUp(self):
+        super(PaymentTests,self).setUp()
+        # bulk_create does not send the HIT to MTurk, as save does
+        HIT.objects.bulk_create([HIT(battery=self.battery,owner=self.owner,mturk_id="hit",
+                                     title="battery",description="battery",reward=1,
+                                     assignment_duration_in_hours=1)])
+        self.hit = HIT.objects.get(mturk_id="hit")
+        self.assignments = []
+        for number in range(3):
+            assignment = Assignment.objects.create(mturk_id="assignment%s" %number,
+                                                   worker_id="worker%s" %number,
+                                                   hit=self.hit,
+                                                   status=Assignment.SUBMITTED,
+                                                   accept_time=timezone.now())
+            self.assignments.append(assignment)
+        self.bonus = self.add_bonus("worker0")
+
+    def add_bonus(self,worker_id,amount=1.5):
+        amounts = {"task_0":{"experiment_id":1,"description":"mean_rt 450.0 GREATERTHAN 400.0","amount":amount}}
+        return Bonus.objects.create(worker_id=worker_id,battery=self.battery,amounts=amounts)
+
+    def send(self,payment,connection):
+        self.assertTrue(claim_payment(payment))
+        return send_payment(payment,connection)
+
+    def test_bonus_is_queued_once(self):
+        payment = queue_bonus_payment(self.bonus,self.assignments[0])
+        self.assertEqual((payment.amount,payment.status),(1.5,"PENDING"))
+        self.assertEqual(queue_bonus_payment(self.bonus,self.assignments[0]).id,payment.id)
+        # another assignment of the worker in the battery is not paid the bonus again
+        assignment = Assignment.objects.create(mturk_id="again",worker_id="worker0",hit=self.hit)
+        self.assertEqual(queue_bonus_payment(self.bonus,assignment),None)
+        self.assertEqual(BonusPayment.objects.filter(worker_id="worker0").count(),1)
+        self.assertEqual(queue_bonus_payment(self.add_bonus("worker1",0),self.assignments[1]),None)
+
+    def test_paid_payment_grants_the_bonus(self):
+        payment = queue_bonus_payment(self.bonus,self.assignments[0])
+        self.assertTrue(claim_payment(payment))
+        # a payment is sent by the worker that claimed it only
+        self.assertFalse(claim_payment(BonusPayment.objects.get(id=payment.id)))
+        connection = FakeConnection()
+        self.assertTrue(send_payment(payment,connection))
+        self.assertEqual(connection.granted,[("worker0","assignment0",1.5)])
+        self.assertEqual(BonusPayment.objects.get(id=payment.id).status,"PAID")
+        self.assertTrue(Bonus.objects.get(id=self.bonus.id).granted)
+        self.assertEqual(queue_bonus_payment(self.bonus,self.assignments[0]).status,"PAID")
+
+    def test_payment_errors_are_retried_or_left_to_check(self):
+        payment = queue_bonus_payment(self.bonus,self.assignments[0])
+        self.assertFalse(self.send(payment,FakeConnection(MTurkRequestError(503,"Throttled"))))
+        payment = BonusPayment.objects.get(id=payment.id)
+        self.assertEqual((payment.status,payment.attempts),("PENDING",1))
+        self.assertTrue(payment.next_attempt > timezone.now())
+        # without an answer from MTurk the bonus may have been granted
+        self.assertFalse(self.send(payment,FakeConnection(socket.timeout("timed out"))))
+        payment = BonusPayment.objects.get(id=payment.id)
+        self.assertEqual((payment.status,payment.attempts,payment.error),("SENDING",2,"timed out"))
+        self.assertFalse(Bonus.objects.get(id=self.bonus.id).granted)
+
+    def test_reconcile_credits_the_assignments_of_a_hit(self):
+        self.add_bonus("worker1")
+        statuses = ["Submitted","Approved","Rejected"]
+        mturk_assignments = [MTurkAssignment("assignment%s" %number,status) for number,status in enumerate(statuses)]
+        connection = FakeConnection(assignments=mturk_assignments)
+        self.hit.generate_connection = lambda: setattr(self.hit,"connection",connection)
+        self.assertEqual(reconcile_hit_credit(self.hit),2)
+        self.assertEqual(connection.approved,["assignment0"])
+        statuses = dict(Assignment.objects.values_list("mturk_id","status"))
+        self.assertEqual(statuses,{"assignment0":Assignment.APPROVED,
+                                   "assignment1":Assignment.APPROVED,
+                                   "assignment2":Assignment.REJECTED})
+        self.assertEqual(sorted(BonusPayment.objects.values_list("worker_id",flat=True)),["worker0","worker1"])
+        # credited assignments are not read again
+        self.assertEqual(reconcile_hit_credit(self.hit),0)
+        self.assertEqual(len(get_mturk_assignments(self.hit,page_size=2)),3)
+
+    def test_sweep_skips_hits_with_abandoned_assignments(self):
+        HIT.objects.bulk_create([HIT(battery=self.battery,owner=self.owner,mturk_id="idle",
+                                     title="battery",description="battery",reward=1,
+                                     assignment_duration_in_hours=1)])
+        idle = HIT.objects.get(mturk_id="idle")
+        # accepted, never submitted, and past its deadline
+        deadline = timezone.now() - datetime.timedelta(hours=2)
+        assignment = Assignment.objects.create(mturk_id="abandoned",worker_id="worker0",hit=idle,
+                                               accept_time=deadline - datetime.timedelta(hours=1),
+                                               deadline=deadline)
+        self.assertEqual([hit.id for hit in get_sweep_hits()],[self.hit.id])
+        # until the deadline the worker may still submit it
+        Assignment.objects.filter(id=assignment.id).update(deadline=timezone.now())
+        self.assertEqual(sorted(hit.id for hit in get_sweep_hits()),sorted([self.hit.id,idle.id]))
+
+
+class ImportResultsTests(ResultTestCase):
+    def setUp(self):
+        super(ImportResultsTests,self).setUp()
+        self.dump = tempfile.NamedTemporaryFile(suffix=".ndjson",delete=False)
+        records = [{"worker_id":"offline0","exp_id":"task_0","taskdata":TASKDATA,
+                    "finishtime":"2016-05-01T10:00:00"},
+                   {"worker_id":"offline0","exp_id":"task_1","taskdata":TASKDATA,"completed":"false"},
+                   {"worker_id":"worker0","exp_id":"task_0","taskdata":TASKDATA[:1]}]
+        self.dump.write("\n".join([json.dumps(record) for record in records]))
+        self.dump.close()
+
+    def tearDown(self):
+        os.remove(self.dump.name)
+
+    def import_results(self):
+        stdout = StringIO()
+        call_command("import_results",str(self.battery.id),self.dump.name,chunk_size=2,stdout=stdout)
+        return stdout.getvalue().strip().splitlines()[-1]
+
+    def test_results_are_imported_once(self):
+        self.assertEqual(self.import_results(),"Imported 2 results, skipped 1 existing")
+        results = Result.objects.filter(worker_id="offline0").order_by("experiment_id")
+        self.assertEqual([result.completed for result in results],[True,False])
+        self.assertEqual(results[0].get_taskdata(),TASKDATA)
+        self.assertEqual(results[0].finishtime.year,2016)
+        self.assertEqual(Result.objects.get(worker_id="worker0",experiment_id="task_0").get_taskdata(),TASKDATA)
+        # a rerun of the same dump skips the imported results
+        self.assertEqual(self.import_results(),"Imported 0 results, skipped 3 existing")
+        self.assertEqual(Result.objects.filter(battery=self.battery).count(),4 * len(self.templates) + 2)
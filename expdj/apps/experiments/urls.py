@@ -13,7 +13,8 @@ from expdj.apps.experiments.views import (
     battery_results_dashboard, dummy_battery ,modify_experiment, intro_battery,
     save_survey_template, add_survey_template, add_game_template,
     save_game_template, enable_cookie_view, change_experiment_order,
-    serve_battery_gmail, subject_management
+    serve_battery_gmail, subject_management, export_battery, export_experiment,
+    submit_export, export_job_status, download_export_job
 )
 
 urlpatterns = patterns('',
@@ -46,6 +47,7 @@ urlpatterns = patterns('',
     #url(r'^experiments/(?P<bid>\d+|[A-Z]{8})/results$',experiment_results_dashboard,name='experiment_results_dashboard'),
     url(r'^experiments/(?P<bid>\d+|[A-Z]{8})/(?P<eid>\d+|[A-Z]{8})/view$',view_experiment, name='experiment_details'),
     url(r'^experiments/(?P<bid>\d+|[A-Z]{8})/(?P<eid>\d+|[A-Z]{8})/order$',change_experiment_order, name='change_experiment_order'),
+    url(r'^experiments/(?P<bid>\d+|[A-Z]{8})/(?P<eid>\d+|[A-Z]{8})/export$',export_experiment, name='export_experiment'),
     url(r'^experiments/(?P<bid>\d+|[A-Z]{8})/(?P<eid>\d+|[A-Z]{8})/remove$',remove_experiment,name='remove_experiment'),
     url(r'^conditions/(?P<bid>\d+|[A-Z]{8})/(?P<eid>\d+|[A-Z]{8})/(?P<cid>\d+|[A-Z]{8})/remove$',remove_condition,name='remove_condition'),
 
@@ -57,6 +59,10 @@ urlpatterns = patterns('',
     url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/edit$',edit_battery,name='edit_battery'),
     url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/subjects$',subject_management,name='subject_management'),
     url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/user$',generate_battery_user,name='generate_battery_user'),
+    url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/export$',export_battery,name='export_battery'),
+    url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/exports$',submit_export,name='submit_export'),
+    url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/exports/(?P<jid>\d+)$',export_job_status,name='export_job_status'),
+    url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/exports/(?P<jid>\d+)/download$',download_export_job,name='download_export_job'),
     #url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/results$',battery_results_dashboard,name='battery_results_dashboard'),
     url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/$',view_battery, name='battery_details'),
     url(r'^batteries/(?P<bid>\d+|[A-Z]{8})/delete$',delete_battery,name='delete_battery'),
@@ -13,6 +13,8 @@ from numpy.random import choice
 from datetime import datetime
 from git import Repo
 import tempfile
+import hashlib
+import logging
 import shutil
 import random
 import pandas
@@ -22,6 +24,8 @@ import re
 
 media_dir = os.path.join(BASE_DIR,MEDIA_ROOT)
 
+logger = logging.getLogger(__name__)
+
 # EXPERIMENT FACTORY PYTHON FUNCTIONS #####################################################
 
 def get_experiment_selection(repo_type="experiments"):
@@ -125,6 +129,8 @@ def install_experiments(experiment_tags=None,repo_type="experiments"):
             errored_experiments.append(experiment[0]["exp_id"])
 
     shutil.rmtree(tmpdir)
+    if repo_type == "surveys":
+        clear_survey_questions([e[0]["exp_id"] for e in experiments])
     return errored_experiments
 
 # EXPERIMENTS AND BATTERIES ###############################################################
@@ -163,85 +169,149 @@ def get_battery_results(battery,exp_id=None,clean=False):
     args = {"battery":battery}
     if exp_id != None:
         args["experiment__exp_id"] = exp_id
-    results = Result.objects.filter(**args)
+    results = Result.objects.filter(**args).for_export()
     df = make_results_df(battery,results)
     if clean == True:
-        columns_to_remove = [x for x in df.columns.tolist() if re.search("worker_|^battery_",x)]
-        columns_to_remove = columns_to_remove + ["experiment_include_bonus",
-                                                 "experiment_include_catch",
-                                                 "result_id",
-                                                 "result_view_history",
-                                                 "result_time_elapsed",
-                                                 "result_timing_post_trial",
-                                                 "result_stim_duration",
-                                                 "result_internal_node_id",
-                                                 "result_trial_index",
-                                                 "result_trial_type",
-                                                 "result_stimulus",
-                                                 "experiment_reference",
-                                                 "experiment_cognitive_atlas_task_id",
-                                                 "result_dateTime",
-                                                 "result_exp_id",
-                                                 "result_page_num"]
-        df.drop(columns_to_remove,axis=1,inplace=True,errors="ignore")
-        df.columns = [x.replace("result_","") for x in df.columns.tolist()]
+        df = clean_results_df(df)
     df.index = range(0,df.shape[0])
     return df
 
-def make_results_df(battery,results):
-
-    variables = get_unique_variables(results)
-    tags = get_unique_experiments(results)
-    lookup = make_experiment_lookup(tags,battery)
-    header = ['worker_id',
-              'worker_platform',
-              'worker_browser',
-              'battery_name',
-              'battery_owner',
-              'battery_owner_email',
-              'experiment_completed',
-              'experiment_include_bonus',
-              'experiment_include_catch',
-              'experiment_exp_id',
-              'experiment_name',
-              'experiment_reference',
-              'experiment_cognitive_atlas_task_id']
-    column_names = header + variables
-    df = pandas.DataFrame(columns=column_names)
-    for result in results:
-        try:
-            if result.completed == True:
-                worker_id = result.worker_id
-                for t in range(len(result.taskdata)):
-                    row_id = "%s_%s_%s" %(result.experiment.exp_id,worker_id,t)
-                    trial = result.taskdata[t]
-
-                    # Add worker and battery information
-                    df.loc[row_id,["worker_id","worker_platform","worker_browser","battery_name","battery_owner","battery_owner_email"]] = [worker_id,result.platform,result.browser,battery.name,battery.owner.username,battery.owner.email]
-
-                    # Look up the experiment
-                    exp=lookup[result.experiment.exp_id]
-                    df.loc[row_id,["experiment_completed","experiment_include_bonus","experiment_include_catch","experiment_exp_id","experiment_name","experiment_reference","experiment_cognitive_atlas_task_id"]] = [result.completed,exp["include_bonus"],exp["include_catch"],exp["experiment"].exp_id,exp["experiment"].name,exp["experiment"].reference,exp["experiment"].cognitive_atlas_task_id]
-
-                    # Parse data
-                    for key in trial.keys():
-                        if key != "trialdata":
-                            df.loc[row_id,key] = trial[key]
-                    for key in trial["trialdata"].keys():
-                        df.loc[row_id,key] = trial["trialdata"][key]
-        except:
-            pass
+def clean_results_df(df):
+    '''clean_results_df removes battery info, subject info, and identifying information
+    from a results DataFrame, and the result_ prefix of the trial columns
+    '''
+    columns_to_remove = [x for x in df.columns.tolist() if re.search("worker_|^battery_",x)]
+    columns_to_remove = columns_to_remove + ["experiment_include_bonus",
+                                             "experiment_include_catch",
+                                             "result_id",
+                                             "result_view_history",
+                                             "result_time_elapsed",
+                                             "result_timing_post_trial",
+                                             "result_stim_duration",
+                                             "result_internal_node_id",
+                                             "result_trial_index",
+                                             "result_trial_type",
+                                             "result_stimulus",
+                                             "experiment_reference",
+                                             "experiment_cognitive_atlas_task_id",
+                                             "result_dateTime",
+                                             "result_exp_id",
+                                             "result_page_num"]
+    df.drop(columns_to_remove,axis=1,inplace=True,errors="ignore")
+    df.columns = [x.replace("result_","") for x in df.columns.tolist()]
+    return df
 
-    # Change all names that don't start with experiment or worker or experiment to be result
-    result_variables = [x for x in column_names if x not in header]
-    for result_variable in result_variables:
-        df=df.rename(columns = {result_variable:"result_%s" %result_variable})
-        final_names = ["result_%s" %x for x in variables]
+# Columns describing the worker, battery and experiment of each exported trial
+RESULT_HEADER = ['worker_id',
+                 'worker_platform',
+                 'worker_browser',
+                 'battery_name',
+                 'battery_owner',
+                 'battery_owner_email',
+                 'experiment_completed',
+                 'experiment_include_bonus',
+                 'experiment_include_catch',
+                 'experiment_exp_id',
+                 'experiment_name',
+                 'experiment_reference',
+                 'experiment_cognitive_atlas_task_id']
+
+def get_export_trials(taskdata):
+    '''get_export_trials returns the jsPsych trials in the taskdata of a result, the
+    dictionaries in its list of trials (none when taskdata is not a list)
+    '''
+    if not isinstance(taskdata,list):
+        return []
+    return [trial for trial in taskdata if isinstance(trial,dict)]
+
+def get_trial_values(trial):
+    '''get_trial_values returns the variables of a jsPsych trial as a flat
+    dictionary, values under "trialdata" taking precedence (none when the
+    trial is not a dictionary)
+    '''
+    if not isinstance(trial,dict):
+        return dict()
+    values = dict((key,value) for key,value in trial.items() if key != "trialdata")
+    if isinstance(trial.get("trialdata"),dict):
+        values.update(trial["trialdata"])
+    return values
+
+def get_result_columns(variables):
+    '''get_result_columns returns the export column names, RESULT_HEADER followed
+    by the trial variables prefixed with result_ (uniqueid becomes result_id)
+    '''
+    columns = ["result_%s" %x for x in variables]
+    columns = ["result_id" if x == "result_uniqueid" else x for x in columns]
+    return RESULT_HEADER + columns
 
-    # rename uniqueid to result id
-    if "result_uniqueid" in df.columns:
-        df=df.rename(columns = {'result_uniqueid':'result_id'})
+def get_result_info(battery,result,experiment):
+    '''get_result_info returns the RESULT_HEADER values of a result
+    :param experiment: the lookup entry of the result experiment, see make_experiment_lookup
+    '''
+    template = experiment["experiment"]
+    return [result.worker_id,result.platform,result.browser,
+            battery.name,battery.owner.username,battery.owner.email,
+            result.completed,experiment["include_bonus"],experiment["include_catch"],
+            template.exp_id,template.name,template.reference,template.cognitive_atlas_task_id]
+
+def result_rows(battery,result,variables,experiment):
+    '''result_rows yields one export row per trial of a result, the RESULT_HEADER
+    values followed by each variable ("" when the trial does not have it)
+    :param battery: the battery of the result
+    :param result: a completed turk.models.Result
+    :param variables: list of trial variables, the order of the columns
+    :param experiment: the lookup entry of the result experiment, see make_experiment_lookup
+    '''
+    info = get_result_info(battery,result,experiment)
+    for trial in get_export_trials(result.stored_taskdata()):
+        values = get_trial_values(trial)
+        row = list(info)
+        for variable in variables:
+            value = values.get(variable)
+            row.append("" if value is None else value)
+        yield row
 
+def make_results_df(battery,results):
+    '''make_results_df returns a DataFrame with one row per trial of the completed
+    results, with the RESULT_HEADER columns followed by the trial variables
+    (see get_result_columns). Trials are flattened into row dictionaries in
+    one pass, and the frame is built with a single constructor call.
+    :param battery: the battery of the results
+    :param results: turk.models.Result objects or queryset
+    '''
+    lookup = dict()
+    rows = []
+    row_ids = []
+    variables = set()
+    for result in results:
+        if result.completed != True:
+            continue
+        # A result that cannot be read is left out of the frame, and logged
+        try:
+            exp_id = result.experiment.exp_id
+            if exp_id not in lookup:
+                lookup[exp_id] = make_experiment_lookup([exp_id],battery).get(exp_id)
+            if lookup[exp_id] == None:
+                continue
+            info = dict(zip(RESULT_HEADER,get_result_info(battery,result,lookup[exp_id])))
+            trial_rows = []
+            result_variables = set()
+            for t,trial in enumerate(get_export_trials(result.stored_taskdata())):
+                values = get_trial_values(trial)
+                result_variables.update(values.keys())
+                row = dict(("result_%s" %key,value) for key,value in values.items())
+                row.update(info)
+                trial_rows.append(row)
+        except Exception:
+            logger.exception("result %s is left out of the results of battery %s" %(result.id,battery.name))
+            continue
+        rows += trial_rows
+        row_ids += ["%s_%s_%s" %(exp_id,result.worker_id,t) for t in range(len(trial_rows))]
+        variables.update(result_variables)
+
+    variables = sorted(variables)
+    df = pandas.DataFrame(rows,index=row_ids,columns=RESULT_HEADER + ["result_%s" %x for x in variables])
+    df.columns = get_result_columns(variables)
     return df
 
 
@@ -358,21 +428,74 @@ def remove_keys(dictionary, keys):
             del new_dict[key]
     return new_dict
 
-def complete_survey_result(exp_id,taskdata):
+def get_sync_marker(request):
+    '''get_sync_marker returns the client page session and sequence number of a
+    sync request (the X-Sync-Session and X-Sync-Sequence headers, None if not
+    sent) and a hash of its payload
+    '''
+    session = request.META.get("HTTP_X_SYNC_SESSION")
+    if session != None:
+        session = session[:64]
+    sequence = request.META.get("HTTP_X_SYNC_SEQUENCE")
+    try:
+        sequence = int(sequence)
+    except (TypeError,ValueError):
+        sequence = None
+    return session,sequence,hashlib.sha1(request.body).hexdigest()
+
+def check_sync_marker(sequence,payload_hash,last_sequence,last_hash,session=None,last_session=None):
+    '''check_sync_marker compares a sync with the last one applied to a result,
+    and returns "duplicate", "stale", or None if the sync should be applied.
+    The sequence number is used when the client sends one and the sync is from
+    the same page session as the last one (a reloaded page numbers its syncs
+    again), the hash otherwise.
+    '''
+    if sequence != None and last_sequence != None and session == last_session:
+        if sequence == last_sequence:
+            return "duplicate"
+        if sequence < last_sequence:
+            return "stale"
+        return None
+    if payload_hash == last_hash:
+        return "duplicate"
+    return None
+
+# Question lookups of installed surveys, by (exp_id, version)
+survey_questions = {}
+
+def get_survey_questions(exp_id,version=None):
+    '''get_survey_questions returns the question lookup of an installed survey,
+    generated by the expfactory-python survey module, parsing the survey files
+    only the first time a version is seen by the process
+    :param exp_id: the survey unique id
+    :param version: the installed version (ExperimentTemplate.version)
+    '''
+    key = (exp_id,version)
+    if key not in survey_questions:
+        experiment = [{"exp_id":exp_id}]
+        experiment_folder = "%s/%s/%s" %(media_dir,"surveys",exp_id)
+        survey_questions[key] = export_questions(experiment,experiment_folder)
+    return survey_questions[key]
+
+def clear_survey_questions(exp_ids=None):
+    '''clear_survey_questions removes cached question lookups
+    :param exp_ids: list of survey ids to remove, default None removes all
+    '''
+    for key in list(survey_questions.keys()):
+        if exp_ids == None or key[0] in exp_ids:
+            del survey_questions[key]
+
+def complete_survey_result(exp_id,taskdata,version=None):
     '''complete_survey_result parses the form names (question ids) and matches to a lookup table generated by expfactory-python survey module that has complete question / option information.
     :param experiment: the survey unique id, expected to be
     :param taskdata: the taskdata from the server, typically an ordered dict
+    :param version: the installed version of the survey, to use the cached lookup
     '''
-    taskdata = dict(taskdata)
-    experiment = [{"exp_id":exp_id}]
-    experiment_folder = "%s/%s/%s" %(media_dir,"surveys",exp_id)
-    question_lookup = export_questions(experiment,experiment_folder)
+    question_lookup = get_survey_questions(exp_id,version)
     final_data = {}
     for queskey,quesval in taskdata.iteritems():
-        if queskey in question_lookup:
-           complete_question = question_lookup[queskey]
-           complete_question["response"] = quesval[0]
-        else:
-           complete_question = {"response":quesval[0]}
+        # copy the entry, the cached lookup is shared by all submissions
+        complete_question = dict(question_lookup.get(queskey,{}))
+        complete_question["response"] = quesval[0]
         final_data[queskey] = complete_question
     return final_data
@@ -1,5 +1,4 @@
 import datetime
-import csv
 import hashlib
 import json
 import numpy
@@ -16,8 +15,10 @@ from expfactory.views import embed_experiment
 
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.forms.models import model_to_dict
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.http.response import (
     HttpResponseRedirect, HttpResponseForbidden, Http404
 )
@@ -26,30 +27,47 @@ from django.shortcuts import (
 )
 from django.utils import timezone
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_protect
+from django.views.decorators.http import require_POST
 
+from expdj.apps.main.timing import phase, timed
 from expdj.apps.main.views import google_auth_view
+from expdj.apps.experiments.export import (
+    EXPORT_FORMATS, export_file, export_tsv, get_export_formats
+)
+from expdj.apps.experiments.export_cache import (
+    cached_export_tsv, get_feed_paths, update_explorer_feed, write_feed
+)
 from expdj.apps.experiments.forms import (
     ExperimentForm, ExperimentTemplateForm, BatteryForm, BlacklistForm
 )
 from expdj.apps.experiments.models import (
     ExperimentTemplate, Experiment, Battery, ExperimentVariable, 
-    CreditCondition
+    CreditCondition, ExportJob
 )
+from expdj.apps.experiments.tasks import submit_export_job
 from expdj.apps.experiments.utils import (
     get_experiment_selection, install_experiments, update_credits, 
     make_results_df, get_battery_results, get_experiment_type, remove_keys, 
-    complete_survey_result, select_experiments
+    complete_survey_result, select_experiments, get_sync_marker,
+    check_sync_marker
 )
 from expdj.settings import BASE_DIR,STATIC_ROOT,MEDIA_ROOT,DOMAIN_NAME
 import expdj.settings as settings
+from expdj.apps.turk import codec
+from expdj.apps.turk.buffer import (
+    buffer_result, load_buffered_result, discard_buffered_result
+)
 from expdj.apps.turk.models import (
-    HIT, Result, Assignment, get_worker, Blacklist, Bonus
+    HIT, Result, Assignment, get_worker, Blacklist, Bonus,
+    get_battery_progress, merge_experiment_schema, record_completed_experiment
 )
 from expdj.apps.turk.tasks import (
-    assign_experiment_credit, update_assignments, check_blacklist, 
-    experiment_reward, check_battery_dependencies
+    update_assignments, evaluate_result_credit, check_battery_dependencies, process_completed_result,
+    get_unique_experiments
+)
+from expdj.apps.turk.utils import (
+    RESULT_FILTER_PARAMS, get_result_filters, get_worker_experiments
 )
-from expdj.apps.turk.utils import get_worker_experiments
 from expdj.apps.users.models import User
 
 
@@ -221,7 +239,8 @@ def view_battery(request, bid):
                'hits':hits,
                'anon_link':anon_link,
                'gmail_link':gmail_link,
-               'assignments':assignments}
+               'assignments':assignments,
+               'export_formats':get_export_formats()}
 
     return render(request,'experiments/battery_details.html', context)
 
@@ -388,6 +407,7 @@ def dummy_battery(request,bid):
 
 
 @ensure_csrf_cookie
+@timed("serve_battery")
 def serve_battery(request,bid,userid=None):
     '''prepare for local serve of battery'''
 
@@ -402,11 +422,13 @@ def serve_battery(request,bid,userid=None):
     if userid == None:
         return preview_battery(request,bid)
 
-    worker = get_worker(userid,create=False)
+    with phase("serve_battery.get_worker"):
+        worker = get_worker(userid,create=False)
     if isinstance(worker,list): # no id means returning []
         return render_to_response("turk/invalid_id_sorry.html")
 
-    missing_batteries, blocking_batteries = check_battery_dependencies(battery, userid)
+    with phase("serve_battery.dependencies"):
+        missing_batteries, blocking_batteries = check_battery_dependencies(battery, userid)
     if missing_batteries or blocking_batteries:
         return render_to_response(
             "turk/battery_requirements_not_met.html",
@@ -421,8 +443,9 @@ def serve_battery(request,bid,userid=None):
     deployment = "docker-local"
 
     # Does the worker have experiments remaining?
-    uncompleted_experiments = get_worker_experiments(worker,battery)
-    experiments_left = len(uncompleted_experiments)
+    with phase("serve_battery.worker_experiments"):
+        uncompleted_experiments = get_worker_experiments(worker,battery)
+        experiments_left = len(uncompleted_experiments)
     if  experiments_left == 0:
         # Thank you for your participation - no more experiments!
         return render_to_response("turk/worker_sorry.html")
@@ -433,11 +456,12 @@ def serve_battery(request,bid,userid=None):
     task_list = battery.experiments.filter(template=experimentTemplate)
 
     # Generate a new results object for the worker, assignment, experiment
-    result,_ = Result.objects.update_or_create(worker=worker,
-                                               experiment=experimentTemplate,
-                                               battery=battery,
-                                               defaults={"browser":browser,"platform":platform})
-    result.save()
+    with phase("serve_battery.result"):
+        result,_ = Result.objects.update_or_create(worker=worker,
+                                                   experiment=experimentTemplate,
+                                                   battery=battery,
+                                                   defaults={"browser":browser,"platform":platform})
+        result.save()
 
     context = {"worker_id": worker.id,
                "uniqueId":result.id}
@@ -490,14 +514,16 @@ def deploy_battery(deployment, battery, experiment_type, context, task_list,
 
     # Get experiment folders
     experiment_folders = [os.path.join(media_dir,experiment_type,x.template.exp_id) for x in task_list]
-    context["experiment_load"] = get_load_static(experiment_folders,url_prefix="/")
+    with phase("deploy_battery.load_static"):
+        context["experiment_load"] = get_load_static(experiment_folders,url_prefix="/")
 
     # Get code to run the experiment (not in external file)
     runcode = ""
 
     # Experiments templates
     if experiment_type in ["experiments"]:
-        runcode = get_experiment_run(experiment_folders,deployment=deployment)[task_list[0].template.exp_id]
+        with phase("deploy_battery.experiment_run"):
+            runcode = get_experiment_run(experiment_folders,deployment=deployment)[task_list[0].template.exp_id]
         if result != None:
             runcode = runcode.replace("{{result.id}}",str(result.id))
         runcode = runcode.replace("{{next_page}}",next_page)
@@ -512,10 +538,12 @@ def deploy_battery(deployment, battery, experiment_type, context, task_list,
             runcode = runcode.replace("Click \"Next Experiment\" to keep your result, and progress to the next task", "Click \"Finised\" to keep your result.")
             runcode = runcode.replace(">Next Experiment</button>", ">Finished</button>")
     elif experiment_type in ["games"]:
-        experiment = load_experiment(experiment_folders[0])
+        with phase("deploy_battery.load_experiment"):
+            experiment = load_experiment(experiment_folders[0])
         runcode = experiment[0]["deployment_variables"]["run"]
     elif experiment_type in ["surveys"]:
-        experiment = load_experiment(experiment_folders[0])
+        with phase("deploy_battery.load_experiment"):
+            experiment = load_experiment(experiment_folders[0])
         resultid = ""
         if result != None:
             resultid = result.id
@@ -535,77 +563,166 @@ def deploy_battery(deployment, battery, experiment_type, context, task_list,
             context["last_experiment"] = last_experiment
 
     context["run"] = runcode
-    response = render_to_response(template, context)
+    with phase("deploy_battery.render"):
+        response = render_to_response(template, context)
 
     # without this header, the iFrame will not render in Amazon
     response['x-frame-options'] = 'this_can_be_anything'
     return response
 
+def get_completion_response(result,progress=None):
+    '''get_completion_response returns the response to the FINISHED sync of a
+    completed result, with the battery progress of the worker
+    :param progress: the WorkerBatteryProgress of the worker, read if not given
+    '''
+    if progress == None:
+        progress = get_battery_progress(result.worker,result.battery)
+    data = {"djstatus":"FINISHED",
+            "finished_battery":"NOTFINISHED"}
+    if progress.is_finished():
+        data["finished_battery"] = "FINISHED"
+    return data
+
+def sync_rejected(reason,result):
+    '''sync_rejected answers a sync that was already applied (duplicate, 200)
+    or is older than the last one applied (stale, 409), see check_sync_marker.
+    A duplicate of the FINISHED sync of a completed result (eg retried after a
+    timeout) gets the completion response again.
+    '''
+    if reason == "duplicate":
+        if result.completed:
+            return JsonResponse(get_completion_response(result))
+        return JsonResponse({"message":"duplicate"})
+    return JsonResponse({"message":"stale"},status=409)
+
 # These views are to work with backbone.js
 @ensure_csrf_cookie
+@timed("sync")
 def sync(request,rid=None):
     '''localsync
     view/method for running experiments to get data from the server
     :param rid: the result object ID, obtained before user sees page
+
+    jsPsych experiments can post the full trial list under taskdata["data"],
+    or (delta mode) only the trials after the last acknowledged trial, with
+    taskdata["first_trial"] giving the index of the first trial sent. A delta
+    that would leave a gap is rejected with 409 and the stored trial_count,
+    so the client can resend from there.
+
+    With RESULT_WRITE_BEHIND, syncs that are not FINISHED are buffered in
+    Redis instead of saved; FINISHED syncs are always saved right away.
+
+    Experiments and games may send an increasing X-Sync-Sequence header,
+    otherwise the payload hash is used: a sync equal to the last one applied
+    is answered with 200, an older sequence with 409, without applying it.
+    A page numbers its syncs again after a reload, so it should also send an
+    X-Sync-Session header, new for each page load: the sequence is only
+    compared between syncs of the same session.
     '''
 
     if request.method == "POST":
 
         if rid != None:
         # Update the result, already has worker and assignment ID stored
-            result,_ = Result.objects.get_or_create(id=rid)
-            battery = result.battery
-            experiment_template = get_experiment_type(result.experiment)
-            if experiment_template == "experiments":
-                data = json.loads(request.body)
-                result.taskdata = data["taskdata"]["data"]
-                result.current_trial = data["taskdata"]["currenttrial"]
-                djstatus = data["djstatus"]
-            elif experiment_template == "games":
-                data = json.loads(request.body)
-                redirect_url = data["redirect_url"]
-                result.taskdata = data["taskdata"]
-                djstatus = data["djstatus"]
-            elif experiment_template == "surveys":
-                data = request.POST
-                redirect_url = data["url"]
-                djstatus = data["djstatus"]
-                # Remove keys we don't want
-                data = remove_keys(data,["process","csrfmiddlewaretoken","url","djstatus"])
-                result.taskdata = complete_survey_result(result.experiment.exp_id,data)
-
-            result.save()
+            session,sequence,payload_hash = get_sync_marker(request)
+            newly_completed = False
+
+            # The result is locked until the sync is saved, so a delta is appended
+            # after the trials of the sync before it (eg a retried request) is saved
+            with transaction.atomic():
+                with phase("sync.load_result"):
+                    result = Result.objects.select_related("experiment").select_for_update().get(id=rid)
+                experiment_template = get_experiment_type(result.experiment)
+                if experiment_template != "surveys":
+                    # A buffered sync is newer than the database row
+                    if settings.RESULT_WRITE_BEHIND and not result.completed:
+                        load_buffered_result(result)
+                    rejected = check_sync_marker(sequence,payload_hash,result.sync_sequence,result.sync_hash,
+                                                 session=session,last_session=result.sync_session)
+                    if rejected != None:
+                        return sync_rejected(rejected,result)
+
+                if experiment_template == "experiments":
+                    with phase("sync.parse"):
+                        data = codec.loads(request.body)
+                    # Delta mode sends only trials after the last acknowledged trial
+                    if "first_trial" in data["taskdata"]:
+                        trial_count = result.append_trials(data["taskdata"]["data"],int(data["taskdata"]["first_trial"]))
+                        if trial_count == None:
+                            out_of_sequence = {"message":"out of sequence",
+                                               "trial_count":result.trial_count()}
+                            return JsonResponse(out_of_sequence,status=409)
+                        data["trial_count"] = trial_count
+                    else:
+                        result.set_taskdata(data["taskdata"]["data"])
+                    result.current_trial = data["taskdata"]["currenttrial"]
+                    djstatus = data["djstatus"]
+                elif experiment_template == "games":
+                    data = codec.loads(request.body)
+                    redirect_url = data["redirect_url"]
+                    result.set_taskdata(data["taskdata"])
+                    djstatus = data["djstatus"]
+                elif experiment_template == "surveys":
+                    data = request.POST
+                    redirect_url = data["url"]
+                    djstatus = data["djstatus"]
+                    # Remove keys we don't want
+                    data = remove_keys(data,["process","csrfmiddlewaretoken","url","djstatus"])
+                    result.set_taskdata(complete_survey_result(result.experiment.exp_id,data,result.experiment.version))
+
+                result.sync_session = session
+                result.sync_sequence = sequence
+                result.sync_hash = payload_hash
+
+                with phase("sync.save"):
+                    if djstatus != "FINISHED" and settings.RESULT_WRITE_BEHIND:
+                        # Written to the database later by flush_result_buffer
+                        buffer_result(result)
+                    else:
+                        if settings.RESULT_WRITE_BEHIND:
+                            discard_buffered_result(result.id)
+                        result.save()
+
+                # Mark experiment as completed if the worker finished it. Only the
+                # sync that changes completed claims the completion, so its tasks
+                # are fired once
+                if djstatus == "FINISHED":
+                    finishtime = timezone.now()
+                    claimed = Result.objects.filter(id=result.id,completed=False).update(completed=True,
+                                                                                         finishtime=finishtime,
+                                                                                         version=result.experiment.version)
+                    newly_completed = claimed == 1
+                    if newly_completed:
+                        result.completed = True
+                        result.finishtime = finishtime
+                        result.version = result.experiment.version
+                        # exports read their columns from the schema, the first
+                        # schema of an experiment is built by process_completed_result
+                        with phase("sync.schema"):
+                            merge_experiment_schema(result,result.stored_taskdata())
 
             # if the worker finished the current experiment
             if djstatus == "FINISHED":
 
-                # Mark experiment as completed
-                result.completed = True
-                result.finishtime = timezone.now()
-                result.version = result.experiment.version
-                result.save()
-
-                # Fire a task to check blacklist status, add bonus
-                check_blacklist.apply_async([result.id])
-                experiment_reward.apply_async([result.id])
-
-                data = dict()
-                data["finished_battery"] = "NOTFINISHED"
-                data["djstatus"] = djstatus
-                completed_experiments = get_worker_experiments(result.worker,battery,completed=True)
-                completed_experiments = numpy.unique([x.template.exp_id for x in completed_experiments]).tolist()
-                if len(completed_experiments) == battery.experiments.count():
-                    assign_experiment_credit.apply_async([result.worker.id],countdown=60)
-                    data["finished_battery"] = "FINISHED"
+                # Fire the tasks indexing the result, then checking blacklist status
+                # and adding bonus from its index (only once, a late retry of a
+                # FINISHED sync must not fire them again)
+                if newly_completed:
+                    completed_tasks = process_completed_result.si(result.id) | evaluate_result_credit.si(result.id)
+                    completed_tasks.apply_async()
+
+                with phase("sync.battery_progress"):
+                    progress = record_completed_experiment(result)
+                    data = get_completion_response(result,progress)
 
                 # Refresh the page if we've completed a survey or game
                 if experiment_template in ["surveys"]:
                     return redirect(redirect_url)
 
-            data = json.dumps(data)
+            data = codec.dumps(data)
 
     else:
-        data = json.dumps({"message":"received!"})
+        data = codec.dumps({"message":"received!"})
 
     return HttpResponse(data, content_type='application/json')
 
@@ -713,7 +830,7 @@ def delete_experiment_template(request, eid, do_redirect=True):
         if os.path.exists(static_files_dir):
             shutil.rmtree(static_files_dir)
         # delete associated results
-        results = Result.objects.filter(experiment=experiment)
+        results = Result.objects.filter(experiment=experiment).summaries()
         [r.delete() for r in results]
         # Cognitive Atlas Task
         task = experiment.cognitive_atlas_task
@@ -997,7 +1114,7 @@ def delete_battery(request, bid):
     if delete_permission==True:
         hits = HIT.objects.filter(battery=battery)
         [h.delete() for h in hits]
-        results = Result.objects.filter(battery=battery)
+        results = Result.objects.filter(battery=battery).summaries()
         [r.delete() for r in results]
         battery.delete()
     return redirect('batteries')
@@ -1034,48 +1151,118 @@ def subject_management(request,bid):
 @login_required
 def export_battery(request,bid):
     battery = get_battery(bid,request)
-    output_name = "expfactory_battery_%s.tsv" %(battery.id)
-    return export_experiments(battery,output_name)
+    if not check_battery_edit_permission(request,battery):
+        return HttpResponseForbidden()
+    try:
+        filters = get_result_filters(request.GET)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e),content_type="text/plain")
+    output_name = "expfactory_battery_%s" %(battery.id)
+    return export_experiments(battery,output_name,format=request.GET.get("format","tsv"),
+                              filters=filters)
 
 # Export specific experiment data
 @login_required
-def export_experiment(request,eid):
-    battery = Battery.objects.filter(experiments__id=eid)[0]
-    experiment = get_experiment(eid,request)
-    output_name = "expfactory_experiment_%s.tsv" %(experiment.template.exp_id)
-    return export_experiments(battery,output_name,[experiment.template.exp_id])
+def export_experiment(request,bid,eid):
+    battery = get_battery(bid,request)
+    if not check_battery_edit_permission(request,battery):
+        return HttpResponseForbidden()
+    experiment = get_object_or_404(battery.experiments,id=eid)
+    try:
+        filters = get_result_filters(request.GET)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e),content_type="text/plain")
+    output_name = "expfactory_experiment_%s" %(experiment.template.exp_id)
+    return export_experiments(battery,output_name,[experiment.template.exp_id],
+                              format=request.GET.get("format","tsv"),filters=filters)
 
 # General function to export some number of experiments
-def export_experiments(battery,output_name,experiment_tags=None):
-
-    # Get all results associated with Battery
-    results = Result.objects.filter(battery=battery)
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="%s"' %(output_name)
-    writer = csv.writer(response,delimiter='\t')
-
-    # Make a results pandas dataframe
-    df = make_results_df(battery,results)
-
-    # Specifying individual experiments removes between trial stufs
-    if experiment_tags != None:
-        if isinstance(experiment_tags,str):
-            experiment_tags = [experiment_tags]
-        df = df[df.experiment_exp_id.isin(experiment_tags)]
-
-    # The program reading in values should fill in appropriate nan value
-    df[df.isnull()]=""
+def export_experiments(battery,output_name,experiment_tags=None,format="tsv",filters=None):
+    '''export_experiments exports the completed results of a battery, one row
+    per trial, see experiments/export.py
+    :param output_name: the file name of the download, without extension
+    :param experiment_tags: optional list of ExperimentTemplate.exp_id to export
+    :param format: tsv (streamed), or parquet, feather or hdf5 (served as a file)
+    :param filters: optional result filters, see turk.utils.get_result_filters
+    '''
+    if format not in get_export_formats():
+        return HttpResponseBadRequest("Export format is not available",content_type="text/plain")
+    if format == "tsv":
+        # the cached exports have all completed results, filtered exports are streamed
+        if settings.EXPORT_CACHE and not filters and (experiment_tags == None or len(experiment_tags) == 1):
+            exp_id = None if experiment_tags == None else experiment_tags[0]
+            return cached_export_tsv(battery,output_name,exp_id)
+        return export_tsv(battery,output_name,experiment_tags,filters)
+    return export_file(battery,output_name,experiment_tags,format,filters)
+
+# Export jobs, written by a Celery task for batteries too large for a request
+def export_job_context(job):
+    context = {"id":job.id,
+               "format":job.format,
+               "status":job.status,
+               "processed":job.processed,
+               "total":job.total,
+               "progress":job.get_progress(),
+               "status_url":reverse('export_job_status',args=[job.battery_id,job.id])}
+    if job.status == "SUCCESS":
+        context["download_url"] = reverse('download_export_job',args=[job.battery_id,job.id])
+    if job.status == "FAILURE":
+        context["error"] = job.error
+    return context
 
-    # Write header
-    writer.writerow(df.columns.tolist())
+@login_required
+@require_POST
+def submit_export(request,bid):
+    '''submit_export starts (or finds) the export job of a battery, or of one experiment
+    with exp_id, and returns its status
+    '''
+    battery = get_battery(bid,request)
+    if not check_battery_edit_permission(request,battery):
+        return HttpResponseForbidden()
+    format = request.POST.get("format","tsv")
+    if format not in get_export_formats():
+        return HttpResponseBadRequest("Export format is not available",content_type="text/plain")
+    try:
+        get_result_filters(request.POST)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e),content_type="text/plain")
+    filters = dict((x,request.POST.getlist(x)) for x in RESULT_FILTER_PARAMS if request.POST.get(x))
+    exp_id = request.POST.get("exp_id") or None
+    if exp_id == None:
+        output_name = "expfactory_battery_%s" %(battery.id)
+    else:
+        get_object_or_404(battery.experiments,template__exp_id=exp_id)
+        output_name = "expfactory_experiment_%s" %(exp_id)
+    job = submit_export_job(battery,output_name,exp_id,format,request.user,filters)
+    return JsonResponse(export_job_context(job))
 
-    for row in df.iterrows():
-        try:
-            values = row[1].tolist()
-            writer.writerow(values)
-        except:
-            pass
+@login_required
+def export_job_status(request,bid,jid):
+    battery = get_battery(bid,request)
+    if not check_battery_edit_permission(request,battery):
+        return HttpResponseForbidden()
+    job = get_object_or_404(ExportJob,id=jid,battery=battery)
+    return JsonResponse(export_job_context(job))
 
+@login_required
+def download_export_job(request,bid,jid):
+    '''download_export_job serves the file of a finished export job, through nginx
+    (X-Accel-Redirect to EXPORT_JOB_URL) unless in DEBUG
+    '''
+    battery = get_battery(bid,request)
+    if not check_battery_edit_permission(request,battery):
+        return HttpResponseForbidden()
+    job = get_object_or_404(ExportJob,id=jid,battery=battery,status="SUCCESS")
+    extension,content_type = EXPORT_FORMATS[job.format]
+    if settings.DEBUG:
+        path = os.path.join(settings.EXPORT_JOB_ROOT,job.file_name)
+        if not os.path.exists(path):
+            raise Http404
+        response = FileResponse(open(path,"rb"),content_type=content_type)
+    else:
+        response = HttpResponse(content_type=content_type)
+        response[settings.PRIVATE_MEDIA_REDIRECT_HEADER] = "%s%s" %(settings.EXPORT_JOB_URL,job.file_name)
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' %(job.output_name,extension)
     return response
 
 #### RESULTS VISUALIZATION #####################################################
@@ -1095,8 +1282,8 @@ def battery_results_context(request,bid):
     battery = get_battery(bid,request)
 
     # Check if battery has results
-    results = Result.objects.filter(battery=battery,completed=True)
-    completed_experiments = numpy.unique([r.experiment.exp_id for r in results]).tolist()
+    results = Result.objects.filter(battery=battery)
+    completed_experiments = get_unique_experiments(results)
     experiments = ExperimentTemplate.objects.filter(exp_id__in=completed_experiments)
     context = {'battery': battery,
                'experiments':experiments,
@@ -1110,16 +1297,19 @@ def experiment_results_dashboard(request,bid):
     if request.method == "POST":
         battery = get_battery(bid,request)
         template = get_experiment_template(request.POST["experiment"],request)
-        results = get_battery_results(battery,exp_id=template.exp_id,clean=True)
-        if len(results) == 0:
+        # The explorer reads expfactory-explorer/data/<exp_id>_data.tsv
+        if settings.EXPORT_CACHE:
+            rows = update_explorer_feed(battery,template)
+        else:
+            results = get_battery_results(battery,exp_id=template.exp_id,clean=True)
+            rows = len(results)
+            if rows > 0:
+                write_feed(get_feed_paths(template.exp_id)[1],results)
+        if rows == 0:
             context = battery_results_context(request,bid)
             context["message"] = "%s does not have any completed results." %template.name
             return render(request, "experiments/results_dashboard_battery.html", context)
 
-        # If we have results, save updated file for shiny server
-        shiny_input = os.path.abspath("expfactory-explorer/data/%s_data.tsv" %template.exp_id)
-        results.to_csv(shiny_input,sep="\t",encoding="utf-8")
-
         return HttpResponseRedirect('%s:3838' %settings.DOMAIN_NAME_HTTP)
     else:
         context = battery_results_context(request,bid)
@@ -0,0 +1,126 @@
+'''
+timing.py: per-phase timing of the serve and sync views
+
+A phase records its duration (milliseconds) and number of database queries
+to the sink named by TIMING_SINK:
+
+    "log"     one line per phase to the expdj.timing logger
+    "statsd"  statsd timers/counters over UDP to TIMING_STATSD_ADDRESS
+    "memory"  the last TIMING_MEMORY_SIZE phases, shown at /timing for admins
+
+or a dotted path to a function taking (name,duration,queries). When
+TIMING_SINK is None, phase returns a shared no-op context manager and
+timed returns the function unchanged.
+
+    with phase("serve_hit.update"):
+        hit.update()
+
+    @timed("sync")
+    def sync(request,rid=None):
+'''
+
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from expdj.settings import (
+    DEBUG, TIMING_SINK, TIMING_STATSD_ADDRESS, TIMING_MEMORY_SIZE
+)
+
+import collections
+import functools
+import logging
+import socket
+import time
+
+logger = logging.getLogger("expdj.timing")
+
+# Last phases recorded by the memory sink, oldest first
+recent_phases = collections.deque(maxlen=TIMING_MEMORY_SIZE)
+
+statsd_socket = None
+
+
+def log_sink(name,duration,queries):
+    logger.info("%s %.1fms %s queries" %(name,duration,queries))
+
+def statsd_sink(name,duration,queries):
+    global statsd_socket
+    if statsd_socket == None:
+        statsd_socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    message = "expdj.%s:%.1f|ms\nexpdj.%s.queries:%s|c" %(name,duration,name,queries)
+    try:
+        statsd_socket.sendto(message,TIMING_STATSD_ADDRESS)
+    except socket.error:
+        pass  # metrics must never break a request
+
+def memory_sink(name,duration,queries):
+    recent_phases.append({"name":name,
+                          "duration":duration,
+                          "queries":queries,
+                          "time":time.time()})
+
+SINKS = {"log":log_sink,
+         "statsd":statsd_sink,
+         "memory":memory_sink}
+
+if TIMING_SINK == None:
+    sink = None
+elif TIMING_SINK in SINKS:
+    sink = SINKS[TIMING_SINK]
+else:
+    sink = import_string(TIMING_SINK)
+
+
+class Phase(object):
+    '''Phase times the enclosed block and counts its database queries'''
+
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        # Queries are only logged by the connection with a debug cursor
+        self.debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        self.queries = len(connection.queries_log)
+        self.start = time.time()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        duration = (time.time() - self.start) * 1000
+        queries = len(connection.queries_log) - self.queries
+        connection.force_debug_cursor = self.debug_cursor
+        # The outermost phase drops the logged queries, unless DEBUG keeps them
+        if not self.debug_cursor and not DEBUG:
+            connection.queries_log.clear()
+        sink(self.name,duration,max(queries,0))
+        return False
+
+
+class NoPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        return False
+
+no_phase = NoPhase()
+
+
+def phase(name):
+    '''phase returns a context manager timing the enclosed block as name'''
+    if sink == None:
+        return no_phase
+    return Phase(name)
+
+
+def timed(name):
+    '''timed is a decorator timing each call of a function as name'''
+    def decorator(func):
+        if sink == None:
+            return func
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            with Phase(name):
+                return func(*args,**kwargs)
+        return wrapper
+    return decorator
@@ -1,10 +1,13 @@
 from django.views.decorators.csrf import requires_csrf_token
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import PermissionDenied
 from django.db.models.aggregates import Count
 from django.template import RequestContext
 from rest_framework.authtoken.models import Token
 from django.shortcuts import render, render_to_response
 from expdj.apps.experiments.models import Battery
+from expdj.apps.main import timing
+from expdj.settings import TIMING_SINK
 import hashlib
 
 def index_view(request):
@@ -37,6 +40,26 @@ def google_auth_view(request,bid,keyid):
     else:
         return render_to_response("turk/robot_sorry.html")
 
+@login_required
+def timing_view(request):
+    '''timing_view shows the phases recorded by the memory timing sink'''
+    if not request.user.is_superuser:
+        raise PermissionDenied()
+    phases = list(reversed(timing.recent_phases))
+    summary = dict()
+    for entry in phases:
+        durations = summary.setdefault(entry["name"],[])
+        durations.append(entry["duration"])
+    summary = [{"name":name,
+                "count":len(durations),
+                "mean":sum(durations)/len(durations),
+                "max":max(durations)} for name,durations in sorted(summary.items())]
+    context = {'active':'home',
+               'sink':TIMING_SINK,
+               'summary':summary,
+               'phases':phases}
+    return render(request, 'main/timing.html', context)
+
 @login_required
 def get_token(request):
     context = {'active':'home'}
@@ -0,0 +1,90 @@
+'''
+buffer.py: write-behind buffer for intermediate result syncs
+
+When RESULT_WRITE_BEHIND is True, sync stores the latest state of a result
+that is not yet FINISHED in a Redis hash keyed by result id, and the
+flush_result_buffer task writes the buffered states to the database in batches.
+A state is removed from the hash only once it is saved (and not replaced since),
+so a sync during a flush still reads the latest state of its result.
+'''
+
+import redis
+
+from expdj.apps.turk import codec
+from expdj.settings import RESULT_BUFFER_URL
+
+BUFFER_KEY = "expdj:result_buffer"
+
+_client = None
+
+def get_client():
+    '''get_client returns a (process wide) connection to the buffer'''
+    global _client
+    if _client == None:
+        _client = redis.StrictRedis.from_url(RESULT_BUFFER_URL)
+    return _client
+
+
+def buffer_result(result):
+    '''buffer_result stores the current taskdata and trial of a result
+    :param result: turk.models.Result, with unsaved changes
+    '''
+    state = {"taskdata":result.stored_taskdata(),
+             "current_trial":result.current_trial,
+             "sync_session":result.sync_session,
+             "sync_sequence":result.sync_sequence,
+             "sync_hash":result.sync_hash}
+    get_client().hset(BUFFER_KEY,result.id,codec.dumps(state))
+
+
+def load_buffered_result(result):
+    '''load_buffered_result applies a buffered state (if any) to a result,
+    which may be newer than what the database holds
+    :param result: turk.models.Result
+    '''
+    state = get_client().hget(BUFFER_KEY,result.id)
+    if state != None:
+        state = codec.loads(state)
+        result.set_taskdata(state["taskdata"])
+        result.current_trial = state["current_trial"]
+        result.sync_session = state.get("sync_session")
+        result.sync_sequence = state.get("sync_sequence")
+        result.sync_hash = state.get("sync_hash")
+
+
+def discard_buffered_result(result_id):
+    get_client().hdel(BUFFER_KEY,result_id)
+
+
+def read_buffered_results():
+    '''read_buffered_results returns all buffered states, as a dictionary of
+    result id: encoded state. The states stay buffered, and are read by syncs,
+    until remove_flushed_results is called once they are saved
+    '''
+    states = get_client().hgetall(BUFFER_KEY)
+    return dict((int(result_id),state) for result_id,state in states.items())
+
+
+# Deletes each field (ARGV id, state pairs) still holding the state that was saved
+REMOVE_FLUSHED_SCRIPT = """
+local removed = 0
+for i = 1, #ARGV, 2 do
+    if redis.call("HGET", KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call("HDEL", KEYS[1], ARGV[i])
+        removed = removed + 1
+    end
+end
+return removed
+"""
+
+def remove_flushed_results(states):
+    '''remove_flushed_results removes saved states from the buffer, except those
+    replaced by a newer sync since they were read, and returns the number removed
+    :param states: dictionary of result id: encoded state, see read_buffered_results
+    '''
+    if len(states) == 0:
+        return 0
+    args = []
+    for result_id,state in states.items():
+        args += [result_id,state]
+    return get_client().eval(REMOVE_FLUSHED_SCRIPT,1,BUFFER_KEY,*args)
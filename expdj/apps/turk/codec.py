@@ -0,0 +1,46 @@
+'''
+codec.py: JSON encoding and decoding for result data
+
+Used by sync request parsing, taskdata storage and the write-behind buffer.
+simplejson (C-backed) is used when it is installed, falling back to the
+standard library. ujson is not used: it writes floats with at most 15 digits,
+and older versions parse them imprecisely, so floats would not round-trip.
+'''
+
+import collections
+import json
+
+from expdj.settings import JSON_PRESERVE_KEY_ORDER
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+# simplejson supports object_pairs_hook, and is faster than json with speedups
+ordered_json = simplejson if simplejson != None else json
+
+# Passed to JSONField, so model fields load with the same key order setting
+if JSON_PRESERVE_KEY_ORDER:
+    LOAD_KWARGS = {'object_pairs_hook': collections.OrderedDict}
+else:
+    LOAD_KWARGS = {}
+
+
+def loads(payload,ordered=None):
+    '''loads parses a JSON string
+    :param payload: the JSON string
+    :param ordered: return OrderedDict objects, default JSON_PRESERVE_KEY_ORDER
+    '''
+    if ordered == None:
+        ordered = JSON_PRESERVE_KEY_ORDER
+    if ordered:
+        return ordered_json.loads(payload,object_pairs_hook=collections.OrderedDict)
+    return ordered_json.loads(payload)
+
+
+def dumps(data):
+    '''dumps writes data as a compact JSON string, OrderedDict keys in order
+    :param data: the data to encode
+    '''
+    return ordered_json.dumps(data,separators=(",",":"))
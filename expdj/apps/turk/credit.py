@@ -0,0 +1,139 @@
+'''
+credit.py: compiled credit conditions
+
+The credit conditions of a battery experiment (experiments.models.CreditCondition)
+are compiled once, resolving the operator and coercing the comparator, and the
+compiled conditions are kept per process keyed by the experiment and the values
+of its conditions, so an edited condition is compiled again. A compiled condition
+is evaluated on all the values of its variable in a result at once, as a NumPy
+array, see turk.tasks.evaluate_result_credit.
+'''
+
+from expdj.apps.experiments.models import CreditCondition
+
+import numpy
+
+
+OPERATORS = dict(CreditCondition.OPERATOR_CHOICES)
+
+# Compiled conditions by (Experiment.id, condition values), see get_credit_conditions
+CREDIT_CONDITION_CACHE = dict()
+CREDIT_CONDITION_CACHE_SIZE = 1000
+
+
+def parse_comparator(value):
+    '''parse_comparator returns the number and boolean of a condition value, the
+    number is None when the value is not numeric
+    '''
+    text = (value or "").strip()
+    try:
+        number = float(text)
+    except ValueError:
+        number = None
+    return number,text.lower() in ["true","1","1.0","yes"]
+
+
+def get_type_kind(value_type):
+    '''get_type_kind returns bool, number or text, the comparison of a type of value'''
+    if issubclass(value_type,(bool,numpy.bool_)):
+        return "bool"
+    if issubclass(value_type,(int,long,float,numpy.number)):
+        return "number"
+    if issubclass(value_type,basestring):
+        return "text"
+    return None
+
+
+def get_value_kind(value):
+    '''get_value_kind returns bool, number or text, the comparison of a value'''
+    return get_type_kind(type(value))
+
+
+def to_array(values):
+    '''to_array returns values as a one dimensional NumPy array of objects'''
+    array = numpy.empty(len(values),dtype=object)
+    for index,value in enumerate(values):
+        array[index] = value
+    return array
+
+
+class CompiledCondition(object):
+    '''CompiledCondition is a CreditCondition with its operator resolved and its
+    value coerced, evaluated on arrays of variable values
+    '''
+    def __init__(self,condition_id,variable_id,variable_name,operator,value,amount):
+        self.id = condition_id
+        self.variable_id = variable_id
+        self.variable_name = variable_name
+        self.operator = operator
+        self.func = OPERATORS.get(operator)
+        self.value = value
+        self.number,self.boolean = parse_comparator(value)
+        self.amount = amount
+
+    def evaluate(self,values):
+        '''evaluate returns a boolean array, True for the values satisfying the condition.
+        Booleans are compared to the boolean of the condition value, numbers to its
+        number (never satisfied when it is not numeric) and text to its text, each
+        kind of value in one comparison. The kinds are found from the types of the
+        values, and values all of one kind (the usual case) are compared as a typed
+        array without classifying each value.
+        :param values: a list of the values of the variable in a result
+        '''
+        passed = numpy.zeros(len(values),dtype=bool)
+        if self.func == None or len(values) == 0:
+            return passed
+        kinds = set([get_type_kind(x) for x in set(map(type,values))])
+        if kinds == set(["number"]):
+            if self.number == None:
+                return passed
+            return numpy.asarray(self.func(numpy.asarray(values,dtype=float),self.number),dtype=bool)
+        if kinds == set(["bool"]):
+            return numpy.asarray(self.func(numpy.asarray(values,dtype=bool),self.boolean),dtype=bool)
+        if kinds == set(["text"]):
+            return numpy.asarray(self.func(to_array(values),self.value),dtype=bool)
+        array = to_array(values)
+        kinds = numpy.array([get_value_kind(x) for x in array],dtype=object)
+        booleans = kinds == "bool"
+        numbers = kinds == "number"
+        texts = kinds == "text"
+        if booleans.any():
+            passed[booleans] = self.func(array[booleans].astype(bool),self.boolean)
+        if numbers.any() and self.number != None:
+            passed[numbers] = self.func(array[numbers].astype(float),self.number)
+        if texts.any():
+            passed[texts] = numpy.asarray(self.func(array[texts],self.value),dtype=bool)
+        return passed
+
+    def get_comparator(self,value):
+        '''get_comparator returns the condition value as compared with value'''
+        kind = get_value_kind(value)
+        if kind == "bool":
+            return self.boolean
+        if kind == "number":
+            return self.number
+        return self.value
+
+    def describe(self,value):
+        '''describe returns the description of a value satisfying the condition,
+        eg 'performance_var 556.333333333 GREATERTHAN 400.0'
+        '''
+        if get_value_kind(value) == "number":
+            value = float(value)
+        return "%s %s %s %s" %(self.variable_name,value,self.operator,self.get_comparator(value))
+
+
+def get_credit_conditions(experiment):
+    '''get_credit_conditions returns the compiled credit conditions of a battery experiment
+    :param experiment: experiments.models.Experiment
+    '''
+    rows = experiment.credit_conditions.order_by("id").values_list("id","variable_id","variable__name",
+                                                                  "operator","value","amount")
+    key = (experiment.id,tuple(rows))
+    conditions = CREDIT_CONDITION_CACHE.get(key)
+    if conditions == None:
+        if len(CREDIT_CONDITION_CACHE) >= CREDIT_CONDITION_CACHE_SIZE:
+            CREDIT_CONDITION_CACHE.clear()
+        conditions = [CompiledCondition(*row) for row in key[1]]
+        CREDIT_CONDITION_CACHE[key] = conditions
+    return conditions
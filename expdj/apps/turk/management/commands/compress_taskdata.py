@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from expdj.apps.turk.models import Result
+from expdj.apps.turk.storage import taskdata_fields
+from expdj.settings import RESULT_TASKDATA_COMPRESSION
+
+
+class Command(BaseCommand):
+    help = "Convert plain JSON Result taskdata to compressed storage, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="number of results converted per transaction")
+        parser.add_argument('--compression', default=RESULT_TASKDATA_COMPRESSION,
+                            choices=["zlib","zstd"],
+                            help="compression to use, default RESULT_TASKDATA_COMPRESSION")
+
+    def handle(self, *args, **options):
+        compression = options["compression"]
+        batch_size = options["batch_size"]
+        if compression == None:
+            raise CommandError("Set RESULT_TASKDATA_COMPRESSION or pass --compression")
+
+        pending = Result.objects.filter(taskdata_compressed__isnull=True,
+                                        taskdata__isnull=False).order_by("id")
+        total = pending.count()
+        converted = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                # Walk by id so each batch is a fresh, bounded query. The rows are
+                # locked until they are converted, so a sync saving one of them in
+                # the meantime (which also locks it) is not overwritten
+                batch = list(pending.filter(id__gt=last_id).select_for_update().only("id","taskdata")[:batch_size])
+                if len(batch) == 0:
+                    break
+                for result in batch:
+                    fields = taskdata_fields(result.taskdata,compression=compression)
+                    Result.objects.filter(id=result.id).update(**fields)
+            last_id = batch[-1].id
+            converted += len(batch)
+            self.stdout.write("Compressed %s of %s results" %(converted,total))
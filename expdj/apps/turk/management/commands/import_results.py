@@ -0,0 +1,177 @@
+import csv
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from expdj.apps.experiments.export_cache import invalidate_battery
+from expdj.apps.experiments.models import Battery, ExperimentTemplate
+from expdj.apps.turk import codec
+from expdj.apps.turk.models import (
+    ExperimentSchema, Result, Worker, WorkerBatteryProgress
+)
+from expdj.apps.turk.tasks import evaluate_result_credit
+
+
+def read_records(stream,format):
+    '''read_records yields one dictionary per result in a dump, either NDJSON
+    (one JSON object per line) or TSV with a header row, where taskdata is
+    a JSON string
+    '''
+    if format == "ndjson":
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield codec.loads(line)
+    else:
+        csv.field_size_limit(sys.maxsize)
+        for row in csv.DictReader(stream,delimiter="\t"):
+            if row.get("taskdata"):
+                row["taskdata"] = codec.loads(row["taskdata"])
+            yield row
+
+
+def read_chunks(records,chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def parse_finishtime(value):
+    if not value:
+        return None
+    finishtime = parse_datetime(value)
+    if finishtime != None and timezone.is_naive(finishtime):
+        finishtime = timezone.make_aware(finishtime,timezone.utc)
+    return finishtime
+
+
+def parse_current_trial(value):
+    if value in [None,""]:
+        return None
+    return int(value)
+
+
+def parse_completed(value):
+    if value in [None,""]:
+        return True
+    if isinstance(value,bool):
+        return value
+    return str(value).lower() in ["1","true","yes"]
+
+
+class Command(BaseCommand):
+    help = '''Import results collected offline into a battery, from an NDJSON or TSV dump.
+    Each record has worker_id, exp_id and taskdata, and optionally finishtime,
+    completed (default true), current_trial, version, language, browser and platform'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('battery_id', type=int,
+                            help="id of the battery to import into")
+        parser.add_argument('dump',
+                            help="path to the dump, - to read from stdin")
+        parser.add_argument('--format', choices=["ndjson","tsv"],
+                            help="format of the dump, default from the file extension")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="number of results inserted per transaction")
+        parser.add_argument('--evaluate-credit', action='store_true', default=False,
+                            help="queue evaluate_result_credit for imported results")
+
+    def handle(self, *args, **options):
+        try:
+            battery = Battery.objects.get(id=options["battery_id"])
+        except Battery.DoesNotExist:
+            raise CommandError("Battery %s does not exist" %options["battery_id"])
+
+        format = options["format"]
+        if format == None:
+            format = "tsv" if options["dump"].endswith((".tsv",".txt")) else "ndjson"
+
+        if options["dump"] == "-":
+            stream = sys.stdin
+        else:
+            stream = open(options["dump"],"rb")
+
+        templates = dict()
+        imported_ids = []
+        imported = 0
+        skipped = 0
+        try:
+            for chunk in read_chunks(read_records(stream,format),options["chunk_size"]):
+
+                # Templates are looked up once, the first time an exp_id is seen
+                missing = set([r["exp_id"] for r in chunk if r["exp_id"] not in templates])
+                if len(missing) > 0:
+                    for template in ExperimentTemplate.objects.filter(exp_id__in=missing):
+                        templates[template.exp_id] = template
+                unknown = missing.difference(templates.keys())
+                if len(unknown) > 0:
+                    raise CommandError("Unknown experiment templates: %s" %", ".join(sorted(unknown)))
+
+                worker_ids = set([r["worker_id"] for r in chunk])
+                with transaction.atomic():
+                    existing_workers = set(Worker.objects.filter(id__in=worker_ids).values_list("id",flat=True))
+                    Worker.objects.bulk_create([Worker(id=w) for w in worker_ids.difference(existing_workers)])
+
+                    # Results already in the battery (eg, from an earlier run) are skipped
+                    existing_results = set(Result.objects.filter(battery=battery,
+                                                                 worker_id__in=worker_ids,
+                                                                 assignment__isnull=True)
+                                                         .values_list("worker_id","experiment__exp_id"))
+                    results = []
+                    inserted = set()
+                    for record in chunk:
+                        key = (record["worker_id"],record["exp_id"])
+                        if key in existing_results:
+                            skipped += 1
+                            continue
+                        existing_results.add(key)
+                        inserted.add(key)
+                        template = templates[record["exp_id"]]
+                        result = Result(worker_id=record["worker_id"],
+                                        experiment=template,
+                                        battery=battery,
+                                        completed=parse_completed(record.get("completed")),
+                                        finishtime=parse_finishtime(record.get("finishtime")),
+                                        current_trial=parse_current_trial(record.get("current_trial")),
+                                        version=record.get("version") or template.version,
+                                        language=record.get("language") or None,
+                                        browser=record.get("browser") or None,
+                                        platform=record.get("platform") or None)
+                        result.set_taskdata(record.get("taskdata"))
+                        results.append(result)
+                    Result.objects.bulk_create(results)
+
+                    # Progress of these workers is rebuilt from their results on next use
+                    WorkerBatteryProgress.objects.filter(battery=battery,worker_id__in=worker_ids).delete()
+
+                imported += len(results)
+                if options["evaluate_credit"] and len(inserted) > 0:
+                    # bulk_create does not set ids, look them up
+                    rows = Result.objects.filter(battery=battery,
+                                                 worker_id__in=worker_ids,
+                                                 completed=True,
+                                                 assignment__isnull=True)
+                    rows = rows.values_list("id","worker_id","experiment__exp_id")
+                    imported_ids += [r[0] for r in rows if (r[1],r[2]) in inserted]
+                self.stdout.write("Imported %s results, skipped %s existing" %(imported,skipped))
+        finally:
+            if stream != sys.stdin:
+                stream.close()
+            # the exports and the schemas of the experiments are rebuilt on next use
+            if imported > 0:
+                ExperimentSchema.objects.filter(battery=battery).delete()
+                invalidate_battery(battery.id)
+
+        if options["evaluate_credit"] and len(imported_ids) > 0:
+            result_ids = [(result_id,) for result_id in imported_ids]
+            chunk_size = options["chunk_size"]
+            evaluate_result_credit.chunks(result_ids,chunk_size).apply_async()
+            self.stdout.write("Queued credit evaluation for %s results" %len(imported_ids))
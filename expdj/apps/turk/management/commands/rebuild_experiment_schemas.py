@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from expdj.apps.experiments.models import Battery, ExperimentTemplate
+from expdj.apps.turk.models import ExperimentSchema, Result, build_experiment_schema
+
+
+class Command(BaseCommand):
+    help = '''Rebuild the experiment schemas (the trial variables of each experiment in
+    a battery, used for export columns) from the completed results'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('battery_ids', nargs='*', type=int,
+                            help="ids of the batteries to rebuild, default all")
+
+    def handle(self, *args, **options):
+        batteries = Battery.objects.all()
+        if len(options["battery_ids"]) > 0:
+            batteries = batteries.filter(id__in=options["battery_ids"])
+
+        for battery in batteries:
+            exp_ids = Result.objects.filter(battery=battery,completed=True).order_by()
+            exp_ids = exp_ids.values_list("experiment_id",flat=True).distinct()
+            experiments = ExperimentTemplate.objects.filter(exp_id__in=set(exp_ids))
+            for experiment in experiments:
+                schema = build_experiment_schema(battery,experiment)
+                ExperimentSchema.objects.update_or_create(battery=battery,experiment=experiment,
+                                                          defaults={"keys":schema.keys,
+                                                                    "trialdata_keys":schema.trialdata_keys})
+            # Experiments without completed results no longer have a schema
+            ExperimentSchema.objects.filter(battery=battery).exclude(experiment__in=experiments).delete()
+            self.stdout.write("Rebuilt %s experiment schemas of battery %s" %(len(experiments),battery.id))
@@ -2,20 +2,21 @@
 # -*- coding: utf-8 -*-
 from expdj.apps.turk.utils import amazon_string_to_datetime, get_connection, \
 get_credentials, to_dict, get_time_difference
+from expdj.apps.turk.storage import decode_taskdata, taskdata_fields
+from expdj.apps.turk import codec
 from django.core.validators import MaxValueValidator, MinValueValidator
 from expdj.apps.experiments.models import Experiment, ExperimentTemplate, Battery
 from boto.mturk.qualification import AdultRequirement, NumberHitsApprovedRequirement, \
  LocaleRequirement, PercentAssignmentsApprovedRequirement, Qualifications, Requirement
 from boto.mturk.question import ExternalQuestion
-from expdj.settings import DOMAIN_NAME, BASE_DIR
-from django.db.models.signals import pre_init
+from expdj.settings import DOMAIN_NAME, BASE_DIR, EXPORT_CHUNK_SIZE
+from django.db.models.signals import pre_init, post_delete, post_save
 from django.contrib.auth.models import User
 from django.db.models import Q, DO_NOTHING
 from boto.mturk.price import Price
 from django.utils import timezone
 from jsonfield import JSONField
-from django.db import models
-import collections
+from django.db import models, transaction
 import datetime
 import boto
 
@@ -487,9 +488,79 @@ class Assignment(models.Model):
     __str__ = __unicode__
 
 
+class ResultQuerySet(models.QuerySet):
+    '''Query shapes for the ways results are read, so related objects are
+    joined instead of fetched per result, and taskdata is only loaded when used'''
+
+    def for_export(self):
+        '''for_export joins the experiment template, read for each exported row'''
+        return self.select_related("experiment")
+
+    def summaries(self):
+        '''summaries joins the worker, experiment and battery, and defers taskdata,
+        for listing results or checking their status'''
+        return self.select_related("worker","experiment","battery").defer("taskdata","taskdata_compressed",
+                                                                          "variable_index")
+
+    def for_credit(self):
+        '''for_credit joins the worker, battery, assignment and the experiment template
+        with its performance and rejection variables, read when assigning credit'''
+        return self.select_related("worker","battery","assignment__hit",
+                                   "experiment__performance_variable",
+                                   "experiment__rejection_variable")
+
+    def taskdata_only(self):
+        '''taskdata_only loads only the id and the (compressed) taskdata'''
+        return self.only("id","taskdata","taskdata_compressed")
+
+    def filter_results(self,experiment_tags=None,worker_ids=None,finished_after=None,
+                       finished_before=None,completed=None,hit_id=None,assignment_id=None):
+        '''filter_results applies the filters of exports and the results API in the
+        query, before any taskdata is read (see turk.utils.get_result_filters)
+        :param experiment_tags: list of ExperimentTemplate.exp_id
+        :param worker_ids: list of Worker.id
+        :param finished_after: results finished at or after this time
+        :param finished_before: results finished before this time
+        :param completed: True or False, None for all results
+        :param hit_id: the Amazon id of the HIT of the results
+        :param assignment_id: the Amazon id of the assignment of the results
+        '''
+        results = self
+        if experiment_tags != None:
+            results = results.filter(experiment_id__in=experiment_tags)
+        if worker_ids != None:
+            results = results.filter(worker_id__in=worker_ids)
+        if finished_after != None:
+            results = results.filter(finishtime__gte=finished_after)
+        if finished_before != None:
+            results = results.filter(finishtime__lt=finished_before)
+        if completed != None:
+            results = results.filter(completed=completed)
+        if hit_id != None:
+            results = results.filter(assignment__hit__mturk_id=hit_id)
+        if assignment_id != None:
+            results = results.filter(assignment__mturk_id=assignment_id)
+        return results
+
+    def chunked(self,chunk_size=EXPORT_CHUNK_SIZE):
+        '''chunked yields the results one chunk (query) at a time, walking the primary
+        key, as the postgres backend of Django 1.8 has no server side cursors and
+        iterator() still fetches the whole query
+        '''
+        last_id = 0
+        while True:
+            chunk = list(self.filter(id__gt=last_id).order_by("id")[:chunk_size])
+            if len(chunk) == 0:
+                break
+            for result in chunk:
+                yield result
+            last_id = chunk[-1].id
+
+
 class Result(models.Model):
     '''A result holds a battery id and an experiment template, to keep track of the battery/experiment combinations that a worker has completed'''
-    taskdata = JSONField(null=True,blank=True,load_kwargs={'object_pairs_hook': collections.OrderedDict})
+    taskdata = JSONField(null=True,blank=True,load_kwargs=codec.LOAD_KWARGS)
+    taskdata_compressed = models.BinaryField(null=True,blank=True,help_text="Compressed taskdata (see RESULT_TASKDATA_COMPRESSION), used instead of taskdata when set")
     version = models.CharField(max_length=128,null=True,blank=True,help_text="Experiment version (github commit) at completion time of result")
     worker = models.ForeignKey(Worker,null=False,blank=False,related_name='result_worker')
     experiment = models.ForeignKey(ExperimentTemplate,help_text="The Experiment Template completed by the worker in the battery",null=False,blank=False,on_delete=DO_NOTHING)
@@ -506,6 +577,12 @@ class Result(models.Model):
     credit_granted = models.BooleanField(choices=((False, 'Not granted'),
                                                   (True, 'Granted')),
                                                   default=False,verbose_name="the function assign_experiment_credit has been run to allocate credit for this result")
+    sync_session = models.CharField(max_length=64,null=True,blank=True,help_text="Client page session (X-Sync-Session) of the last sync applied to the result")
+    sync_sequence = models.PositiveIntegerField(null=True,blank=True,help_text="Client sequence number of the last sync applied to the result")
+    sync_hash = models.CharField(max_length=40,null=True,blank=True,help_text="sha1 of the payload of the last sync applied to the result")
+    variable_index = JSONField(null=True,blank=True,help_text="variables of the trials, with the values and summaries read for credit (see turk/variables.py)")
+
+    objects = ResultQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Result"
@@ -519,14 +596,305 @@ class Result(models.Model):
         return u"Result: id[%s],worker[%s],battery[%s],experiment[%s]" %(self.id,self.worker,self.battery,self.experiment)
 
     def get_taskdata(self):
+        '''get_taskdata returns taskdata as standard python objects, whether it
+        is stored as plain JSON or compressed
+        '''
+        if self.taskdata_compressed is not None:
+            return decode_taskdata(self.taskdata_compressed)
         return to_dict(self.taskdata)
 
+    def set_taskdata(self,taskdata):
+        '''set_taskdata stores taskdata, compressed if RESULT_TASKDATA_COMPRESSION is set'''
+        for field,value in taskdata_fields(taskdata).items():
+            setattr(self,field,value)
+
+    def stored_taskdata(self):
+        '''stored_taskdata returns taskdata without the to_dict conversion'''
+        if self.taskdata_compressed is not None:
+            return decode_taskdata(self.taskdata_compressed)
+        return self.taskdata
+
+    def append_trials(self,trials,first_trial):
+        '''append_trials adds new trials (delta sync) to the end of taskdata,
+        and returns the new trial count. Returns None if first_trial leaves a
+        gap after the trials already stored, in which case the client should
+        resend from trial_count(). Trials that were already stored (a retried
+        delta) are skipped.
+        :param trials: list of trials following the last acknowledged trial
+        :param first_trial: index of the first trial in trials
+        '''
+        taskdata = self.stored_taskdata()
+        if not isinstance(taskdata,list):
+            taskdata = []
+        trial_count = len(taskdata)
+        if first_trial < 0 or first_trial > trial_count:
+            return None
+        taskdata = taskdata + trials[trial_count - first_trial:]
+        self.set_taskdata(taskdata)
+        return len(taskdata)
+
+    def trial_count(self):
+        '''trial_count returns the number of trials stored in taskdata'''
+        taskdata = self.stored_taskdata()
+        if isinstance(taskdata,list):
+            return len(taskdata)
+        return 0
+
+
+class WorkerBatteryProgress(models.Model):
+    '''A worker battery progress keeps the set of experiments a worker has completed
+    in a battery, so deciding what is left does not need to read the results.
+    It is created by record_completed_experiment, use get_battery_progress to read it'''
+    worker = models.ForeignKey(Worker,null=False,blank=False,related_name='battery_progress')
+    battery = models.ForeignKey(Battery,null=False,blank=False,related_name='worker_progress')
+    completed_experiments = JSONField(default=list,help_text="exp_id of each experiment template completed by the worker in the battery")
+    completed_count = models.PositiveIntegerField(default=0,help_text="The number of experiments completed by the worker in the battery")
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Worker battery progress"
+        verbose_name_plural = "Worker battery progress"
+        unique_together = ("worker","battery")
+
+    def __unicode__(self):
+        return u"WorkerBatteryProgress: worker[%s],battery[%s],completed[%s]" %(self.worker_id,self.battery_id,self.completed_count)
+
+    def uncompleted_experiments(self):
+        '''uncompleted_experiments returns the battery experiments not yet completed'''
+        return self.battery.experiments.exclude(template__exp_id__in=self.completed_experiments)
+
+    def is_finished(self):
+        '''is_finished returns True if every experiment in the battery is completed,
+        in one query for an experiment of the battery not in completed_experiments'''
+        experiments = Battery.experiments.through.objects.filter(battery_id=self.battery_id)
+        experiments = experiments.exclude(experiment__template__exp_id__in=self.completed_experiments)
+        return not experiments.exists()
+
+
+def build_battery_progress(worker,battery):
+    '''build_battery_progress returns a new (unsaved) WorkerBatteryProgress with
+    the experiments of the worker's completed results in the battery
+    '''
+    completed = Result.objects.filter(worker=worker,battery=battery,completed=True)
+    completed = sorted(set(completed.values_list("experiment__exp_id",flat=True)))
+    return WorkerBatteryProgress(worker=worker,battery=battery,
+                                 completed_experiments=completed,
+                                 completed_count=len(completed))
+
+
+def get_battery_progress(worker,battery):
+    '''get_battery_progress returns the WorkerBatteryProgress for a worker and
+    battery. Until the worker completes an experiment of the battery there is
+    none, and an unsaved one is built from the completed results (usually none)
+    '''
+    progress = WorkerBatteryProgress.objects.filter(worker=worker,battery=battery).first()
+    if progress == None:
+        progress = build_battery_progress(worker,battery)
+    return progress
+
+
+def record_completed_experiment(result):
+    '''record_completed_experiment adds the experiment of a completed result to
+    the worker's battery progress, creating it if needed, and returns the progress
+    :param result: a turk.models.Result, with completed True
+    '''
+    progress = WorkerBatteryProgress.objects.filter(worker_id=result.worker_id,
+                                                    battery_id=result.battery_id).first()
+    if progress == None:
+        built = build_battery_progress(result.worker,result.battery)
+        progress,_ = WorkerBatteryProgress.objects.get_or_create(worker=result.worker,battery=result.battery,
+                                                                 defaults={"completed_experiments":built.completed_experiments,
+                                                                           "completed_count":built.completed_count})
+    with transaction.atomic():
+        # Lock the row, two experiments of a battery may finish at the same time
+        progress = WorkerBatteryProgress.objects.select_for_update().get(id=progress.id)
+        exp_id = result.experiment.exp_id
+        if exp_id not in progress.completed_experiments:
+            progress.completed_experiments.append(exp_id)
+            progress.completed_count = len(progress.completed_experiments)
+            progress.save()
+    return progress
+
+
+def reset_battery_progress(sender,instance,**kwargs):
+    '''a deleted result may have been counted, the progress is built again from the results'''
+    WorkerBatteryProgress.objects.filter(worker_id=instance.worker_id,
+                                         battery_id=instance.battery_id).delete()
+
+post_delete.connect(reset_battery_progress,sender=Result)
+
+
+class ExperimentSchema(models.Model):
+    '''An experiment schema keeps the variables found in the trials of the completed
+    results of an experiment in a battery: the top level keys, and the keys of
+    trialdata. Exports read their columns from it instead of scanning the results.
+    Use get_experiment_schema, which builds it from the results the first time'''
+    battery = models.ForeignKey(Battery,null=False,blank=False,related_name='experiment_schemas')
+    experiment = models.ForeignKey(ExperimentTemplate,null=False,blank=False,related_name='schemas')
+    keys = JSONField(default=list,help_text="top level keys of the trials")
+    trialdata_keys = JSONField(default=list,help_text="keys of the trialdata of the trials")
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Experiment schema"
+        verbose_name_plural = "Experiment schemas"
+        unique_together = ("battery","experiment")
+
+    def __unicode__(self):
+        return u"ExperimentSchema: battery[%s],experiment[%s]" %(self.battery_id,self.experiment_id)
+
+    def get_variables(self):
+        '''get_variables returns the sorted variables of a flattened trial, see
+        experiments.utils.get_trial_values'''
+        return sorted(set(self.keys).union(self.trialdata_keys))
+
+
+def get_trial_keys(taskdata):
+    '''get_trial_keys returns the sets of top level and trialdata keys of the trials in taskdata'''
+    keys = set()
+    trialdata_keys = set()
+    for trial in taskdata or []:
+        if isinstance(trial,dict):
+            keys.update([x for x in trial.keys() if x != "trialdata"])
+            if isinstance(trial.get("trialdata"),dict):
+                trialdata_keys.update(trial["trialdata"].keys())
+    return keys,trialdata_keys
+
+
+def build_experiment_schema(battery,experiment):
+    '''build_experiment_schema reads the completed results of an experiment in a
+    battery, and returns the keys of their trials as an unsaved ExperimentSchema
+    '''
+    keys = set()
+    trialdata_keys = set()
+    results = Result.objects.filter(battery=battery,experiment=experiment,completed=True)
+    for result in results.taskdata_only().chunked():
+        result_keys,result_trialdata_keys = get_trial_keys(result.stored_taskdata())
+        keys.update(result_keys)
+        trialdata_keys.update(result_trialdata_keys)
+    return ExperimentSchema(battery=battery,experiment=experiment,
+                            keys=sorted(keys),trialdata_keys=sorted(trialdata_keys))
+
+
+def get_experiment_schema(battery,experiment):
+    '''get_experiment_schema returns the ExperimentSchema of an experiment in a
+    battery, building it from the completed results if needed
+    '''
+    try:
+        return ExperimentSchema.objects.get(battery=battery,experiment=experiment)
+    except ExperimentSchema.DoesNotExist:
+        schema = build_experiment_schema(battery,experiment)
+        schema,_ = ExperimentSchema.objects.get_or_create(battery=battery,experiment=experiment,
+                                                          defaults={"keys":schema.keys,
+                                                                    "trialdata_keys":schema.trialdata_keys})
+        return schema
+
+
+def get_schema_variables(battery,experiment_tags=None):
+    '''get_schema_variables returns the sorted variables of the completed results
+    of a battery, from the schemas of its experiments
+    :param experiment_tags: optional list of ExperimentTemplate.exp_id
+    '''
+    experiments = Result.objects.filter(battery=battery,completed=True)
+    if experiment_tags != None:
+        experiments = experiments.filter(experiment__exp_id__in=experiment_tags)
+    exp_ids = set(experiments.order_by().values_list("experiment_id",flat=True).distinct())
+    schemas = list(ExperimentSchema.objects.filter(battery=battery,experiment_id__in=exp_ids))
+    missing = exp_ids.difference([x.experiment_id for x in schemas])
+    for experiment in ExperimentTemplate.objects.filter(exp_id__in=missing):
+        schemas.append(get_experiment_schema(battery,experiment))
+    variables = set()
+    for schema in schemas:
+        variables.update(schema.get_variables())
+    return sorted(variables)
+
+
+def add_schema_keys(schema,result,keys,trialdata_keys):
+    '''add_schema_keys adds the trial keys of a completed result to a schema, locking
+    it only when some are new, and returns the schema
+    '''
+    if keys.issubset(schema.keys) and trialdata_keys.issubset(schema.trialdata_keys):
+        return schema
+    with transaction.atomic():
+        # Lock the row, results of the experiment may finish at the same time
+        schema = ExperimentSchema.objects.select_for_update().filter(id=schema.id).first()
+        if schema == None:
+            # reset meanwhile, the rebuilt schema includes the result
+            return get_experiment_schema(result.battery,result.experiment)
+        schema.keys = sorted(keys.union(schema.keys))
+        schema.trialdata_keys = sorted(trialdata_keys.union(schema.trialdata_keys))
+        schema.save()
+    return schema
+
+
+def merge_experiment_schema(result,taskdata):
+    '''merge_experiment_schema adds the keys of the trials of a result being completed
+    to the schema of its experiment, so exports include them right away. It is
+    called by the sync request, and does nothing when there is no schema yet, as
+    building one reads every result (see update_experiment_schema)
+    :param taskdata: the taskdata of result, already read
+    '''
+    schema = ExperimentSchema.objects.filter(battery_id=result.battery_id,
+                                             experiment_id=result.experiment_id).first()
+    if schema == None:
+        return None
+    keys,trialdata_keys = get_trial_keys(taskdata)
+    return add_schema_keys(schema,result,keys,trialdata_keys)
+
+
+def update_experiment_schema(result):
+    '''update_experiment_schema adds the keys of the trials of a completed result
+    to the schema of its experiment, building the schema the first time, and
+    returns the schema
+    :param result: a turk.models.Result, with completed True
+    '''
+    schema = get_experiment_schema(result.battery,result.experiment)
+    keys,trialdata_keys = get_trial_keys(result.stored_taskdata())
+    return add_schema_keys(schema,result,keys,trialdata_keys)
+
+
+def reset_experiment_schema(sender,instance,**kwargs):
+    '''a deleted completed result may have had the only trials with some keys, the schema is rebuilt on next use'''
+    if not instance.completed:
+        return
+    ExperimentSchema.objects.filter(battery_id=instance.battery_id,
+                                    experiment_id=instance.experiment_id).delete()
+
+post_delete.connect(reset_experiment_schema,sender=Result)
+
+
+def invalidate_result_exports(sender,instance,**kwargs):
+    from expdj.apps.experiments.export_cache import invalidate_result
+    invalidate_result(instance.battery_id,instance.experiment_id)
+
+def invalidate_saved_result_exports(sender,instance,created=False,update_fields=None,**kwargs):
+    '''the taskdata of a completed result saved again may differ from the export'''
+    if created or not instance.completed:
+        return
+    if update_fields != None and not set(["taskdata","taskdata_compressed"]).intersection(update_fields):
+        return
+    invalidate_result_exports(sender,instance)
+
+def remove_battery_exports(sender,instance,**kwargs):
+    from expdj.apps.experiments.export_cache import remove_battery_exports
+    remove_battery_exports(instance.id)
+
+def invalidate_experiment_exports(sender,instance,**kwargs):
+    from expdj.apps.experiments.export_cache import invalidate_experiment
+    invalidate_experiment(instance.exp_id)
+
+# Materialized exports (experiments/export_cache.py) of deleted or changed data are removed
+post_delete.connect(invalidate_result_exports,sender=Result)
+post_save.connect(invalidate_saved_result_exports,sender=Result)
+post_delete.connect(remove_battery_exports,sender=Battery)
+post_delete.connect(invalidate_experiment_exports,sender=ExperimentTemplate)
+
 
 class Bonus(models.Model):
     '''A bonus object keeps track of a users bonuses for a battery'''
     worker = models.ForeignKey(Worker,null=False,blank=False,help_text="The ID of the Worker who is receiving bonus")
     battery = models.ForeignKey(Battery, help_text="Battery reciving bonuses for", verbose_name="Battery of experiments for bonus", null=False, blank=False)
-    amounts = JSONField(null=True,blank=True,help_text="dictionary of experiments with bonus amounts",load_kwargs={'object_pairs_hook': collections.OrderedDict})
+    amounts = JSONField(null=True,blank=True,help_text="dictionary of experiments with bonus amounts",load_kwargs=codec.LOAD_KWARGS)
     # {u'test_task': {'description': u'performance_var True EQUALS True', 'experiment_id': 113, 'amount': 3.0} # amount in dollars/cents
     granted = models.BooleanField(choices=((False, 'Not bonused'),
                                           (True, 'Bonus granted')),
@@ -551,13 +919,45 @@ class Bonus(models.Model):
         unique_together = ("worker","battery")
 
 
+class BonusPayment(models.Model):
+    '''A bonus payment is the grant of a Bonus for an assignment, sent by the payout
+    queue (see turk/payments.py). There is at most one per worker and assignment,
+    so a bonus is never paid twice.
+    '''
+    STATUS_CHOICES = (
+        ("PENDING", "Pending"),
+        ("SENDING", "Sending"),
+        ("PAID", "Paid"),
+        ("FAILED", "Failed"),
+    )
+    worker = models.ForeignKey(Worker,null=False,blank=False,help_text="The ID of the Worker who is receiving bonus")
+    assignment = models.ForeignKey(Assignment,null=False,blank=False,help_text="The assignment the bonus is granted for")
+    bonus = models.ForeignKey(Bonus,null=True,blank=True,on_delete=models.SET_NULL,help_text="The bonus amounts paid")
+    amount = models.FloatField(help_text="amount, in dollars, to grant")
+    reason = models.TextField(help_text="message to the worker for the bonus")
+    status = models.CharField(max_length=32,choices=STATUS_CHOICES,default="PENDING",db_index=True)
+    attempts = models.PositiveIntegerField(default=0,help_text="grants attempted")
+    next_attempt = models.DateTimeField(default=timezone.now,help_text="date of the next attempt, when pending")
+    error = models.TextField(null=True,blank=True,help_text="error of the last attempt")
+    add_date = models.DateTimeField('date queued', auto_now_add=True)
+    paid_date = models.DateTimeField('date paid', null=True, blank=True)
+
+    def __unicode__(self):
+        return "<%s_%s: %s>" %(self.worker_id,self.assignment_id,self.status)
+
+    class Meta:
+        verbose_name = "Bonus payment"
+        verbose_name_plural = "Bonus payments"
+        unique_together = ("worker","assignment")
+
+
 
 class Blacklist(models.Model):
     '''A blacklist prevents a user from continuing a battery'''
     worker = models.ForeignKey(Worker,null=False,blank=False,help_text="The ID of the Worker who is or is pending blacklising")
     blacklist_time = models.DateTimeField(null=True,blank=True,help_text=("Time of blacklist"))
     battery = models.ForeignKey(Battery, help_text="Battery blacklisted from", verbose_name="Battery of experiments", null=False, blank=False)
-    flags = JSONField(null=True,blank=True,help_text="dictionary of experiments with violations",load_kwargs={'object_pairs_hook': collections.OrderedDict})
+    flags = JSONField(null=True,blank=True,help_text="dictionary of experiments with violations",load_kwargs=codec.LOAD_KWARGS)
     # {u'test_task': {'description': u'credit_var True EQUALS True', 'experiment_id': 113}
     active = models.BooleanField(choices=((False, 'Not Blacklisted'),
                                           (True, 'Blacklisted')),
@@ -0,0 +1,133 @@
+'''
+payments.py: bonus payout queue
+
+Bonuses are not granted when credit is assigned. turk.tasks.queue_bonus_payment
+records a BonusPayment, one per (worker, assignment), and the pay_bonuses task (run by
+celery beat every BONUS_PAYMENT_INTERVAL seconds) sends the pending payments in
+batches of BONUS_PAYMENT_BATCH_SIZE:
+
+    - grants are throttled by a token bucket, BONUS_PAYMENT_RATE per second
+      with bursts of BONUS_PAYMENT_BURST, and a batch stops at the interval so
+      runs do not overlap
+    - one MTurk connection is opened per battery (credentials) in a batch
+    - a payment is claimed (PENDING to SENDING) with a conditional update, so
+      it is sent by one worker only, and recorded PAID once granted
+    - an error returned by MTurk (eg throttling) puts the payment back to
+      PENDING with exponential backoff, until BONUS_PAYMENT_MAX_ATTEMPTS
+
+A payment whose request failed without an answer from MTurk (eg a timeout)
+may have been granted, and stays SENDING with the error for an administrator
+to check, as sending it again could pay twice. The rest of the batch is sent.
+'''
+
+from boto.mturk.connection import MTurkRequestError
+from boto.mturk.price import Price
+
+from django.db.models import F
+from django.utils import timezone
+
+from expdj.apps.turk.models import BonusPayment, Bonus
+from expdj.settings import (
+    BONUS_PAYMENT_BATCH_SIZE, BONUS_PAYMENT_RATE, BONUS_PAYMENT_BURST,
+    BONUS_PAYMENT_INTERVAL, BONUS_PAYMENT_MAX_ATTEMPTS, BONUS_PAYMENT_BACKOFF_SECONDS
+)
+
+import datetime
+import time
+
+
+class TokenBucket(object):
+    '''TokenBucket allows rate calls per second on average, and bursts of capacity'''
+    def __init__(self,rate,capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity,self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self):
+        '''take waits for a token, and takes it'''
+        self.refill()
+        while self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self.refill()
+        self.tokens -= 1
+
+    def drain(self):
+        '''drain empties the bucket, eg after a throttling error'''
+        self.tokens = 0
+        self.last = time.time()
+
+
+def get_backoff(attempts):
+    '''get_backoff returns the wait before the next attempt of a payment, doubling
+    from BONUS_PAYMENT_BACKOFF_SECONDS up to an hour
+    '''
+    return datetime.timedelta(seconds=min(BONUS_PAYMENT_BACKOFF_SECONDS * 2 ** (attempts - 1),3600))
+
+
+def claim_payment(payment):
+    '''claim_payment marks a pending payment as SENDING, and returns False if another
+    worker claimed it first
+    '''
+    claimed = BonusPayment.objects.filter(id=payment.id,status="PENDING").update(status="SENDING",
+                                                                                 attempts=F("attempts") + 1)
+    payment.attempts += 1
+    return claimed == 1
+
+
+def send_payment(payment,connection):
+    '''send_payment grants a claimed payment, and records the outcome
+    :param connection: the MTurk connection of the battery of the payment
+    returns False when the grant failed, the error is recorded
+    '''
+    payments = BonusPayment.objects.filter(id=payment.id,status="SENDING")
+    try:
+        connection.grant_bonus(payment.worker_id,payment.assignment.mturk_id,
+                               Price(payment.amount),payment.reason)
+    except MTurkRequestError as e:
+        if payment.attempts >= BONUS_PAYMENT_MAX_ATTEMPTS:
+            payments.update(status="FAILED",error=str(e))
+        else:
+            payments.update(status="PENDING",error=str(e),
+                            next_attempt=timezone.now() + get_backoff(payment.attempts))
+        return False
+    except Exception as e:
+        # the bonus may have been granted, it is left SENDING to be checked
+        payments.update(error=str(e))
+        return False
+    payments.update(status="PAID",error=None,paid_date=timezone.now())
+    if payment.bonus_id != None:
+        Bonus.objects.filter(id=payment.bonus_id).update(granted=True)
+    return True
+
+
+def pay_due_bonuses():
+    '''pay_due_bonuses sends a batch of the pending payments that are due, and returns
+    the number paid
+    '''
+    started = time.time()
+    bucket = TokenBucket(BONUS_PAYMENT_RATE,BONUS_PAYMENT_BURST)
+    due = BonusPayment.objects.filter(status="PENDING",next_attempt__lte=timezone.now())
+    due = due.select_related("assignment__hit__battery").order_by("next_attempt")
+    connections = dict()
+    paid = 0
+    for payment in due[:BONUS_PAYMENT_BATCH_SIZE]:
+        if time.time() - started > BONUS_PAYMENT_INTERVAL:
+            break
+        hit = payment.assignment.hit
+        if hit.battery_id not in connections:
+            hit.generate_connection()
+            connections[hit.battery_id] = hit.connection
+        if not claim_payment(payment):
+            continue
+        bucket.take()
+        if send_payment(payment,connections[hit.battery_id]):
+            paid += 1
+        else:
+            bucket.drain()
+    return paid
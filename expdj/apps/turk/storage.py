@@ -0,0 +1,96 @@
+'''
+storage.py: compressed storage for Result taskdata
+
+Compressed taskdata is stored with a short header naming the compression
+and serialization used, eg "zlib:json:<payload>", so rows written under
+different settings can always be decoded.
+'''
+
+import zlib
+
+from expdj.apps.turk import codec
+from expdj.settings import RESULT_TASKDATA_COMPRESSION, RESULT_TASKDATA_SERIALIZER
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class TaskdataStorageError(Exception):
+    """Taskdata cannot be encoded or decoded with the requested codec"""
+    pass
+
+
+def serialize(taskdata,serializer):
+    if serializer == "json":
+        return codec.dumps(taskdata)
+    elif serializer == "msgpack" and msgpack != None:
+        return msgpack.packb(taskdata,use_bin_type=True)
+    raise TaskdataStorageError("serializer %s is not available" %serializer)
+
+
+def deserialize(payload,serializer):
+    if serializer == "json":
+        return codec.loads(payload)
+    elif serializer == "msgpack" and msgpack != None:
+        return msgpack.unpackb(payload,raw=False)
+    raise TaskdataStorageError("serializer %s is not available" %serializer)
+
+
+def compress(payload,compression):
+    if compression == "zlib":
+        return zlib.compress(payload)
+    elif compression == "zstd" and zstandard != None:
+        return zstandard.ZstdCompressor().compress(payload)
+    raise TaskdataStorageError("compression %s is not available" %compression)
+
+
+def decompress(payload,compression):
+    if compression == "zlib":
+        return zlib.decompress(payload)
+    elif compression == "zstd" and zstandard != None:
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise TaskdataStorageError("compression %s is not available" %compression)
+
+
+def encode_taskdata(taskdata,compression=None,serializer=None):
+    '''encode_taskdata returns taskdata serialized and compressed, with header
+    :param taskdata: the taskdata (list or dict) to encode
+    :param compression: "zlib" or "zstd", default RESULT_TASKDATA_COMPRESSION
+    :param serializer: "json" or "msgpack", default RESULT_TASKDATA_SERIALIZER
+    '''
+    compression = compression or RESULT_TASKDATA_COMPRESSION
+    serializer = serializer or RESULT_TASKDATA_SERIALIZER
+    payload = serialize(taskdata,serializer)
+    if not isinstance(payload,bytes):
+        payload = payload.encode("utf-8")
+    header = ("%s:%s:" %(compression,serializer)).encode("ascii")
+    return header + compress(payload,compression)
+
+
+def decode_taskdata(blob):
+    '''decode_taskdata reverses encode_taskdata, using the codec named in the header
+    :param blob: the stored value (bytes, buffer or memoryview)
+    '''
+    blob = bytes(blob)
+    compression,serializer,payload = blob.split(b":",2)
+    payload = decompress(payload,compression.decode("ascii"))
+    return deserialize(payload,serializer.decode("ascii"))
+
+
+def taskdata_fields(taskdata,compression=None):
+    '''taskdata_fields returns the Result column values used to store taskdata,
+    compressed when compression (or RESULT_TASKDATA_COMPRESSION) is set
+    '''
+    compression = compression or RESULT_TASKDATA_COMPRESSION
+    if compression and taskdata is not None:
+        return {"taskdata":None,
+                "taskdata_compressed":encode_taskdata(taskdata,compression=compression)}
+    return {"taskdata":taskdata,
+            "taskdata_compressed":None}
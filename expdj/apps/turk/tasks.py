@@ -1,18 +1,30 @@
 from __future__ import absolute_import
 
+import datetime
 import numpy
 import os
 
-from boto.mturk.price import Price
+from boto.mturk.connection import MTurkRequestError
 from celery import shared_task, Celery
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 
 from expdj.apps.experiments.models import ExperimentTemplate, Battery
-from expdj.apps.experiments.utils import get_experiment_type
-from expdj.apps.turk.models import Result, Assignment, get_worker, HIT, Blacklist, Bonus
-from expdj.settings import TURK
+from expdj.apps.turk import codec
+from expdj.apps.turk.buffer import read_buffered_results, remove_flushed_results
+from expdj.apps.turk.credit import get_credit_conditions
+from expdj.apps.turk.models import (Result, Assignment, get_worker, HIT,
+    Blacklist, Bonus, BonusPayment, update_experiment_schema)
+from expdj.apps.turk.payments import pay_due_bonuses
+from expdj.apps.turk.storage import taskdata_fields
+from expdj.apps.turk.variables import (
+    find_variables, get_result_variables, get_variable_index
+)
+from expdj.settings import (TURK, RESULT_BUFFER_BATCH_SIZE, CREDIT_SWEEP_MAX_AGE_DAYS,
+    CREDIT_SWEEP_GRACE_MINUTES)
 
 #  trying to import Result object directly from models was giving an import
 #  error here, even though the import matched views.py exactly.
@@ -34,80 +46,231 @@ def update_assignments(hit_id):
     except:
         pass
 
+@shared_task
+def flush_result_buffer():
+    '''flush_result_buffer writes the latest buffered state of results that
+    are still in progress (see RESULT_WRITE_BEHIND) to the database, committing
+    RESULT_BUFFER_BATCH_SIZE results per transaction. A state is removed from the
+    buffer once its batch is committed, unless a newer sync replaced it meanwhile
+    '''
+    states = read_buffered_results()
+    result_ids = sorted(states.keys())
+    for start in range(0,len(result_ids),RESULT_BUFFER_BATCH_SIZE):
+        batch = result_ids[start:start+RESULT_BUFFER_BATCH_SIZE]
+        with transaction.atomic():
+            for result_id in batch:
+                state = codec.loads(states[result_id])
+                fields = taskdata_fields(state["taskdata"])
+                fields["current_trial"] = state["current_trial"]
+                fields["sync_session"] = state.get("sync_session")
+                fields["sync_sequence"] = state.get("sync_sequence")
+                fields["sync_hash"] = state.get("sync_hash")
+                # FINISHED syncs are saved directly, and must not be overwritten
+                Result.objects.filter(id=result_id,completed=False).update(**fields)
+        remove_flushed_results(dict((result_id,states[result_id]) for result_id in batch))
+
+@shared_task
+def process_completed_result(result_id):
+    '''process_completed_result does the bookkeeping for a result that was just
+    marked as completed: the schema of its experiment (see ExperimentSchema) and
+    its variable index (see turk/variables.py)
+    :param result_id: the id of the result object, turk.models.Result
+    '''
+    result = Result.objects.select_related("battery",
+                                           "experiment__performance_variable",
+                                           "experiment__rejection_variable").get(id=result_id)
+    update_experiment_schema(result)
+    get_variable_index(result)
+
 @shared_task
 def assign_experiment_credit(worker_id):
-    '''Function to parse all results for a worker, assign credit or bonus if needed,
-    and either flag result or mark as completed. Should be fired if:
+    '''Function to assign credit (approval and bonus) for the assignments of a worker
+    that are not yet credited, see reconcile_hit_credit. Should be fired if:
       1) worker completes full battery and expfactory.djstatus variable is finished
       2) worker does not accept Consent ("Disagree") and ends battery
       3) worker is deemed to have poorly completed some N experiments in a row
-      4) worker does not complete experiments, HIT time runs out
+    Workers that finish the battery, or whose HIT time runs out, are credited by the
+    reconcile_credit sweep once the assignment is submitted.
     '''
-    # Look up all result objects for worker
     worker = get_worker(worker_id)
-    results = Result.objects.filter(worker=worker)
-    if len(results)>0:
-        result = results[0]
-        if result.assignment != None:
-            result.assignment.hit.generate_connection()
-            result.assignment.update()
-            if result.assignment.status == "S":
-                # Approve and grant bonus
-                result.assignment.approve()
-                result.assignment.completed = True
-                result.assignment.save()
-                grant_bonus(result.id)
+    assignments = get_uncredited_assignments().filter(worker=worker)
+    for hit in HIT.objects.filter(assignments__in=assignments).distinct().select_related("battery"):
+        reconcile_hit_credit(hit,assignments.filter(hit=hit))
+
+
+def get_uncredited_assignments():
+    '''get_uncredited_assignments returns the assignments not yet approved or rejected'''
+    return Assignment.objects.filter(Q(status__isnull=True)|Q(status=Assignment.SUBMITTED))
+
+
+def get_sweep_hits():
+    '''get_sweep_hits returns the HITs with uncredited assignments accepted in the last
+    CREDIT_SWEEP_MAX_AGE_DAYS that may still be credited: read as submitted, or not
+    past their deadline (plus CREDIT_SWEEP_GRACE_MINUTES), so that the HITs with only
+    abandoned assignments are not read from Amazon every sweep
+    '''
+    now = timezone.now()
+    accepted = now - datetime.timedelta(days=CREDIT_SWEEP_MAX_AGE_DAYS)
+    deadline = now - datetime.timedelta(minutes=CREDIT_SWEEP_GRACE_MINUTES)
+    # assignments accepted before the deadline was recorded have none
+    pending = Q(status=Assignment.SUBMITTED)|Q(deadline__gte=deadline)|Q(deadline__isnull=True)
+    assignments = get_uncredited_assignments().filter(pending,accept_time__gte=accepted)
+    hits = HIT.objects.filter(assignments__in=assignments,mturk_id__isnull=False).distinct()
+    return hits.exclude(status=HIT.DISPOSED).select_related("battery")
+
+
+def get_mturk_assignments(hit,page_size=100):
+    '''get_mturk_assignments returns the assignments of a HIT on Amazon, by assignment id,
+    reading them a page of page_size at a time
+    :param hit: a turk.models.HIT, with its connection
+    '''
+    assignments = dict()
+    page_number = 1
+    while True:
+        page = hit.connection.get_assignments(hit.mturk_id,page_size=page_size,page_number=page_number)
+        for mturk_assignment in page:
+            assignments[mturk_assignment.AssignmentId] = mturk_assignment
+        if page_number * page_size >= int(page.TotalNumResults):
+            return assignments
+        page_number += 1
+
+
+def reconcile_hit_credit(hit,assignments=None):
+    '''reconcile_hit_credit reads the assignments of a HIT from Amazon once, approves
+    those submitted, and records the approved ones as completed and their bonuses
+    for payment (see turk/payments.py) in bulk. Returns the number of assignments credited.
+    :param hit: a turk.models.HIT
+    :param assignments: the assignments to credit, default all uncredited of the HIT
+    '''
+    if assignments == None:
+        assignments = get_uncredited_assignments().filter(hit=hit)
+    assignments = dict((x.mturk_id,x) for x in assignments.exclude(mturk_id=None))
+    if len(assignments) == 0:
+        return 0
+    hit.generate_connection()
+    mturk_assignments = get_mturk_assignments(hit)
+
+    approved = []
+    rejected = []
+    for mturk_id,assignment in assignments.items():
+        if mturk_id not in mturk_assignments:
+            continue
+        status = Assignment.reverse_status_lookup[mturk_assignments[mturk_id].AssignmentStatus]
+        if status == Assignment.SUBMITTED:
+            try:
+                hit.connection.approve_assignment(mturk_id)
+            except MTurkRequestError:
+                # retried by the next sweep
+                continue
+            approved.append(assignment)
+        elif status == Assignment.APPROVED:
+            approved.append(assignment)
+        elif status == Assignment.REJECTED:
+            rejected.append(assignment)
+
+    with transaction.atomic():
+        Assignment.objects.filter(id__in=[x.id for x in approved]).update(status=Assignment.APPROVED,
+                                                                           completed=True)
+        Assignment.objects.filter(id__in=[x.id for x in rejected]).update(status=Assignment.REJECTED)
+        bonuses = Bonus.objects.filter(battery_id=hit.battery_id,
+                                       worker_id__in=[x.worker_id for x in approved])
+        bonuses = dict((x.worker_id,x) for x in bonuses)
+        for assignment in approved:
+            if assignment.worker_id in bonuses:
+                queue_bonus_payment(bonuses[assignment.worker_id],assignment)
+    return len(approved)
 
 
 @shared_task
-def check_blacklist(result_id):
-    '''check_blacklist compares a result (associated with an experiment) against
-    the rejection criteria, and adds a flag to the user/battery blacklist object
-    in the case of a violation. When the user/battery blacklist flag count
-    exceeds the battery.blacklist_threshold, the user is blacklisted.
-    :param result: a turk.models.Result object
+def reconcile_credit():
+    '''reconcile_credit credits the submitted assignments of the HITs returned by
+    get_sweep_hits, one HIT at a time (run by celery beat every CREDIT_SWEEP_MINUTES)
     '''
+    for hit in get_sweep_hits():
+        try:
+            reconcile_hit_credit(hit)
+        except MTurkRequestError:
+            # eg a HIT removed on Amazon, the other HITs are still credited
+            continue
+
 
-    result = Result.objects.get(id=result_id)
+@shared_task
+def evaluate_result_credit(result_id,rejection=True,reward=True):
+    '''evaluate_result_credit compares a completed result against the credit conditions
+    of its experiment in one pass. A violation of the rejection criteria adds a flag
+    to the user/battery blacklist object (the user is blacklisted when the flag count
+    exceeds the battery.blacklist_threshold), and the performance criteria record a
+    bonus, paid once the assignment is approved (see reconcile_hit_credit). The
+    variables are read from the variable index of the result, and the Blacklist and
+    Bonus are written in one transaction.
+    :param result_id: the id of the result object, turk.models.Result
+    :param rejection: False to skip the rejection criteria
+    :param reward: False to skip the performance criteria
+    '''
+    # taskdata is only read to index results completed before the variable index
+    result = Result.objects.for_credit().defer("taskdata","taskdata_compressed").get(id=result_id)
     worker = result.worker
     battery = result.battery
     experiment_template = result.experiment
-    experiment = [b for b in battery.experiments.all() if b.template == experiment_template]
-
-    if len(experiment) > 0:
-        experiment = experiment[0]
-
-        # rejection criteria
-        do_catch = True if experiment_template.rejection_variable != None and experiment.include_catch == True else False
-        do_blacklist = battery.blacklist_active
-        found_violation = False
-
-        if result.completed == True and do_catch == True and do_blacklist == True:
-
-            # A credit condition can be for reward or rejection
-            for credit_condition in experiment.credit_conditions.all():
-                variable_name = credit_condition.variable.name
-                variables = get_variables(result,variable_name)
-                func = [x[1] for x in credit_condition.OPERATOR_CHOICES if x[0] == credit_condition.operator][0]
-                func_description = [x[0] for x in credit_condition.OPERATOR_CHOICES if x[0] == credit_condition.operator][0]
-
-                # Look through variables and determine if in violation of condition
-                for variable in variables:
-                    comparator = credit_condition.value
-                    if isinstance(variable,bool):
-                        comparator = bool(comparator)
-                    elif isinstance(variable,float) or isinstance(variable,int):
-                        variable = float(variable)
-                    if not isinstance(comparator,bool) and (isinstance(comparator,float) or isinstance(comparator,int)):
-                        comparator = float(comparator)
-
-                    # If the variable passes criteria and it's a rejection variable
-                    if func(variable,comparator):
-                        if credit_condition.variable == experiment_template.rejection_variable and found_violation == False:
-                            found_violation = True
-                            description = "%s %s %s %s" %(variable_name,variable,func_description,comparator)
-                            blacklist,_ = Blacklist.objects.get_or_create(worker=worker,battery=battery)
-                            add_blacklist(blacklist,experiment,description)
+    experiment = battery.experiments.filter(template=experiment_template).first()
+    if result.completed != True or experiment == None:
+        return
+
+    # rejection and performance criteria
+    do_catch = rejection and battery.blacklist_active and experiment.include_catch
+    do_catch = do_catch and experiment_template.rejection_variable_id != None
+    do_bonus = reward and battery.bonus_active and experiment.include_bonus
+    do_bonus = do_bonus and experiment_template.performance_variable_id != None
+    variable_ids = []
+    if do_catch:
+        variable_ids.append(experiment_template.rejection_variable_id)
+    if do_bonus:
+        variable_ids.append(experiment_template.performance_variable_id)
+    conditions = [x for x in get_credit_conditions(experiment) if x.variable_id in variable_ids]
+    if len(conditions) == 0:
+        return
+    variables = get_result_variables(result,set([x.variable_name for x in conditions]))
+
+    # The first violation is flagged, the last performance condition met is the bonus
+    violation = None
+    rewards = []
+    for condition in conditions:
+        values = variables[condition.variable_name]
+        passed = numpy.flatnonzero(condition.evaluate(values))
+        if len(passed) == 0:
+            continue
+        if do_catch and condition.variable_id == experiment_template.rejection_variable_id:
+            if violation == None:
+                violation = condition.describe(values[passed[0]])
+        if do_bonus and condition.variable_id == experiment_template.performance_variable_id:
+            rewards.append((condition,condition.describe(values[passed[-1]])))
+    if violation == None and len(rewards) == 0:
+        return
+
+    with transaction.atomic():
+        if violation != None:
+            blacklist,_ = Blacklist.objects.get_or_create(worker=worker,battery=battery)
+            # concurrent results of the worker update the flags one at a time
+            blacklist = Blacklist.objects.select_for_update().get(id=blacklist.id)
+            blacklist.battery = battery
+            add_blacklist(blacklist,experiment,violation)
+        if len(rewards) > 0:
+            bonus,_ = Bonus.objects.get_or_create(worker=worker,battery=battery)
+            bonus = Bonus.objects.select_for_update().get(id=bonus.id)
+            rewards = [x for x in rewards if x[0].amount != None]
+            if len(rewards) > 0:
+                condition,description = rewards[-1]
+                add_bonus(bonus,experiment,description,condition.amount)
+                Result.objects.filter(id=result.id).update(credit_granted=True)
+
+
+@shared_task
+def check_blacklist(result_id):
+    '''check_blacklist compares a result against the rejection criteria only, see
+    evaluate_result_credit
+    :param result_id: the id of the result object, turk.models.Result
+    '''
+    evaluate_result_credit(result_id,reward=False)
 
 
 def add_blacklist(blacklist,experiment,description):
@@ -144,73 +307,60 @@ def get_bonus_reason(bonus):
         reason = "%s%s" %(reason,new_reason)
     return reason
 
+def queue_bonus_payment(bonus,assignment):
+    '''queue_bonus_payment records the payment of the total of a bonus for an
+    assignment (see turk/payments.py), and returns it. There is one payment per worker
+    and assignment, the same one is returned when called again. A bonus is paid once:
+    returns None when it is granted, or queued or paid for another assignment of the
+    worker, or when there is nothing to pay.
+    :param bonus: turk.models.Bonus
+    :param assignment: turk.models.Assignment, of the worker of bonus
+    '''
+    with transaction.atomic():
+        # the bonus is locked so two assignments of the worker cannot both queue it
+        bonus = Bonus.objects.select_for_update().get(id=bonus.id)
+        payment = BonusPayment.objects.filter(worker_id=bonus.worker_id,assignment=assignment).first()
+        if payment != None:
+            return payment
+        if bonus.granted:
+            return None
+        if BonusPayment.objects.filter(bonus=bonus,status__in=["PENDING","SENDING","PAID"]).exists():
+            return None
+        amount = bonus.calculate_bonus()
+        if amount <= 0:
+            return None
+        return BonusPayment.objects.create(worker_id=bonus.worker_id,
+                                           assignment=assignment,
+                                           bonus=bonus,
+                                           amount=amount,
+                                           reason=get_bonus_reason(bonus))
+
 def grant_bonus(result_id):
-    '''grant_bonus will calculate and grant a total bonus for a worker
+    '''grant_bonus will calculate the total bonus for a worker, and queue its payment
+    for the assignment of the result, see queue_bonus_payment
     :param result_id: the id the result to grant the bonus for
     '''
-    result = Result.objects.get(id=result_id)
-    worker = result.worker
-    battery = result.battery
-    result.assignment.hit.generate_connection()
+    result = Result.objects.summaries().select_related("assignment").get(id=result_id)
+    if result.assignment == None:
+        return None
     try:
-        bonus = Bonus.objects.get(worker=worker,battery=battery)
-        amount = bonus.calculate_bonus()
-        price = Price(amount)
-        reason = get_bonus_reason(bonus)
-        result.assignment.hit.connection.grant_bonus(worker.id,result.assignment.mturk_id,price,reason)
-        bonus.granted = True
-        bonus.save()
+        bonus = Bonus.objects.get(worker=result.worker,battery=result.battery)
     except Bonus.DoesNotExist:
-        pass
+        return None
+    return queue_bonus_payment(bonus,result.assignment)
+
+@shared_task
+def pay_bonuses():
+    '''pay_bonuses sends a batch of the queued bonus payments, see turk/payments.py'''
+    return pay_due_bonuses()
 
 @shared_task
 def experiment_reward(result_id):
-    '''experiment_reward will record bonus based on satisfying some criteria
-    The final bonus will be allocated at the end of the battery, after
-    a result is submit, with grant_bonus. This function currently has code
-    similar to check_blacklist, and the two are separate as this is expected
-    to change
-    :result_id: the id of the result object, turk.models.Result
+    '''experiment_reward records a bonus for a result meeting the performance criteria
+    only, see evaluate_result_credit
+    :param result_id: the id of the result object, turk.models.Result
     '''
-
-    # Look up all result objects for worker
-    result = Result.objects.get(id=result_id)
-    battery = result.battery
-    worker = result.worker
-    experiment_template = result.experiment
-    experiment = [b for b in battery.experiments.all() if b.template == experiment_template]
-
-    if len(experiment)>0:
-        experiment=experiment[0]
-
-        do_bonus = True if experiment_template.performance_variable != None and experiment.include_bonus == True else False
-        bonus_active = battery.bonus_active
-
-        if result.completed == True and do_bonus == True and bonus_active == True:
-            for credit_condition in experiment.credit_conditions.all():
-                variable_name = credit_condition.variable.name
-                variables = get_variables(result,variable_name)
-                func = [x[1] for x in credit_condition.OPERATOR_CHOICES if x[0] == credit_condition.operator][0]
-                func_description = [x[0] for x in credit_condition.OPERATOR_CHOICES if x[0] == credit_condition.operator][0]
-
-                # Look through variables and determine if passes condition
-                for variable in variables:
-                    comparator = credit_condition.value
-                    if isinstance(variable,bool):
-                        comparator = bool(comparator)
-                    elif isinstance(variable,float) or isinstance(variable,int):
-                        variable = float(variable)
-                        comparator = float(comparator)
-
-                    # If the variable passes criteria and it's a performance variable
-                    if func(variable,comparator):
-                        if credit_condition.variable == experiment_template.performance_variable:
-                            description = "%s %s %s %s" %(variable_name,variable,func_description,comparator)
-                            bonus,_ = Bonus.objects.get_or_create(worker=worker,battery=battery)
-                            if credit_condition.amount != None:
-                                add_bonus(bonus,experiment,description,credit_condition.amount)
-                                result.credit_granted = True
-                                result.save()
+    evaluate_result_credit(result_id,rejection=False)
 
 
 def add_bonus(bonus,experiment,description,amount):
@@ -236,114 +386,61 @@ def add_bonus(bonus,experiment,description,amount):
 
 # EXPERIMENT RESULT PARSING helper functions
 def get_unique_experiments(results):
-    experiments = []
-    for result in results:
-        if result.completed == True:
-           experiments.append(result.experiment.exp_id)
-    return numpy.unique(experiments).tolist()
+    '''get_unique_experiments returns the sorted exp_id of the completed results
+    :param results: a queryset of turk.models.Result
+    '''
+    completed = results.filter(completed=True).order_by()
+    return sorted(set(completed.values_list("experiment_id",flat=True)))
 
 
 def get_variables(result,variable_name):
-    # First try looking for variable as it is
-    variables = find_variable(result,variable_name)
-    summary_funcs = {"avg":numpy.mean,
-                     "mean":numpy.mean,
-                     "average":numpy.mean,
-                     "med":numpy.median,
-                     "median":numpy.median,
-                     "sum":numpy.sum,
-                     "total":numpy.sum,
-                     "max":numpy.max,
-                     "min":numpy.min}
-
-    # Did the user specify a summary statistic?
-    if len(variables) == 0:
-        summary_func = variable_name.split("_")[0].lower()
-        if summary_func in summary_funcs.keys():
-            name = ["_".join(variable_name.split("_")[1:])][0]
-            summary_func = summary_funcs[summary_func]
-            variables = find_variable(result,name)
-            variables = [summary_func(variables)]
-    return variables
+    '''get_variables returns the values of a variable in the trials of a result, or
+    of a summary statistic (eg mean_rt), see turk/variables.py
+    '''
+    return get_result_variables(result,[variable_name])[variable_name]
 
 def find_variable(result,variable_name):
-
-    # Surveys and games not yet implemented
-    experiment_type = get_experiment_type(result.experiment)
-    variables = []
-
-    # For experiments
-    if experiment_type == "experiments":
-        taskdata = result.taskdata
-        for trial in taskdata[0]["trialdata"]:
-            if variable_name in trial.keys():
-                variables.append(trial[variable_name])
-    return variables
-
-def get_unique_variables(results):
-    variables = []
-    for result in results:
-        if result.completed == True:
-            for trial in result.taskdata:
-                new_variables = [x for x in trial.keys() if x not in variables and x!="trialdata"]
-                variables = variables + new_variables
-                if "trialdata" in trial.keys():
-                    new_variables = [x for x in trial["trialdata"].keys() if x not in variables]
-                    variables = variables + new_variables
-    return numpy.unique(variables).tolist()
+    '''find_variable returns the values of a variable in the trials of a result,
+    see find_variables
+    '''
+    return find_variables(result,[variable_name])[variable_name]
 
 
 def check_battery_dependencies(current_battery, worker_id):
     '''
-    check_battery_dependencies looks up all of a workers completed 
-    experiments in a result object and places them in a dictionary 
-
-    organized by battery_id. Each of these buckets of results is
-    iterated through to check that every experiment in that battery has
-    been completed. In this way a list of batteries that a worker has 
-    completed is built. This list is then compared to the lists of 
-    required and restricted batteries to determine if the worker is 
-    eligible to attempt the current battery.
+    check_battery_dependencies looks up the worker's progress (see
+    turk.models.WorkerBatteryProgress) in each of the required and
+    restricted batteries of the current battery, to determine if the
+    worker is eligible to attempt the current battery.
     '''
-    worker_results = turk.models.Result.objects.filter(
-        worker_id = worker_id,
-        completed=True
-    )
-    
-    worker_result_batteries = {}
-    for result in worker_results:
-        if worker_result_batteries.get(result.battery.id):
-            worker_result_batteries[result.battery.id].append(result)
-        else:
-            worker_result_batteries[result.battery.id] = []
-            worker_result_batteries[result.battery.id].append(result)
-
-    worker_completed_batteries = []
-    for battery_id in worker_result_batteries:
-        result = worker_result_batteries[battery_id]
-        all_experiments_complete = True
-        result_experiment_list = [x.experiment_id for x in result]
-        try:
-            battery_experiments = Battery.objects.get(id=battery_id).experiments.all()
-        except ObjectDoesNotExist:
-            #  battery may have been removed.
-            continue
-        for experiment in battery_experiments:
-            if experiment.template_id not in result_experiment_list:
-                all_experiments_complete = False
-                break
-        if all_experiments_complete:
-            worker_completed_batteries.append(battery_id)
-            continue
+    worker = turk.models.Worker.objects.filter(id=worker_id).first()
+    required_batteries = list(current_battery.required_batteries.prefetch_related("experiments"))
+    restricted_batteries = list(current_battery.restricted_batteries.prefetch_related("experiments"))
+
+    # The progress of all batteries is read at once, missing rows are built
+    progress = dict()
+    if worker != None:
+        battery_ids = [b.id for b in required_batteries + restricted_batteries]
+        for battery_progress in turk.models.WorkerBatteryProgress.objects.filter(worker=worker,battery_id__in=battery_ids):
+            progress[battery_progress.battery_id] = battery_progress
+
+    def battery_finished(battery):
+        if worker == None:
+            return False
+        if battery.id not in progress:
+            progress[battery.id] = turk.models.get_battery_progress(worker,battery)
+        # template_id is the exp_id of the experiment template
+        exp_ids = set([e.template_id for e in battery.experiments.all()])
+        return exp_ids.issubset(progress[battery.id].completed_experiments)
 
     missing_batteries = []
-    for required_battery in current_battery.required_batteries.all():
-        if required_battery.id not in worker_completed_batteries:
+    for required_battery in required_batteries:
+        if not battery_finished(required_battery):
             missing_batteries.append(required_battery)
 
     blocking_batteries = []
-    for restricted_battery in current_battery.restricted_batteries.all():
-        if restricted_battery.id in worker_completed_batteries:
+    for restricted_battery in restricted_batteries:
+        if battery_finished(restricted_battery):
             blocking_batteries.append(restricted_battery)
 
     return missing_batteries, blocking_batteries
@@ -1,6 +1,5 @@
 import ConfigParser
 import datetime
-import json
 import os
 
 from boto.mturk.connection import MTurkConnection
@@ -9,8 +8,11 @@ from boto.mturk.question import ExternalQuestion
 import pandas
 
 from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
 from expdj.apps.experiments.models import Experiment
+from expdj.apps.turk import codec
 from expdj.settings import BASE_DIR, MTURK_ALLOW
 
 
@@ -20,7 +22,64 @@ def to_dict(input_ordered_dict):
     '''to_dict converts an input ordered dict into a standard dict
     :param input_ordered_dict: the ordered dict
     '''
-    return json.loads(json.dumps(input_ordered_dict))
+    return codec.loads(codec.dumps(input_ordered_dict),ordered=False)
+
+
+# Query parameters of the result filters, see get_result_filters
+RESULT_FILTER_PARAMS = ["experiment","worker","finished_after","finished_before",
+                        "completed","hit","assignment"]
+
+def get_list_param(params,name):
+    '''get_list_param returns the values of a repeated or comma separated parameter'''
+    values = []
+    for value in params.getlist(name):
+        values += [x.strip() for x in value.split(",") if x.strip()]
+    return values
+
+def parse_filter_time(value):
+    '''parse_filter_time parses an ISO date, or date and time, as UTC when naive'''
+    finishtime = parse_datetime(value)
+    if finishtime == None:
+        date = parse_date(value)
+        if date == None:
+            raise ValueError("%s is not a date or date and time" %(value))
+        finishtime = datetime.datetime.combine(date,datetime.time())
+    if timezone.is_naive(finishtime):
+        finishtime = timezone.make_aware(finishtime,timezone.utc)
+    return finishtime
+
+def get_result_filters(params):
+    '''get_result_filters reads result filters from query parameters, as keyword
+    arguments of turk.models.ResultQuerySet.filter_results:
+        experiment        exp_id, repeated or comma separated
+        worker            worker id, repeated or comma separated
+        finished_after    ISO date or date and time (UTC), inclusive
+        finished_before   ISO date or date and time (UTC), exclusive
+        completed         true, false or all
+        hit               HIT id (from Amazon)
+        assignment        assignment id (from Amazon)
+    Parameters that are not given are not in the filters.
+    :param params: a QueryDict, eg request.GET
+    raises ValueError for an invalid value
+    '''
+    filters = dict()
+    if params.get("experiment"):
+        filters["experiment_tags"] = get_list_param(params,"experiment")
+    if params.get("worker"):
+        filters["worker_ids"] = get_list_param(params,"worker")
+    for name in ["finished_after","finished_before"]:
+        if params.get(name):
+            filters[name] = parse_filter_time(params.get(name))
+    if params.get("completed"):
+        completed = params.get("completed").lower()
+        if completed not in ["true","false","all"]:
+            raise ValueError("completed must be true, false or all")
+        filters["completed"] = None if completed == "all" else completed == "true"
+    if params.get("hit"):
+        filters["hit_id"] = params.get("hit")
+    if params.get("assignment"):
+        filters["assignment_id"] = params.get("assignment")
+    return filters
 
 
 PRODUCTION_HOST = u'mechanicalturk.amazonaws.com'
@@ -116,17 +175,11 @@ def get_worker_experiments(worker,battery,completed=False):
     a worker has/has not completed for a particular battery
     :param completed: boolean, default False to return uncompleted experiments
     '''
-    from expdj.apps.turk.models import Result
-    battery_tags = [x.template.exp_id for x in battery.experiments.all()]
-    worker_experiments = Result.objects.filter(worker=worker,battery=battery)
-    worker_tags = [x.experiment.exp_id for x in worker_experiments if x.completed==True]
-
+    from expdj.apps.turk.models import get_battery_progress
+    progress = get_battery_progress(worker,battery)
     if completed==False:
-        experiment_selection = [e for e in battery_tags if e not in worker_tags]
-    else:
-        experiment_selection = [e for e in worker_tags if e in battery_tags]
-    return Experiment.objects.filter(template__exp_id__in=experiment_selection,
-                                     battery_experiments__id=battery.id)
+        return progress.uncompleted_experiments()
+    return battery.experiments.filter(template__exp_id__in=progress.completed_experiments)
 
 
 def get_time_difference(d1,d2,format='%Y-%m-%d %H:%M:%S'):
@@ -0,0 +1,184 @@
+'''
+variables.py: the variable index of results
+
+The variables of the trials of a result (the values of a variable are those of
+the trials in taskdata[0]["trialdata"] with that key) are indexed once, when the
+result is completed (see turk.tasks.process_completed_result), and stored in
+Result.variable_index:
+
+    variables     the names of all variables in the trials
+    values        the values of the performance and rejection variables of the
+                  experiment, and of the variables they summarize (eg rt for mean_rt)
+    summaries     for each numeric variable: mean, median, sum, max and min
+
+Credit evaluation reads variables and summaries (eg mean_rt) from the index,
+building it for results completed before it existed, and only scans taskdata
+for variables the index does not cover.
+'''
+
+from expdj.apps.experiments.utils import get_experiment_type
+from expdj.apps.turk.models import Result
+
+import numpy
+
+
+VARIABLE_INDEX_VERSION = 1
+
+# Summary statistics of a variable, eg mean_rt, by prefix
+SUMMARY_FUNCS = {"mean":numpy.mean,
+                 "median":numpy.median,
+                 "sum":numpy.sum,
+                 "max":numpy.max,
+                 "min":numpy.min}
+
+SUMMARY_NAMES = {"avg":"mean",
+                 "mean":"mean",
+                 "average":"mean",
+                 "med":"median",
+                 "median":"median",
+                 "sum":"sum",
+                 "total":"sum",
+                 "max":"max",
+                 "min":"min"}
+
+
+def get_summary(variable_name):
+    '''get_summary returns the summary and the variable of a summary name,
+    eg ("mean", "rt") for mean_rt, or None
+    '''
+    prefix = variable_name.split("_")[0].lower()
+    if prefix in SUMMARY_NAMES:
+        return SUMMARY_NAMES[prefix],"_".join(variable_name.split("_")[1:])
+    return None
+
+
+def get_trials(result,taskdata=None):
+    '''get_trials returns the trials searched for variables, none for surveys and games'''
+    if get_experiment_type(result.experiment) != "experiments":
+        return []
+    if taskdata == None:
+        taskdata = result.stored_taskdata()
+    if not taskdata or not isinstance(taskdata[0],dict):
+        return []
+    return taskdata[0].get("trialdata") or []
+
+
+def find_variables(result,variable_names,taskdata=None):
+    '''find_variables returns the values of variables in the trials of a result,
+    {variable_name: values}, in one pass over its taskdata
+    '''
+    variables = dict((name,[]) for name in variable_names)
+    for trial in get_trials(result,taskdata):
+        if not isinstance(trial,dict):
+            continue
+        for variable_name in variable_names:
+            if variable_name in trial.keys():
+                variables[variable_name].append(trial[variable_name])
+    return variables
+
+
+def summarize(values):
+    '''summarize returns the summary statistics of numeric values, or None'''
+    if len(values) == 0 or not all([isinstance(x,(bool,int,long,float)) for x in values]):
+        return None
+    summaries = dict()
+    for name,summary_func in SUMMARY_FUNCS.items():
+        value = float(summary_func(values))
+        summaries[name] = None if value != value else value
+    return summaries
+
+
+def get_indexed_names(experiment):
+    '''get_indexed_names returns the variables whose values are indexed for an
+    experiment template, its performance and rejection variables
+    '''
+    names = set()
+    for variable in [experiment.performance_variable,experiment.rejection_variable]:
+        if variable != None:
+            names.add(variable.name)
+            if get_summary(variable.name) != None:
+                names.add(get_summary(variable.name)[1])
+    return names
+
+
+def build_variable_index(result):
+    '''build_variable_index reads the trials of a result once, and returns its variable index
+    :param result: a turk.models.Result, with its experiment
+    '''
+    indexed = get_indexed_names(result.experiment)
+    variables = dict()
+    for trial in get_trials(result):
+        if not isinstance(trial,dict):
+            continue
+        for variable_name,value in trial.items():
+            variables.setdefault(variable_name,[]).append(value)
+    summaries = dict()
+    for variable_name,values in variables.items():
+        summary = summarize(values)
+        if summary != None:
+            summaries[variable_name] = summary
+    return {"version":VARIABLE_INDEX_VERSION,
+            "variables":sorted(variables.keys()),
+            "values":dict((x,variables[x]) for x in indexed if x in variables),
+            "summaries":summaries}
+
+
+def get_variable_index(result):
+    '''get_variable_index returns the variable index of a result, building and
+    storing it when there is none (or it is of an older version)
+    '''
+    index = result.variable_index
+    if not isinstance(index,dict) or index.get("version") != VARIABLE_INDEX_VERSION:
+        index = build_variable_index(result)
+        Result.objects.filter(id=result.id).update(variable_index=index)
+        result.variable_index = index
+    return index
+
+
+def lookup_variable(index,variable_name):
+    '''lookup_variable returns the values of a variable (or of a summary, eg
+    [mean of rt] for mean_rt) from a variable index, or None when it is not indexed
+    '''
+    if variable_name in index["values"]:
+        return index["values"][variable_name]
+    if variable_name in index["variables"]:
+        return None
+    if get_summary(variable_name) == None:
+        return []
+    summary,name = get_summary(variable_name)
+    if name not in index["variables"]:
+        return [numpy.nan]
+    if name in index["summaries"]:
+        value = index["summaries"][name][summary]
+        return [numpy.nan if value == None else value]
+    return None
+
+
+def get_result_variables(result,variable_names):
+    '''get_result_variables returns the values of several variables (or summaries,
+    eg mean_rt) in the trials of a result, {variable_name: values}, from its
+    variable index, reading the taskdata once for those not indexed
+    '''
+    index = get_variable_index(result)
+    variables = dict()
+    missing = []
+    for variable_name in variable_names:
+        values = lookup_variable(index,variable_name)
+        if values == None:
+            missing.append(variable_name)
+        else:
+            variables[variable_name] = values
+    if len(missing) == 0:
+        return variables
+
+    names = set(missing)
+    for variable_name in missing:
+        if get_summary(variable_name) != None:
+            names.add(get_summary(variable_name)[1])
+    found = find_variables(result,names)
+    for variable_name in missing:
+        variables[variable_name] = found[variable_name]
+        if len(variables[variable_name]) == 0 and get_summary(variable_name) != None:
+            summary,name = get_summary(variable_name)
+            variables[variable_name] = [SUMMARY_FUNCS[summary](found[name])]
+    return variables
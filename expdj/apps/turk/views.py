@@ -20,6 +20,7 @@ from expdj.apps.experiments.models import (Battery, ExperimentTemplate)
 from expdj.apps.experiments.views import (check_battery_edit_permission, 
     check_mturk_access, get_battery_intro, deploy_battery)
 from expdj.apps.experiments.utils import get_experiment_type, select_experiments
+from expdj.apps.main.timing import phase, timed
 from expdj.apps.turk.forms import HITForm, WorkerContactForm
 from expdj.apps.turk.models import Worker, HIT, Assignment, Result, get_worker
 from expdj.apps.turk.tasks import (assign_experiment_credit,
@@ -104,6 +105,7 @@ def manage_hit(request,bid,hid):
     return render(request, "turk/manage_hit.html", context)
 
 
+@timed("serve_hit")
 def serve_hit(request,hid):
     '''serve_hit runs the experiment after accepting a hit
     :param hid: the hit id
@@ -121,7 +123,8 @@ def serve_hit(request,hid):
         hit =  get_hit(hid,request)
 
         # Update the hit, only allow to continue if HIT is valid
-        hit.update()
+        with phase("serve_hit.hit_update"):
+            hit.update()
         if hit.status in ["D"]:
             return render_to_response("turk/hit_expired.html")
 
@@ -132,9 +135,11 @@ def serve_hit(request,hid):
             return render_to_response("turk/error_sorry.html")
 
         # Get Experiment Factory objects for each
-        worker = get_worker(aws["worker_id"])
+        with phase("serve_hit.get_worker"):
+            worker = get_worker(aws["worker_id"])
 
-        check_battery_response = check_battery_view(battery, aws["worker_id"])
+        with phase("serve_hit.dependencies"):
+            check_battery_response = check_battery_view(battery, aws["worker_id"])
         if (check_battery_response):
             return check_battery_response
 
@@ -154,16 +159,17 @@ def serve_hit(request,hid):
                                                                       worker=worker,
                                                                       hit=hit)
 
-        # if the assignment is new, we need to set up a task to run when the worker time runs out to allocate credit
+        # if the assignment is new, record when it was accepted and its deadline. Credit
+        # is allocated by the reconcile_credit sweep until the deadline (see turk/tasks.py)
         if already_created == False:
             assignment.accept_time = datetime.now()
-            if hit.assignment_duration_in_hours != None:
-                assign_experiment_credit.apply_async([worker.id],countdown=360*(hit.assignment_duration_in_hours))
+            assignment.deadline = assignment.accept_time + timedelta(hours=hit.assignment_duration_in_hours)
             assignment.save()
 
         # Does the worker have experiments remaining for the hit?
-        uncompleted_experiments = get_worker_experiments(worker,hit.battery)
-        experiments_left = len(uncompleted_experiments)  
+        with phase("serve_hit.worker_experiments"):
+            uncompleted_experiments = get_worker_experiments(worker,hit.battery)
+            experiments_left = len(uncompleted_experiments)
         if experiments_left == 0:
             # Thank you for your participation - no more experiments!
             return render_to_response("turk/worker_sorry.html")
@@ -180,12 +186,13 @@ def serve_hit(request,hid):
         template = "%s/mturk_battery.html" %(experiment_type)
 
         # Generate a new results object for the worker, assignment, experiment
-        result,_ = Result.objects.update_or_create(worker=worker,
-                                                   experiment=experimentTemplate,
-                                                   assignment=assignment, # assignment has record of HIT
-                                                   battery=hit.battery,
-                                                   defaults={"browser":browser,"platform":platform})
-        result.save()
+        with phase("serve_hit.result"):
+            result,_ = Result.objects.update_or_create(worker=worker,
+                                                       experiment=experimentTemplate,
+                                                       assignment=assignment, # assignment has record of HIT
+                                                       battery=hit.battery,
+                                                       defaults={"browser":browser,"platform":platform})
+            result.save()
 
         # Add variables to the context
         aws["amazon_host"] = host
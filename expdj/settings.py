@@ -192,18 +192,103 @@ CELERY_DEFAULT_QUEUE = 'default'
 CELERY_QUEUES = (
     Queue('default', Exchange('default'), routing_key='default'),
 )
-CELERY_IMPORTS = ('expdj.apps.turk.tasks', )
+CELERY_IMPORTS = ('expdj.apps.turk.tasks', 'expdj.apps.experiments.tasks', )
+
+# Write-behind for result syncs: intermediate (not FINISHED) syncs are kept in
+# Redis and written to the database by flush_result_buffer in batches
+RESULT_WRITE_BEHIND = False
+RESULT_BUFFER_URL = 'redis://redis:6379/1'
+RESULT_BUFFER_FLUSH_SECONDS = 30
+RESULT_BUFFER_BATCH_SIZE = 200
+
+# Bonus payout queue (see turk/payments.py): pay_bonuses runs every
+# BONUS_PAYMENT_INTERVAL seconds, granting at most BONUS_PAYMENT_BATCH_SIZE
+# bonuses at BONUS_PAYMENT_RATE per second (bursts of BONUS_PAYMENT_BURST).
+# Failed grants are retried after BONUS_PAYMENT_BACKOFF_SECONDS, doubling
+BONUS_PAYMENT_INTERVAL = 60
+BONUS_PAYMENT_BATCH_SIZE = 100
+BONUS_PAYMENT_RATE = 2
+BONUS_PAYMENT_BURST = 5
+BONUS_PAYMENT_MAX_ATTEMPTS = 8
+BONUS_PAYMENT_BACKOFF_SECONDS = 30
+
+# reconcile_credit approves the submitted assignments, and queues their bonuses,
+# of the HITs with uncredited assignments accepted in the last CREDIT_SWEEP_MAX_AGE_DAYS.
+# An assignment not yet read as submitted is swept until CREDIT_SWEEP_GRACE_MINUTES
+# after its deadline, once the worker can no longer submit it
+CREDIT_SWEEP_MINUTES = 10
+CREDIT_SWEEP_MAX_AGE_DAYS = 30
+CREDIT_SWEEP_GRACE_MINUTES = 30
 
 # here is how to run a task regularly
-#CELERYBEAT_SCHEDULE = {
-#    'task name': {
-#        'task': 'task_name',
-#        'schedule': timedelta(days=1)
-#    },
-#}
+CELERYBEAT_SCHEDULE = {
+    'flush-result-buffer': {
+        'task': 'expdj.apps.turk.tasks.flush_result_buffer',
+        'schedule': timedelta(seconds=RESULT_BUFFER_FLUSH_SECONDS)
+    },
+    'remove-expired-export-jobs': {
+        'task': 'expdj.apps.experiments.tasks.remove_expired_export_jobs',
+        'schedule': timedelta(hours=1)
+    },
+    'pay-bonuses': {
+        'task': 'expdj.apps.turk.tasks.pay_bonuses',
+        'schedule': timedelta(seconds=BONUS_PAYMENT_INTERVAL)
+    },
+    'reconcile-credit': {
+        'task': 'expdj.apps.turk.tasks.reconcile_credit',
+        'schedule': timedelta(minutes=CREDIT_SWEEP_MINUTES)
+    },
+}
 
 CELERY_TIMEZONE = 'Europe/Berlin'
 
+# Result storage
+# Compress new Result taskdata with "zlib" or "zstd" (requires zstandard),
+# serialized as "json" or "msgpack" (requires msgpack). None stores plain JSON.
+# Existing rows can be converted with python manage.py compress_taskdata
+RESULT_TASKDATA_COMPRESSION = None
+RESULT_TASKDATA_SERIALIZER = "json"
+
+# Keep the key order of JSON objects in result data (OrderedDict). Setting this
+# to False parses into plain dictionaries, which is faster (see turk/codec.py)
+JSON_PRESERVE_KEY_ORDER = True
+
+# Results read per query by the streaming export (see experiments/export.py)
+EXPORT_CHUNK_SIZE = 200
+
+# Export jobs and the export_battery command write batteries with at least
+# EXPORT_POOL_MIN_EXPERIMENTS experiments with a pool of EXPORT_PROCESSES
+# processes, one experiment each. Smaller batteries are written serially
+EXPORT_PROCESSES = 4
+EXPORT_POOL_MIN_EXPERIMENTS = 8
+
+# Materialized TSV exports, updated incrementally (see experiments/export_cache.py).
+# nginx denies /static/exports, the files are only served through the export views
+EXPORT_CACHE = True
+EXPORT_CACHE_ROOT = os.path.join(MEDIA_ROOT,"exports","cache")
+# Results committed this long after their finishtime are still appended
+EXPORT_CACHE_LATE_SECONDS = 600
+
+# Data files of the results explorer (expfactory-explorer, a Shiny app), one
+# <exp_id>_data.tsv per experiment, updated from the materialized exports
+EXPLORER_DATA_ROOT = os.path.abspath("expfactory-explorer/data")
+
+# Export jobs (see experiments/tasks.py) write to EXPORT_JOB_ROOT, served by
+# nginx from the internal location EXPORT_JOB_URL. Jobs and their files are
+# removed after EXPORT_JOB_EXPIRE_HOURS, unfinished jobs are no longer reused.
+# A job without progress for EXPORT_JOB_STALL_MINUTES (eg its worker was killed)
+# is marked as failed, and a new request starts another
+EXPORT_JOB_ROOT = os.path.join(MEDIA_ROOT,"exports","jobs")
+EXPORT_JOB_URL = "/private/exports/"
+EXPORT_JOB_EXPIRE_HOURS = 24
+EXPORT_JOB_STALL_MINUTES = 30
+
+# Per-phase timing of the serve and sync views (see apps/main/timing.py):
+# None (off), "log", "statsd", "memory" (shown at /timing) or a dotted path
+TIMING_SINK = None
+TIMING_STATSD_ADDRESS = ("localhost",8125)
+TIMING_MEMORY_SIZE = 1000
+
 # REST FRAMEWORK
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
@@ -3,15 +3,16 @@ from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from expdj.apps.experiments import urls as experiment_urls
 from django.contrib.auth.decorators import login_required
 from rest_framework import routers, serializers, viewsets
+from rest_framework.exceptions import ParseError
 from django.contrib.sitemaps.views import sitemap, index
 from django.conf.urls import include, url, patterns
 from expdj.apps.turk.models import Result, Worker
+from expdj.apps.turk.utils import get_result_filters
 from expdj.apps.users import urls as users_urls
 from django.http import Http404, HttpResponse
 from expdj.apps.main import urls as main_urls
 from expdj.apps.turk import urls as turk_urls
 from django.conf.urls.static import static
-from expdj.apps.turk.utils import to_dict
 from django.conf import settings
 from django.contrib import admin
 import os
@@ -58,7 +59,7 @@ class ResultSerializer(serializers.HyperlinkedModelSerializer):
     data = serializers.SerializerMethodField('get_taskdata')
 
     def get_taskdata(self,result):
-        return to_dict(result.taskdata)
+        return result.get_taskdata()
 
     class Meta:
         model = Result
@@ -67,9 +68,19 @@ class ResultSerializer(serializers.HyperlinkedModelSerializer):
 
 # ViewSets define the view behavior.
 class ResultViewSet(viewsets.ModelViewSet):
-    queryset = Result.objects.all()
+    queryset = Result.objects.select_related("experiment__cognitive_atlas_task","battery","worker")
     serializer_class = ResultSerializer
 
+    def get_queryset(self):
+        '''filters the results with the query parameters of turk.utils.get_result_filters,
+        eg /api/results/?experiment=stroop&finished_after=2016-01-01
+        '''
+        try:
+            filters = get_result_filters(self.request.query_params)
+        except ValueError as e:
+            raise ParseError(str(e))
+        return super(ResultViewSet,self).get_queryset().filter_results(**filters)
+
 # Routers provide an easy way of automatically determining the URL conf.
 router = routers.DefaultRouter()
 router.register(r'api/results', ResultViewSet)
@@ -0,0 +1,141 @@
+# Benchmark of experiments.utils.make_results_df against the previous
+# implementation, which filled the DataFrame cell by cell with df.loc.
+# Uses unsaved objects, so it does not touch the database:
+#
+#     python manage.py shell < scripts/benchmark_results_df.py
+#
+# The previous implementation is slow, so on TRIALS it is stopped after
+# OLD_TIME_LIMIT seconds, reporting how many trials it wrote by then.
+
+from expdj.apps.experiments.models import Experiment, ExperimentTemplate
+from expdj.apps.experiments.utils import make_results_df, make_experiment_lookup
+from django.contrib.auth.models import User
+import pandas
+import random
+import time
+
+TRIALS = [2000,5000,100000]   # trials in the batteries timed
+OLD_TIME_LIMIT = 3600         # seconds the previous version is given on each battery
+TRIALS_PER_RESULT = 500
+EXPERIMENTS = ["stroop","go_nogo","n_back","stop_signal"]
+
+
+class BenchmarkExperiments(object):
+    '''stands in for battery.experiments, used by make_experiment_lookup'''
+    def __init__(self,experiments):
+        self.experiments = experiments
+
+    def filter(self,template__exp_id):
+        return [e for e in self.experiments if e.template.exp_id == template__exp_id]
+
+
+class BenchmarkBattery(object):
+    def __init__(self):
+        self.name = "benchmark"
+        self.owner = User(username="benchmark",email="benchmark@expfactory.org")
+        experiments = []
+        for exp_id in EXPERIMENTS:
+            experiment = Experiment(include_bonus=False,include_catch=False)
+            # unsaved templates cannot be assigned to the foreign key
+            experiment._template_cache = ExperimentTemplate(exp_id=exp_id,name=exp_id)
+            experiments.append(experiment)
+        self.experiments = BenchmarkExperiments(experiments)
+
+
+class BenchmarkResult(object):
+    '''has the fields of turk.models.Result read by make_results_df'''
+    def __init__(self,result_id,worker_id,experiment,taskdata):
+        self.id = result_id
+        self.worker_id = worker_id
+        self.experiment = experiment
+        self.taskdata = taskdata
+        self.completed = True
+        self.platform = "Linux"
+        self.browser = "Chrome"
+
+    def stored_taskdata(self):
+        return self.taskdata
+
+
+def make_trial(index):
+    return {"trial_index":index,
+            "trial_type":random.choice(["poldrack-text","poldrack-single-stim","poldrack-categorize"]),
+            "rt":random.randint(200,1500),
+            "key_press":random.choice([37,39,-1]),
+            "time_elapsed":index*1000,
+            "internal_node_id":"0.0-%s.0" %index,
+            "trialdata":{"correct":random.choice([True,False]),
+                         "stim":random.choice(["red","blue","green"]),
+                         "exp_stage":"test"}}
+
+
+def make_results(battery,trials):
+    results = []
+    templates = [e.template for e in battery.experiments.experiments]
+    for worker in range(trials // TRIALS_PER_RESULT):
+        taskdata = [make_trial(t) for t in range(TRIALS_PER_RESULT)]
+        results.append(BenchmarkResult(worker,"worker%s" %worker,templates[worker % len(templates)],taskdata))
+    return results
+
+
+class BenchmarkTimeout(Exception):
+    '''the previous version ran out of time, args are the trials written'''
+    pass
+
+
+def make_results_df_loc(battery,results,time_limit=None):
+    '''the previous make_results_df, filling the frame with df.loc'''
+    started = time.time()
+    written = 0
+    variables = []
+    for result in results:
+        for trial in result.stored_taskdata():
+            variables += [x for x in trial.keys() if x not in variables and x!="trialdata"]
+            variables += [x for x in trial["trialdata"].keys() if x not in variables]
+    variables = sorted(set(variables))
+    tags = sorted(set([r.experiment.exp_id for r in results]))
+    lookup = make_experiment_lookup(tags,battery)
+    header = ['worker_id','worker_platform','worker_browser','battery_name','battery_owner',
+              'battery_owner_email','experiment_completed','experiment_include_bonus',
+              'experiment_include_catch','experiment_exp_id','experiment_name',
+              'experiment_reference','experiment_cognitive_atlas_task_id']
+    df = pandas.DataFrame(columns=header + variables)
+    for result in results:
+        taskdata = result.stored_taskdata()
+        for t in range(len(taskdata)):
+            row_id = "%s_%s_%s" %(result.experiment.exp_id,result.worker_id,t)
+            trial = taskdata[t]
+            df.loc[row_id,header[0:6]] = [result.worker_id,result.platform,result.browser,battery.name,battery.owner.username,battery.owner.email]
+            exp = lookup[result.experiment.exp_id]
+            df.loc[row_id,header[6:]] = [result.completed,exp["include_bonus"],exp["include_catch"],exp["experiment"].exp_id,exp["experiment"].name,exp["experiment"].reference,exp["experiment"].cognitive_atlas_task_id]
+            for key in trial.keys():
+                if key != "trialdata":
+                    df.loc[row_id,key] = trial[key]
+            for key in trial["trialdata"].keys():
+                df.loc[row_id,key] = trial["trialdata"][key]
+            written += 1
+        if time_limit != None and time.time() - started > time_limit:
+            raise BenchmarkTimeout(written)
+    return df
+
+
+def timed(func,battery,results):
+    start = time.time()
+    df = func(battery,results)
+    return time.time() - start, df
+
+
+battery = BenchmarkBattery()
+print("%10s %24s %14s %10s" %("trials","df.loc (s)","new (s)","speedup"))
+for trials in TRIALS:
+    results = make_results(battery,trials)
+    new_time,new_df = timed(make_results_df,battery,results)
+    try:
+        old_time,old_df = timed(lambda b,r: make_results_df_loc(b,r,OLD_TIME_LIMIT),battery,results)
+    except BenchmarkTimeout as e:
+        old_time = "> %s (%s trials)" %(OLD_TIME_LIMIT,e.args[0])
+        print("%10s %24s %14.2f %10s" %(trials,old_time,new_time,"-"))
+        continue
+    assert old_df.shape[0] == new_df.shape[0]
+    print("%10s %24.2f %14.2f %9.0fx" %(trials,old_time,new_time,old_time/new_time))
+print("columns: %s" %", ".join(new_df.columns.tolist()))